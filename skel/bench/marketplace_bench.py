@@ -0,0 +1,276 @@
+"""
+Measures the throughput and latency of the Marketplace on synthetic workloads.
+
+Run from the skel directory:
+    python3 -m bench.marketplace_bench --producers 1,4 --consumers 4,16 --output bench.json
+
+Every combination of the swept parameters (producers, consumers, products, queue sizes)
+is one run. Producers publish without sleeping and consumers retry without sleeping, so
+the numbers reflect the marketplace itself. In a synthetic run every consumer keeps filling
+carts of random products and placing orders until --duration elapses; a product that is out
+of stock counts as a retry and the consumer moves on to its next pick, so full producer
+queues always get drained. A run can also replay the shape of a test file
+(--scenario tests/10.in): its products, production plans and carts, with every wait
+removed, until the carts are done.
+"""
+import argparse
+import itertools
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from json import loads
+
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Tea
+
+METHODS = ["publish", "add_to_cart", "remove_from_cart", "place_order"]
+
+
+def parse_input():
+    """
+    Parses the command line
+    :return: the arguments namespace
+    """
+    def int_list(value):
+        return [int(x) for x in value.split(",")]
+
+    parser = argparse.ArgumentParser(description="Marketplace throughput/latency benchmark")
+    parser.add_argument("--producers", type=int_list, default=[1, 4],
+                        help="comma-separated producer counts to sweep")
+    parser.add_argument("--consumers", type=int_list, default=[1, 8],
+                        help="comma-separated consumer counts to sweep")
+    parser.add_argument("--products", type=int_list, default=[4, 32],
+                        help="comma-separated product cardinalities to sweep")
+    parser.add_argument("--queue-sizes", type=int_list, default=[8, 64],
+                        help="comma-separated queue_size_per_producer values to sweep")
+    parser.add_argument("--duration", type=float, default=2,
+                        help="seconds each synthetic run lasts")
+    parser.add_argument("--cart-size", type=int, default=10,
+                        help="add operations per cart in synthetic workloads")
+    parser.add_argument("--scenario", default=None,
+                        help="run the shape of this test file instead of the synthetic sweep")
+    parser.add_argument("--sharded", action="store_true", help="benchmark the sharded mode")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds after which an unfinished scenario run is stopped")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic workloads")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    return parser.parse_args()
+
+
+def random_carts(products, cart_size, rng):
+    """
+    Endless carts of cart_size random picks, giving back about one in ten of them.
+    A pick that is out of stock is skipped rather than retried.
+    """
+    while True:
+        cart = []
+        for product in rng.choices(products, k=cart_size):
+            cart.append({"type": "add", "product": product, "quantity": 1, "retry": False})
+            if rng.random() < 0.1:
+                cart.append({"type": "remove", "product": product, "quantity": 1})
+        yield cart
+
+
+def synthetic_workload(num_producers, num_consumers, num_products, cart_size, seed):
+    """
+    Every producer publishes every product, one unit at a time, round-robin; every consumer
+    fills random carts until the run is stopped.
+    :return: (producer plans, consumer carts) in the format of the test files
+    """
+    products = [Coffee(f"Bench coffee {i}", 1 + i % 10, "5.05", "MEDIUM") if i % 2 == 0
+                else Tea(f"Bench tea {i}", 1 + i % 10, "Herbal")
+                for i in range(num_products)]
+    producers = [[(product, 1) for product in products] for _ in range(num_producers)]
+    consumers = [random_carts(products, cart_size, random.Random(seed * 7919 + i))
+                 for i in range(num_consumers)]
+    return producers, consumers
+
+
+def scenario_workload(filename):
+    """
+    Loads the products, production plans and carts of a test file
+    :return: (producer plans, consumer carts, queue size)
+    """
+    with open(filename, encoding="utf-8") as input_file:
+        config = loads(input_file.read())
+
+    classes = {"Coffee": Coffee, "Tea": Tea}
+    products = {k: classes[v["product_type"]](**{f: x for f, x in v.items()
+                                                  if f != "product_type"})
+                for k, v in config["products"].items()}
+    producers = [[(products[i], quantity) for i, quantity, _ in producer["products"]]
+                 for producer in config["producers"]]
+    consumers = [[[dict(operation, product=products[operation["product"]])
+                   for operation in cart] for cart in consumer["carts"]]
+                 for consumer in config["consumers"]]
+    return producers, consumers, config["marketplace"]["queue_size_per_producer"]
+
+
+class Recorder:
+    """
+    Per-thread latency samples and retry counts
+    """
+
+    def __init__(self):
+        self.samples = {method: [] for method in METHODS}
+        self.retries = {"publish": 0, "add_to_cart": 0}
+
+    def call(self, method, function, *args):
+        """
+        Calls function(*args) and records how long it took under method
+        """
+        start = time.perf_counter_ns()
+        result = function(*args)
+        self.samples[method].append(time.perf_counter_ns() - start)
+        return result
+
+
+def produce(marketplace, plan, recorder, stop):
+    """
+    Publishes the plan over and over until stop is set
+    """
+    producer_id = marketplace.register_producer()
+    while not stop.is_set():
+        for product, quantity in plan:
+            published = 0
+            while published < quantity and not stop.is_set():
+                if recorder.call("publish", marketplace.publish, producer_id, product):
+                    published += 1
+                else:
+                    recorder.retries["publish"] += 1
+                    time.sleep(0)
+
+
+def consume(marketplace, carts, recorder, stop):
+    """
+    Runs every operation of each cart in a new marketplace cart, retrying failed adds
+    (unless the operation says otherwise), then places its order; returns early once stop
+    is set
+    """
+    for cart in carts:
+        cart_id = marketplace.new_cart()
+        for operation in cart:
+            for _ in range(operation["quantity"]):
+                if operation["type"] == "remove":
+                    recorder.call("remove_from_cart", marketplace.remove_from_cart,
+                                  cart_id, operation["product"])
+                    continue
+                while not recorder.call("add_to_cart", marketplace.add_to_cart,
+                                        cart_id, operation["product"]):
+                    recorder.retries["add_to_cart"] += 1
+                    if stop.is_set():
+                        return
+                    if not operation.get("retry", True):
+                        break
+                    time.sleep(0)
+        recorder.call("place_order", marketplace.place_order, cart_id)
+        if stop.is_set():
+            return
+
+
+def percentile(sorted_samples, fraction):
+    """
+    :return: the sample below which fraction of the samples fall, None if there are none
+    """
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+
+def run(queue_size, producers, consumers, args, duration):
+    """
+    Runs one workload on a fresh marketplace, for at most duration seconds
+    :return: a dict with the run's throughput, latencies and retries
+    """
+    marketplace = Marketplace(queue_size, sharded=args.sharded, log_every=0)
+    stop = threading.Event()
+    recorders = [Recorder() for _ in producers + consumers]
+    producer_threads = [threading.Thread(target=produce, args=(marketplace, plan, recorder, stop),
+                                         daemon=True)
+                        for plan, recorder in zip(producers, recorders)]
+    consumer_threads = [threading.Thread(target=consume, args=(marketplace, carts, recorder, stop),
+                                         daemon=True)
+                        for carts, recorder in zip(consumers, recorders[len(producers):])]
+
+    start = time.perf_counter()
+    for thread in producer_threads + consumer_threads:
+        thread.start()
+    deadline = start + duration
+    for thread in consumer_threads:
+        thread.join(max(0, deadline - time.perf_counter()))
+    completed = not args.scenario or not any(thread.is_alive() for thread in consumer_threads)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in producer_threads + consumer_threads:
+        thread.join()
+
+    latency = {}
+    for method in METHODS:
+        samples = sorted(itertools.chain.from_iterable(r.samples[method] for r in recorders))
+        latency[method] = {"count": len(samples),
+                           "p50_us": None if not samples else percentile(samples, 0.5) / 1000,
+                           "p99_us": None if not samples else percentile(samples, 0.99) / 1000}
+    retries = {key: sum(r.retries[key] for r in recorders) for key in ("publish", "add_to_cart")}
+    calls = sum(latency[method]["count"] for method in METHODS)
+    return {"completed": completed,
+            "elapsed_s": elapsed,
+            # successful operations only; failed publish/add_to_cart calls are the retries
+            "ops_per_sec": (calls - sum(retries.values())) / elapsed,
+            "calls_per_sec": calls / elapsed,
+            "latency": latency,
+            "retries": retries}
+
+
+def revision():
+    """
+    :return: the git revision being measured, None outside a git checkout
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """
+    Runs the sweep (or the scenario), prints one line per run and saves the results
+    """
+    args = parse_input()
+    results = []
+
+    if args.scenario:
+        producers, consumers, queue_size = scenario_workload(args.scenario)
+        runs = [({"scenario": args.scenario, "queue_size": queue_size}, queue_size,
+                 producers, consumers, args.timeout)]
+    else:
+        runs = []
+        for num_producers, num_consumers, num_products, queue_size in itertools.product(
+                args.producers, args.consumers, args.products, args.queue_sizes):
+            producers, consumers = synthetic_workload(num_producers, num_consumers, num_products,
+                                                      args.cart_size, args.seed)
+            runs.append(({"producers": num_producers, "consumers": num_consumers,
+                          "products": num_products, "queue_size": queue_size},
+                         queue_size, producers, consumers, args.duration))
+
+    for params, queue_size, producers, consumers, duration in runs:
+        result = dict(params, **run(queue_size, producers, consumers, args, duration))
+        results.append(result)
+        print(f"{params}: {result['ops_per_sec']:.0f} ops/s, "
+              f"add_to_cart p99 {result['latency']['add_to_cart']['p99_us']} us, "
+              f"retries {result['retries']}"
+              + ("" if result["completed"] else " (timed out)"), file=sys.stderr)
+
+    report = {"revision": revision(), "sharded": args.sharded, "runs": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
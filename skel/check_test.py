@@ -5,8 +5,32 @@ Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-import subprocess
 import sys
+from collections import Counter
+
+CHUNK_SIZE = 1 << 20
+# the number of differing entries shown for a failed test
+MAX_REPORTED = 10
+
+
+def entries(input_file):
+    """
+    Yields the "consumer bought product" entries of a file, reading it in chunks.
+    Every entry ends with ")" - sometimes there is no new line between consumer outputs.
+    """
+    rest = ""
+    while True:
+        chunk = input_file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        parts = (rest + chunk).split(")")
+        rest = parts.pop()
+        for part in parts:
+            part = part.strip()
+            if part:
+                yield part + ")"
+    if rest.strip():
+        yield rest.strip() + ")"
 
 
 def main():
@@ -17,29 +41,23 @@ def main():
     testname = sys.argv[1]
     output_filename = sys.argv[2]
     ref_filename = sys.argv[3]
-    # load the lines from the output file and sort them
+    # count every distinct entry of both files; the order of the entries does not matter
     with open(output_filename) as output_file:
-        output_lines = output_file.read()
-
-    output_lines = output_lines.split(")")  # sometimes there is no new line between consumer outputs
-    output_lines = [line.strip() + ")" for line in output_lines if len(line.strip()) > 0]
-
-    output_lines.sort()
-
-    sorted_output_filename = output_filename + ".sorted"
-
-    # write to input file (tests/{test_name}.in)
-    with open(sorted_output_filename, 'w') as sorted_output_file:
-        for line in output_lines:
-            print(line, file=sorted_output_file)
+        found = Counter(entries(output_file))
+    with open(ref_filename) as ref_file:
+        expected = Counter(entries(ref_file))
 
-    command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
-    out, err = command.communicate()
+    differences = [(entry, expected[entry], found[entry])
+                   for entry in {**found, **expected} if found[entry] != expected[entry]]
 
-    if len(out) == 0:
+    if not differences:
         print(f"Test {testname}" + ":\t\t" + "PASSED")
     else:
         print(f"Test {testname}" + ":\t\t" + "FAILED")
+        for entry, expected_count, found_count in differences[:MAX_REPORTED]:
+            print(f"    expected {expected_count}, found {found_count}: {entry}")
+        if len(differences) > MAX_REPORTED:
+            print(f"    ... and {len(differences) - MAX_REPORTED} more differing entries")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+"""
+This module reads a test's market configuration as a stream
+
+Computer Systems Architecture Course
+Assignment 1
+March 2020
+"""
+
+from json import JSONDecoder
+
+# the product classes are looked up by their product_type
+from tema.product import Product, Coffee, Tea  # pylint: disable=unused-import
+
+WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    """
+    Buffered cursor over a JSON text that is read in chunks
+    """
+
+    def __init__(self, input_file, chunk_size):
+        [self.input_file, self.chunk_size] = [input_file, chunk_size]
+        [self.buffer, self.position, self.eof] = ["", 0, False]
+        self.decoder = JSONDecoder()
+
+    def _fill(self):
+        """
+        Drops the consumed text and reads the next chunk. A value that does not fit in
+        the buffer doubles it, so decoding a large value costs linear time overall.
+
+        :returns False at the end of the file
+        """
+        if self.eof:
+            return False
+        chunk = self.input_file.read(max(self.chunk_size, len(self.buffer) - self.position))
+        self.eof = not chunk
+        [self.buffer, self.position] = [self.buffer[self.position:] + chunk, 0]
+        return not self.eof
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, "" at the end of the file
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer) or not self._fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, characters):
+        """
+        Consumes the next character, which must be one of characters
+
+        :returns the character
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"expected one of {characters!r}, found {character!r}")
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decodes the next JSON value. A value that ends with the buffer may be cut short
+        (a number), so it is only accepted once more text or the end of the file follows.
+        """
+        self.peek()
+        while True:
+            try:
+                [value, end] = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def members(self):
+        """
+        Yields the keys of the object that starts here; the caller must consume each
+        member's value before asking for the next key
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self):
+        """
+        Yields the elements of the array that starts here, one at a time
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def make_product(product_dict):
+    """
+    Builds the product a products entry describes
+    """
+    params = {k: product_dict[k] for k in product_dict.keys() if k != 'product_type'}
+    return globals()[product_dict['product_type']](**params)
+
+
+def iter_config(input_file, chunk_size=1 << 16):
+    """
+    Reads a market configuration incrementally. Each product is built once and shared by
+    every producer and cart operation that names its id; producers and consumers are
+    parsed one at a time, with their product ids already replaced by the products.
+
+    Yields ("products", products by id) and ("marketplace", arguments) first, then
+    ("producer", arguments) and ("consumer", arguments) in file order. The producers and
+    consumers that precede the marketplace or the products in the file are held back
+    until both have been read; those of a file that starts with both can be run while
+    the rest of it is still being parsed.
+
+    :type input_file: File
+    :param input_file: the test's market configuration (.in), opened for reading
+
+    :type chunk_size: Int
+    :param chunk_size: the number of characters read at a time
+    """
+    reader = _Reader(input_file, chunk_size)
+    [products, marketplace, pending, started] = [None, None, [], False]
+
+    def resolve(kind, config):
+        if kind == "producer":
+            config['products'] = [(products[i], quantity, sleep_time)
+                                  for i, quantity, sleep_time in config['products']]
+        else:
+            for cart in config['carts']:
+                for operation in cart:
+                    operation['product'] = products[operation['product']]
+        return kind, config
+
+    for key in reader.members():
+        if key == "products":
+            products = {}
+            for product_id in reader.members():
+                products[product_id] = make_product(reader.value())
+        elif key in ("producers", "consumers"):
+            kind = key[:-1]
+            for config in reader.elements():
+                if started:
+                    yield resolve(kind, config)
+                else:
+                    pending.append((kind, config))
+        elif key == "marketplace":
+            marketplace = reader.value()
+        else:
+            reader.value()
+
+        if not started and products is not None and marketplace is not None:
+            yield "products", products
+            yield "marketplace", marketplace
+            for kind, config in pending:
+                yield resolve(kind, config)
+            [pending, started] = [[], True]
+
+    if not started:
+        raise ValueError("the configuration lacks its marketplace or its products")
+
+
+def load_config(input_file):
+    """
+    Reads a whole market configuration
+
+    :returns a dict with the products by id, the marketplace's arguments and the
+    producers' and consumers' arguments, with their product ids replaced by the products
+    """
+    config = {"producers": [], "consumers": []}
+    for kind, value in iter_config(input_file):
+        if kind in ("producer", "consumer"):
+            config[kind + "s"].append(value)
+        else:
+            config[kind] = value
+    return config
@@ -0,0 +1,338 @@
+"""
+This module replays a recorded stream of marketplace operations, a marketplace.log or a
+trace written with test.py --trace, against a new Marketplace
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import ast
+import re
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime
+from threading import Thread
+
+from tema.marketplace import Marketplace
+from tema.marketplace_trace import MAGIC, NO_RESULT, OPS, read_trace
+from tema.product import Coffee, Tea
+from trace_analyzer import write_report
+
+PRODUCT_TYPES = {"Coffee": Coffee, "Tea": Tea}
+# the operations called by producers; the others are called by carts
+PRODUCER_OPS = {"register_producer", "publish", "publish_many", "publish_wait"}
+# their results are the new ids, which need not match between runs
+REGISTER_OPS = {"register_producer", "new_cart"}
+
+# "(2021-03-20 10:00:00,123): message" in older logs, "2021-03-20 10:00:00,123 - message"
+LOG_LINE = re.compile(r"^\(?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})\)?(?::| -) (.*)$")
+# the messages of Marketplace._log, the more specific ones first
+LOG_MESSAGES = [(op, re.compile(pattern)) for op, pattern in [
+    ("register_producer", r"^New producer: (?P<actor>\d+)$"),
+    ("publish_many", r"^Publishing (?P<quantity>\d+) x product (?P<product>.+) "
+                     r"from producer (?P<actor>\d+)$"),
+    ("publish_wait", r"^Publishing product (?P<product>.+) from producer (?P<actor>\d+) "
+                     r"\(wait\)$"),
+    ("publish", r"^Publishing product (?P<product>.+) from producer (?P<actor>\d+)$"),
+    ("new_cart", r"^Registering new cart(?: (?P<actor>\d+))?$"),
+    ("add_to_cart_many", r"^Adding (?P<quantity>\d+) x product (?P<product>.+) "
+                         r"to cart (?P<actor>\d+)$"),
+    ("add_to_cart_wait", r"^Adding product (?P<product>.+) to cart (?P<actor>\d+) \(wait\)$"),
+    ("add_to_cart", r"^Adding product (?P<product>.+) to cart (?P<actor>\d+)$"),
+    ("remove_from_cart_many", r"^Remove (?P<quantity>\d+) x product (?P<product>.+) "
+                              r"from cart (?P<actor>\d+)$"),
+    ("remove_from_cart", r"^Remove product (?P<product>.+) from cart (?P<actor>\d+)$"),
+    ("place_order", r"^Place order from cart (?P<actor>\d+)$")]]
+
+
+def parse_product(text):
+    """
+    Builds the product written as its repr, e.g. "Tea(name='Linden', price=9, type='Herbal')",
+    without evaluating anything but literals
+
+    :raises ValueError if the text is not the repr of a known product
+    """
+    node = ast.parse(text.strip(), mode="eval").body
+    if not isinstance(node, ast.Call) or getattr(node.func, "id", None) not in PRODUCT_TYPES:
+        raise ValueError(f"not a product: {text}")
+    return PRODUCT_TYPES[node.func.id](**{keyword.arg: ast.literal_eval(keyword.value)
+                                          for keyword in node.keywords})
+
+
+def from_start(operations):
+    """
+    Sorts the operations by time and makes their times relative to the first one
+    """
+    operations.sort(key=lambda operation: operation[0])
+    start = operations[0][0] if operations else 0.0
+    return [(operation[0] - start,) + operation[1:] for operation in operations]
+
+
+def read_log(paths):
+    """
+    Reads the operations logged by the marketplace. The log has no results, so nothing can
+    diverge, and with --log-every above 1 it holds only a sample of the operations.
+
+    :type paths: List
+    :param paths: the log files, the rotated ones first (marketplace.log.2, .1, then .log)
+
+    :returns the operations, by start time, as tuples of (seconds since the first one, op,
+    recorded actor id, product, quantity, result), with a None result
+    """
+    [operations, products, carts] = [[], {}, 0]
+    for path in paths:
+        with open(path, encoding="utf-8") as log_file:
+            for line in log_file:
+                match = LOG_LINE.match(line.rstrip("\n"))
+                if match is None:
+                    continue
+                [stamp, message] = match.groups()
+                for op, pattern in LOG_MESSAGES:
+                    fields = pattern.match(message)
+                    if fields is not None:
+                        break
+                else:
+                    continue
+                fields = fields.groupdict()
+                if fields.get("actor") is None:
+                    # older logs leave out the id of a new cart: it is the next one
+                    [actor, carts] = [carts, carts + 1]
+                else:
+                    actor = int(fields["actor"])
+                    if op == "new_cart":
+                        carts = max(carts, actor + 1)
+                product = None
+                if "product" in fields:
+                    if fields["product"] not in products:
+                        products[fields["product"]] = parse_product(fields["product"])
+                    product = products[fields["product"]]
+                when = datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S,%f").timestamp()
+                operations.append((when, op, actor, product, int(fields.get("quantity", 1)),
+                                   None))
+    return from_start(operations)
+
+
+def read_trace_operations(path):
+    """
+    Reads the operations recorded in a trace, with the .products file next to it
+
+    :returns the operations, as read_log does, with the recorded results; a call that
+    returned a boolean has the result 0 or 1 and an order has its number of units
+    """
+    trace = read_trace(path)
+    if trace["lost"]:
+        print(f"{trace['lost']} older records were overwritten: the replay starts from an "
+              f"empty marketplace, so results may diverge", file=sys.stderr)
+    products = [parse_product(text) for text in trace["products"]]
+    operations = []
+    for [when, duration, op, actor, product_id, quantity, result] in trace["records"]:
+        if product_id >= len(products):
+            raise ValueError(f"{path}.products has no product {product_id}")
+        operations.append((when - duration, OPS[op], actor,
+                           products[product_id] if product_id >= 0 else None, quantity,
+                           None if result == NO_RESULT or OPS[op] in REGISTER_OPS else result))
+    return from_start(operations)
+
+
+def read_operations(paths):
+    """
+    Reads the operations of a trace or of marketplace logs, telling them apart by the
+    magic number at the start of a trace
+    """
+    with open(paths[0], "rb") as first_file:
+        is_trace = first_file.read(len(MAGIC)) == MAGIC
+    if is_trace:
+        if len(paths) > 1:
+            raise ValueError("only one trace can be replayed at a time")
+        return read_trace_operations(paths[0])
+    return read_log(paths)
+
+
+def units(result):
+    """
+    Returns a call's result as a number: a boolean as 0 or 1 and an order as its units
+    """
+    if isinstance(result, list):
+        return sum(line[1] if isinstance(line, tuple) else 1 for line in result)
+    return None if result is None else int(result)
+
+
+class Replayer:
+    """
+    Replays operations against a marketplace. Every producer and cart is replayed by one
+    worker thread, so its operations keep their recorded order; the actors are spread
+    over the workers in the order they first appear. The recorded ids are mapped to the
+    ids the marketplace gives, and producers and carts created before the recording
+    started are registered on their first operation.
+    """
+
+    def __init__(self, marketplace, speed=1.0, wait_timeout=1.0):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace to replay against
+
+        :type speed: Float
+        :param speed: how many times faster than recorded to replay, 0 for as fast as possible
+
+        :type wait_timeout: Float
+        :param wait_timeout: the timeout of the publish_wait and add_to_cart_wait calls,
+        which were not recorded
+        """
+        [self.marketplace, self.speed, self.wait_timeout] = [marketplace, speed, wait_timeout]
+        # (kind, recorded id) -> the id given by the marketplace
+        self.ids = {}
+
+    def actor(self, op, recorded_id):
+        """
+        Returns the marketplace id of the producer or cart with the recorded id,
+        registering it if it has none yet
+        """
+        key = ("producer" if op in PRODUCER_OPS else "cart", recorded_id)
+        if key not in self.ids:
+            self.ids[key] = self.marketplace.register_producer() if key[0] == "producer" \
+                else self.marketplace.new_cart()
+        return self.ids[key]
+
+    def call(self, op, actor, product, quantity):
+        """
+        Calls the operation on the marketplace
+
+        :returns its result, as a number
+        """
+        if op in REGISTER_OPS:
+            self.actor(op, actor)
+            return None
+        actor_id = self.actor(op, actor)
+        method = getattr(self.marketplace, op)
+        if op == "place_order":
+            return units(method(actor_id))
+        if op.endswith("_many"):
+            return units(method(actor_id, product, quantity))
+        if op.endswith("_wait"):
+            return units(method(actor_id, product, timeout=self.wait_timeout))
+        return units(method(actor_id, product))
+
+    def replay(self, operations, stats, start):
+        """
+        Replays the operations in order, each at its recorded time scaled by the speed,
+        collecting into stats the calls, the divergences and how far behind it fell
+        """
+        for position, [when, op, actor, product, quantity, expected] in operations:
+            if self.speed:
+                delay = start + when / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    stats["max_lag"] = max(stats["max_lag"], -delay)
+            result = self.call(op, actor, product, quantity)
+            stats["calls"][op] += 1
+            if expected is not None and result != expected:
+                stats["divergences"][op] += 1
+                stats["examples"].append({"position": position, "op": op, "actor": actor,
+                                          "product": str(product), "expected": expected,
+                                          "result": result})
+
+    def run(self, operations, concurrency=1):
+        """
+        Replays the operations on concurrency worker threads
+
+        :returns a dict with the calls and the divergences by op, the first divergences,
+        sorted by position, the elapsed seconds and the achieved throughput
+        """
+        [workers, assigned] = [[[] for _ in range(concurrency)], {}]
+        for position, operation in enumerate(operations):
+            key = ("producer" if operation[1] in PRODUCER_OPS else "cart", operation[2])
+            assigned.setdefault(key, len(assigned) % concurrency)
+            workers[assigned[key]].append((position, operation))
+
+        stats = [{"calls": Counter(), "divergences": Counter(), "examples": [], "max_lag": 0.0}
+                 for _ in workers]
+        start = time.perf_counter()
+        threads = [Thread(target=self.replay, args=(worker, worker_stats, start))
+                   for worker, worker_stats in zip(workers, stats)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        [calls, divergences] = [sum((s["calls"] for s in stats), Counter()),
+                                sum((s["divergences"] for s in stats), Counter())]
+        return {"operations": len(operations), "elapsed_s": elapsed,
+                "throughput": len(operations) / elapsed if elapsed else 0.0,
+                "recorded_s": operations[-1][0] if operations else 0.0,
+                "max_lag_s": max(s["max_lag"] for s in stats),
+                "calls": dict(calls), "divergences": dict(divergences),
+                "examples": sorted((example for s in stats for example in s["examples"]),
+                                   key=lambda example: example["position"])}
+
+
+def print_report(results, show):
+    """
+    Prints the results of Replayer.run, with the first show divergences
+    """
+    print(f"{results['operations']} operations replayed in {results['elapsed_s']:.3f}s "
+          f"({results['throughput']:.0f}/s), recorded over {results['recorded_s']:.3f}s")
+    if results["max_lag_s"]:
+        print(f"At most {results['max_lag_s']:.3f}s behind the recorded times")
+
+    print("\nCalls (op: calls, divergent results)")
+    for op in OPS:
+        if op in results["calls"]:
+            print(f"  {op}: {results['calls'][op]}, {results['divergences'].get(op, 0)}")
+
+    print(f"\nDivergences: {sum(results['divergences'].values())}")
+    for example in results["examples"][:show]:
+        print(f"  #{example['position']} {example['op']}({example['actor']}, "
+              f"{example['product']}): recorded {example['expected']}, "
+              f"replayed {example['result']}")
+
+
+def main():
+    """
+    Replays the operations given on the command line
+    """
+    parser = ArgumentParser(description="Replay a marketplace.log or a trace written by "
+                                        "test.py --trace against a new Marketplace")
+    parser.add_argument("recording", nargs="+",
+                        help="a trace, or log files, the rotated ones first")
+    parser.add_argument("--queue-size", type=int, required=True,
+                        help="the queue_size_per_producer of the marketplace")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times faster than recorded to replay, 0 for as fast "
+                             "as possible")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="the number of worker threads the producers and carts are "
+                             "spread over")
+    parser.add_argument("--wait-timeout", type=float, default=1.0,
+                        help="the timeout of the replayed publish_wait and add_to_cart_wait")
+    parser.add_argument("--sharded", action="store_true",
+                        help="use striped inventory locks and per-producer/per-cart locks")
+    parser.add_argument("--waitlist", action="store_true",
+                        help="queue the carts for missing units and hand them new ones first")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep the units in typed-array queues")
+    parser.add_argument("--log-every", type=int, default=0,
+                        help="log one in every N replayed operations, none by default")
+    parser.add_argument("--show", type=int, default=10,
+                        help="the number of divergences shown")
+    parser.add_argument("--report", default=None,
+                        help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    operations = read_operations(args.recording)
+    marketplace = Marketplace(args.queue_size, sharded=args.sharded, log_every=args.log_every,
+                              waitlist=args.waitlist, compact=args.compact)
+    results = Replayer(marketplace, args.speed, args.wait_timeout).run(operations,
+                                                                       args.concurrency)
+    print_report(results, args.show)
+    write_report(results, args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+This module runs the homework's tests concurrently and checks their output
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+TESTS = "tests"
+PYTHON_CMD = sys.executable or "python3"
+# seconds each test may run, as in run_tests.sh
+TIMEOUT_VALS = {i: 30 if i <= 8 else 60 for i in range(1, 11)}
+# tests spend most of their time asleep, so every CPU can run several of them at once
+TESTS_PER_CPU = 10
+
+
+def run_test(test, timeout, extra_args):
+    """
+    Runs test.py on a test, killing it after timeout seconds, then checks its output
+
+    :returns a dict with the lines to print, the wall time and the peak RSS of the run
+    """
+    prefix = f"{test:02d}"
+    output_filename = f"{TESTS}/{prefix}.out"
+    start = time.monotonic()
+    with open(output_filename, "w", encoding="utf-8") as output_file:
+        # the process is reaped below by os.wait4, not by a with block
+        # pylint: disable=consider-using-with
+        process = subprocess.Popen([PYTHON_CMD, "test.py", *extra_args, f"{TESTS}/{prefix}.in"],
+                                   stdout=output_file)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    # wait4 reaps the process and reports its resource usage
+    [_, status, usage] = os.wait4(process.pid, 0)
+    timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.monotonic() - start
+
+    lines = [f"Starting test {test}"]
+    if process.returncode != 0:
+        lines.append(f"TIMEOUT. Test {test} exceeded maximum allowed time of {timeout}"
+                     if timed_out.is_set()
+                     else f"ERROR. Test {test} exited with code {process.returncode}")
+    lines.append(f"Finished test {test}")
+    check = subprocess.run([PYTHON_CMD, "check_test.py", str(test), output_filename,
+                            f"{TESTS}/{prefix}.ref.out"], capture_output=True, text=True,
+                           check=False)
+    lines.append(check.stdout.rstrip("\n"))
+    # ru_maxrss is in kilobytes on Linux
+    lines.append(f"Stats {prefix}: wall time {wall_time:.2f}s, peak RSS {usage.ru_maxrss} KB")
+    return {"test": test, "passed": check.stdout.split("\n", 1)[0].endswith("PASSED"),
+            "wall_time_s": wall_time, "peak_rss_kb": usage.ru_maxrss, "lines": lines}
+
+
+def main():
+    """
+    Runs the selected tests in a pool, printing the results in test order
+    """
+    parser = ArgumentParser(description="Run the tests concurrently; unknown arguments "
+                                        "are passed on to test.py")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help=f"the number of tests run at the same time (default: "
+                             f"{TESTS_PER_CPU} per usable CPU)")
+    parser.add_argument("--tests", type=lambda value: [int(x) for x in value.split(",")],
+                        default=sorted(TIMEOUT_VALS), help="comma-separated test numbers")
+    parser.add_argument("--report", default=None,
+                        help="also write the results, with times and memory, to this JSON file")
+    [args, extra_args] = parser.parse_known_args()
+
+    # Cleanup the previous run's temporary files
+    for name in os.listdir(TESTS):
+        if name.endswith(".out.sorted"):
+            os.remove(os.path.join(TESTS, name))
+
+    jobs = args.jobs or TESTS_PER_CPU * len(os.sched_getaffinity(0))
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(args.tests)))) as pool:
+        futures = [pool.submit(run_test, test, TIMEOUT_VALS[test], extra_args)
+                   for test in args.tests]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            print("\n".join(results[-1]["lines"]), flush=True)
+    print(f"Stats: {sum(r['passed'] for r in results)}/{len(results)} passed "
+          f"in {time.monotonic() - start:.2f}s")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            json.dump([{k: v for k, v in r.items() if k != "lines"} for r in results],
+                      report_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
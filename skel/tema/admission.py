@@ -0,0 +1,254 @@
+"""
+This module represents the admission policies: they decide how many units a producer may
+have on sale in the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from abc import ABC, abstractmethod
+from threading import Lock
+
+
+class AdmissionPolicy(ABC):
+    """
+    Interface of the admission policies. The marketplace calls reserve() before putting
+    units on sale, release() when units leave the sale for a cart and restore() when units
+    removed from a cart are put back on sale, always while holding the lock of the
+    producer the units belong to. A policy whose state is shared between producers guards
+    it with a lock of its own, taken last and never held while calling out.
+
+    As with queue_size_per_producer, a limit too tight for a test can leave a producer
+    blocked on a product nobody buys anymore, with the products others wait for behind it.
+    """
+    # True when units of one producer leaving can make room for another producer
+    shared = False
+
+    def register(self, producer_id):
+        """
+        Called when a producer registers, before it publishes anything
+        """
+
+    @abstractmethod
+    def reserve(self, producer_id, product_id, quantity, held):
+        """
+        Reserves room for up to quantity units, atomically; every policy defines it
+
+        :type producer_id: Int
+        :param producer_id: the producer of the units
+
+        :type product_id: Int
+        :param product_id: the registry id of the product
+
+        :type quantity: Int
+        :param quantity: the number of units the producer wants to put on sale
+
+        :type held: Int
+        :param held: the number of units of the producer already on sale
+
+        :returns the number of units admitted, at most quantity; 0 or less admits none
+        """
+
+    def release(self, producer_id, product_id, quantity):
+        """
+        Gives back the room of units that left the sale
+        """
+
+    def restore(self, producer_id, product_id, quantity):
+        """
+        Takes room again for units put back on sale; they are always admitted, even if
+        the room they left was reserved by others in the meantime
+        """
+
+
+class PerProducerCap(AdmissionPolicy):
+    """
+    At most capacity units of every producer on sale: the queue_size_per_producer limit.
+    It keeps no state, the marketplace counts the units of every producer.
+    """
+
+    def __init__(self, capacity):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the maximum number of units of a producer on sale
+        """
+        self.capacity = capacity
+
+    def reserve(self, producer_id, product_id, quantity, held):
+        return min(quantity, self.capacity - held)
+
+
+class ProducerCap(AdmissionPolicy):
+    """
+    At most capacity units of every producer on sale, like PerProducerCap, but counted by
+    the policy itself, so the cap holds across all the marketplaces sharing it. Room freed
+    in one of them is room for the producer in the others, so it is shared.
+    """
+    shared = True
+
+    def __init__(self, capacity):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the maximum number of units of a producer on sale
+        """
+        [self.capacity, self.on_sale, self.lock] = [capacity, {}, Lock()]
+
+    def reserve(self, producer_id, product_id, quantity, held):
+        with self.lock:
+            on_sale = self.on_sale.get(producer_id, 0)
+            admitted = min(quantity, self.capacity - on_sale)
+            if admitted > 0:
+                self.on_sale[producer_id] = on_sale + admitted
+        return admitted
+
+    def release(self, producer_id, product_id, quantity):
+        with self.lock:
+            self.on_sale[producer_id] -= quantity
+
+    def restore(self, producer_id, product_id, quantity):
+        with self.lock:
+            self.on_sale[producer_id] = self.on_sale.get(producer_id, 0) + quantity
+
+
+class GlobalCap(AdmissionPolicy):
+    """
+    At most capacity units on sale in the whole marketplace, whoever their producers
+    """
+    shared = True
+
+    def __init__(self, capacity):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the maximum number of units on sale
+        """
+        [self.capacity, self.on_sale, self.lock] = [capacity, 0, Lock()]
+
+    def reserve(self, producer_id, product_id, quantity, held):
+        with self.lock:
+            admitted = min(quantity, self.capacity - self.on_sale)
+            if admitted > 0:
+                self.on_sale += admitted
+        return admitted
+
+    def release(self, producer_id, product_id, quantity):
+        with self.lock:
+            self.on_sale -= quantity
+
+    def restore(self, producer_id, product_id, quantity):
+        with self.lock:
+            self.on_sale += quantity
+
+
+class PerProductCap(AdmissionPolicy):
+    """
+    At most capacity units of every product on sale, whoever their producers
+    """
+    shared = True
+
+    def __init__(self, capacity):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the maximum number of units of a product on sale
+        """
+        [self.capacity, self.on_sale, self.lock] = [capacity, {}, Lock()]
+
+    def reserve(self, producer_id, product_id, quantity, held):
+        with self.lock:
+            on_sale = self.on_sale.get(product_id, 0)
+            admitted = min(quantity, self.capacity - on_sale)
+            if admitted > 0:
+                self.on_sale[product_id] = on_sale + admitted
+        return admitted
+
+    def release(self, producer_id, product_id, quantity):
+        with self.lock:
+            self.on_sale[product_id] -= quantity
+
+    def restore(self, producer_id, product_id, quantity):
+        with self.lock:
+            self.on_sale[product_id] = self.on_sale.get(product_id, 0) + quantity
+
+
+class FairShare(AdmissionPolicy):
+    """
+    Splits capacity units between the registered producers in proportion to their
+    weights, so a fast producer cannot fill the marketplace and starve the others. Every
+    producer may have at least one unit on sale; the shares shrink as producers register.
+    """
+
+    def __init__(self, capacity, weights=None):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the number of units on sale shared by the producers
+
+        :type weights: Dict
+        :param weights: producer id -> weight, 1 for the producers it leaves out
+        """
+        [self.capacity, self.weights] = [capacity, {} if weights is None else weights]
+        [self.total_weight, self.lock] = [0, Lock()]
+
+    def register(self, producer_id):
+        with self.lock:
+            self.total_weight += self.weights.get(producer_id, 1)
+
+    def share(self, producer_id):
+        """
+        Returns the number of units the producer may have on sale
+        """
+        return max(1, self.capacity * self.weights.get(producer_id, 1) // self.total_weight)
+
+    def reserve(self, producer_id, product_id, quantity, held):
+        return min(quantity, self.share(producer_id) - held)
+
+
+class AllOf(AdmissionPolicy):
+    """
+    Admits only what every one of its policies admits, e.g. a per-producer cap under a
+    global one
+    """
+
+    def __init__(self, *policies):
+        """
+        Constructor
+
+        :type policies: AdmissionPolicy
+        :param policies: the policies to combine
+        """
+        self.policies = policies
+        self.shared = any(policy.shared for policy in policies)
+
+    def register(self, producer_id):
+        for policy in self.policies:
+            policy.register(producer_id)
+
+    def reserve(self, producer_id, product_id, quantity, held):
+        [admitted, reserved] = [quantity, []]
+        for policy in self.policies:
+            granted = max(0, policy.reserve(producer_id, product_id, admitted, held))
+            # the earlier policies give back what they reserved beyond this one's grant
+            if granted < admitted:
+                for earlier in reserved:
+                    earlier.release(producer_id, product_id, admitted - granted)
+            [admitted, reserved] = [granted, reserved + [policy]]
+            if not admitted:
+                break
+        return admitted
+
+    def release(self, producer_id, product_id, quantity):
+        for policy in self.policies:
+            policy.release(producer_id, product_id, quantity)
+
+    def restore(self, producer_id, product_id, quantity):
+        for policy in self.policies:
+            policy.restore(producer_id, product_id, quantity)
@@ -0,0 +1,198 @@
+"""
+This module represents the asyncio runtime: a Marketplace, producers and consumers
+that all run as coroutines on a single event loop.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import asyncio
+
+try:
+    from tema.consumer import shop
+    from tema.marketplace import Marketplace
+    from tema.producer import units_made
+except ImportError:
+    from consumer import shop
+    from marketplace import Marketplace
+    from producer import units_made
+
+
+class AsyncMarketplace(Marketplace):
+    """
+    Marketplace shared by coroutines. The synchronous methods are inherited: on a single
+    thread their locks are never contended, so they never block the loop. The blocking
+    calls, publish_wait and add_to_cart_wait, become coroutines that await a future
+    resolved when room or stock shows up.
+    """
+
+    def __init__(self, queue_size_per_producer, **kwargs):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type kwargs:
+        :param kwargs: other arguments that are passed to the Marketplace's __init__()
+        """
+        super().__init__(queue_size_per_producer, **kwargs)
+        # producer id / product id -> futures of the coroutines waiting for room / stock
+        [self.producers_waiters, self.products_waiters] = [{}, {}]
+
+    # the waiting calls are awaited here, not called
+    # pylint: disable=invalid-overridden-method
+    async def publish_wait(self, producer_id, product, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace, awaiting until the
+        producer's queue has room for it
+
+        :returns True, or False if the timeout expired before the product could be published
+        """
+        self._log("Publishing product %s from producer %s (wait)", product, producer_id)
+
+        [product_id, deadline] = [self.registry.intern(product), None if timeout is None
+                                  else asyncio.get_running_loop().time() + timeout]
+        while not self._publish(producer_id, product_id, 1):
+            if not await self._park(self.producers_waiters, producer_id, deadline):
+                return False
+        return True
+
+    async def add_to_cart_wait(self, cart_id, product, timeout=None):
+        """
+        Adds a product to the given cart, awaiting until a unit of it is on sale
+
+        :returns True, or False if the timeout expired before the product was available
+        """
+        self._log("Adding product %s to cart %d (wait)", product, cart_id)
+
+        [product_id, deadline] = [self.registry.intern(product), None if timeout is None
+                                  else asyncio.get_running_loop().time() + timeout]
+        while not self._take(cart_id, product_id, 1):
+            if not await self._park(self.products_waiters, product_id, deadline):
+                if self.waitlist:
+                    self._cancel(cart_id, product_id)
+                return False
+        return True
+
+    @staticmethod
+    async def _park(waiters, key, deadline):
+        """
+        Awaits until key is woken up or the deadline passes
+
+        :returns False if the deadline passed
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiters.setdefault(key, []).append(future)
+        try:
+            await asyncio.wait_for(future, None if deadline is None
+                                   else max(0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    @staticmethod
+    def _wake(waiters, key):
+        """
+        Resolves the futures of every coroutine waiting on key; they retry their operation
+        """
+        for future in waiters.pop(key, ()):
+            if not future.done():
+                future.set_result(None)
+
+    def _put_on_sale(self, product_id, producer_ids):
+        handed = super()._put_on_sale(product_id, producer_ids)
+        self._wake(self.products_waiters, product_id)
+        return handed
+
+    def _free_slots(self, product_id, producer_ids):
+        super()._free_slots(product_id, producer_ids)
+        for producer_id in set(producer_ids):
+            self._wake(self.producers_waiters, producer_id)
+
+    def _wake_producers(self):
+        for producer_id in list(self.producers_waiters):
+            self._wake(self.producers_waiters, producer_id)
+
+
+class AsyncProducer:
+    """
+    Coroutine counterpart of the Producer thread.
+    """
+
+    def __init__(self, products, marketplace, republish_wait_time, blocking=False, **kwargs):
+        """
+        Constructor. Takes the same arguments as Producer; kwargs may hold the name.
+        """
+        [self.products, self.marketplace, self.republish_wait_time, self.blocking, self.name] = \
+            [products, marketplace, republish_wait_time, blocking, kwargs.get('name')]
+        self.producer_id = marketplace.register_producer()
+
+    async def publish_product(self, product, quantity, wait_time):
+        """
+        Publishes quantity units of product, making one every wait_time
+        """
+        loop = asyncio.get_running_loop()
+        [published, start] = [0, loop.time()]
+        while published < quantity:
+            made = units_made(quantity, wait_time, loop.time() - start, published)
+            attempt = self.marketplace.publish_many(self.producer_id, product, made - published)
+            if not attempt and self.blocking:
+                attempt = int(await self.marketplace.publish_wait(self.producer_id, product))
+            if attempt:
+                published += attempt
+                await asyncio.sleep(start + published * wait_time - loop.time())
+            else:
+                await asyncio.sleep(self.republish_wait_time)
+
+    async def run(self):
+        """
+        Publishes the producer's products forever
+        """
+        while True:
+            for product, quantity, wait_time in self.products:
+                await self.publish_product(product, quantity, wait_time)
+
+
+class AsyncConsumer:
+    """
+    Coroutine counterpart of the Consumer thread.
+    """
+
+    def __init__(self, carts, marketplace, retry_wait_time, blocking=False, **kwargs):
+        """
+        Constructor. Takes the same arguments as Consumer; kwargs must hold the name and
+        may hold the order_sink.
+        """
+        [self.carts, self.marketplace, self.retry_wait_time, self.blocking, self.name] = \
+            [carts, marketplace, retry_wait_time, blocking, kwargs['name']]
+        self.order_sink = kwargs.get('order_sink')
+        self.cart_index = marketplace.new_cart()
+
+    async def run(self):
+        """
+        Runs the operations of every cart, then places the order
+        """
+        [shopping, units] = [shop(self), None]
+        while True:
+            try:
+                product = shopping.send(units)
+            except StopIteration:
+                return
+            units = int(await self.marketplace.add_to_cart_wait(self.cart_index, product)) \
+                if self.blocking else 0
+            if not units:
+                await asyncio.sleep(self.retry_wait_time)
+
+
+async def run_market(producers, consumers):
+    """
+    Runs the producers in the background until every consumer has placed its order
+    """
+    producer_tasks = [asyncio.create_task(producer.run()) for producer in producers]
+    await asyncio.gather(*(consumer.run() for consumer in consumers))
+    for task in producer_tasks:
+        task.cancel()
+    await asyncio.gather(*producer_tasks, return_exceptions=True)
@@ -0,0 +1,104 @@
+"""
+This module represents the clocks the producers and consumers sleep on.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import time
+from itertools import count
+from threading import Event, Lock
+
+
+class RealClock:
+    """
+    Wall clock: sleeping really sleeps.
+    """
+
+    def register(self):
+        """
+        Announces a new actor; the wall clock does not track them
+        """
+
+    def unregister(self):
+        """
+        Announces that an actor is done; the wall clock does not track them
+        """
+
+    @staticmethod
+    def time():
+        """
+        Returns the current time, in seconds
+        """
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(seconds):
+        """
+        Sleeps for the given number of seconds
+        """
+        time.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    Simulated clock. Every actor (producer or consumer thread) registers before it starts
+    and unregisters when it is done; sleeping only queues a wake-up time. Once every
+    registered actor is asleep, the clock jumps straight to the earliest wake-up time and
+    wakes the actors due then, so a scenario takes no longer than its actual work while the
+    actors still wake up in the order they would on the wall clock.
+
+    An actor must not block on anything but the clock (e.g. Marketplace.publish_wait),
+    or the clock would never see all the actors asleep.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        [self.now, self.actors] = [0.0, 0]
+        # heap of (wake-up time, sequence number, event) entries, one per sleeping actor;
+        # each actor waits on its own event so a jump only wakes up the actors due then
+        [self.sleepers, self.sequence] = [[], count()]
+
+    def register(self):
+        """
+        Announces a new actor
+        """
+        with self.lock:
+            self.actors += 1
+
+    def unregister(self):
+        """
+        Announces that an actor is done; the others may all be asleep now
+        """
+        with self.lock:
+            self.actors -= 1
+            self._advance()
+
+    def time(self):
+        """
+        Returns the current simulated time, in seconds
+        """
+        return self.now
+
+    def sleep(self, seconds):
+        """
+        Blocks the calling actor until the simulated time has advanced by seconds
+        """
+        woken = Event()
+        with self.lock:
+            heapq.heappush(self.sleepers, (self.now + max(0, seconds), next(self.sequence), woken))
+            self._advance()
+        woken.wait()
+
+    def _advance(self):
+        """
+        If every actor is asleep, moves the time to the earliest wake-up and wakes up
+        every actor due then. The caller must hold the lock.
+        """
+        if not self.sleepers or len(self.sleepers) < self.actors:
+            return
+        self.now = max(self.now, self.sleepers[0][0])
+        while self.sleepers and self.sleepers[0][0] <= self.now:
+            heapq.heappop(self.sleepers)[2].set()
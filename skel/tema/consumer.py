@@ -7,7 +7,11 @@ March 2021
 """
 
 from threading import Thread
-from time import sleep
+
+try:
+    from tema.clock import RealClock
+except ImportError:
+    from clock import RealClock
 
 
 class Consumer(Thread):
@@ -15,7 +19,8 @@ class Consumer(Thread):
     Class that represents a consumer.
     """
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, *, blocking=False, clock=None,
+                 order_sink=None, **kwargs):
         """
         Constructor.
 
@@ -29,30 +34,82 @@ class Consumer(Thread):
         :param retry_wait_time: the number of seconds that a producer must wait
         until the Marketplace becomes available
 
+        :type blocking: Boolean
+        :param blocking: if True, block in Marketplace.add_to_cart_wait until the product
+        is on sale instead of sleeping retry_wait_time between attempts
+
+        :type clock: RealClock or VirtualClock
+        :param clock: the clock the consumer sleeps on, the wall clock by default
+
+        :type order_sink: OrderSink
+        :param order_sink: where the placed order goes, printed right away by default
+
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
         """
         Thread.__init__(self)
         [self.carts, self.marketplace, self.retry_wait_time, self.name, self.cart_index] = \
             [carts, marketplace, retry_wait_time, kwargs['name'], marketplace.new_cart()]
+        self.blocking = blocking
+        self.clock = clock or RealClock()
+        self.clock.register()
+        self.order_sink = order_sink
 
     def run(self):
-        for cart in self.carts:
-            for operation in cart:
-                if operation['type'].__eq__('add'):
-                    count = 0
-                    while count < operation['quantity']:
-                        attempt = self.marketplace.add_to_cart(self.cart_index,
-                                                               operation['product'])
-                        if attempt:
-                            count += 1
-                        else:
-                            sleep(self.retry_wait_time)
-                elif operation['type'].__eq__('remove'):
-                    count = 0
-                    while count < operation['quantity']:
-                        self.marketplace.remove_from_cart(self.cart_index, operation['product'])
-                        count += 1
-
-        for product in self.marketplace.place_order(self.cart_index):
-            print(f"{self.name} bought {product}")
+        try:
+            self.buy()
+        finally:
+            self.clock.unregister()
+
+    def buy(self):
+        """
+        Runs the operations of every cart, then places the order
+        """
+        [shopping, units] = [shop(self), None]
+        try:
+            while True:
+                product = shopping.send(units)
+                units = int(self.marketplace.add_to_cart_wait(self.cart_index, product)) \
+                    if self.blocking else 0
+                if not units:
+                    self.clock.sleep(self.retry_wait_time)
+        except StopIteration:
+            pass
+
+
+def shop(consumer):
+    """
+    Runs the operations of every cart of a consumer, then places its order and prints it
+    or hands it to its order sink. Every way of running consumers drives this generator:
+    whenever an add finds no unit of its product on sale, it yields the product; the
+    runner waits for it as it can and sends back the number of units it added to the cart
+    meanwhile, none if it only slept, and the add is retried.
+
+    :param consumer: has the carts, marketplace, cart_index, name and order_sink of a
+    Consumer
+    """
+    [marketplace, cart_id] = [consumer.marketplace, consumer.cart_index]
+    for cart in consumer.carts:
+        for operation in cart:
+            if operation['type'] == 'add':
+                count = 0
+                while count < operation['quantity']:
+                    # take every unit on sale in one call, wait only when none is left
+                    attempt = marketplace.add_to_cart_many(cart_id, operation['product'],
+                                                           operation['quantity'] - count)
+                    if not attempt:
+                        attempt = yield operation['product']
+                    count += attempt or 0
+            elif operation['type'] == 'remove':
+                marketplace.remove_from_cart_many(cart_id, operation['product'],
+                                                  operation['quantity'])
+
+    order = marketplace.place_order(cart_id, summary=True)
+    if consumer.order_sink is not None:
+        consumer.order_sink.submit(consumer.name, order)
+        return
+    # every line of the order is formatted once, whatever its quantity
+    for product, quantity in order:
+        line = f"{consumer.name} bought {product}"
+        for _ in range(quantity):
+            print(line)
@@ -0,0 +1,144 @@
+"""
+This module represents the ConsumerPool: consumers run as tasks on a fixed number of
+worker threads instead of a thread each.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Condition, Lock, Thread
+
+try:
+    from tema.consumer import shop
+except ImportError:
+    from consumer import shop
+
+
+class PooledConsumer:
+    """
+    Counterpart of the Consumer thread run by a ConsumerPool: its run() is a generator
+    that yields the seconds it would sleep before retrying an add.
+    """
+
+    def __init__(self, carts, marketplace, retry_wait_time, order_sink=None, **kwargs):
+        """
+        Constructor. Takes the same arguments as Consumer, but blocking and clock; kwargs
+        must hold the name.
+        """
+        [self.carts, self.marketplace, self.retry_wait_time, self.name, self.cart_index] = \
+            [carts, marketplace, retry_wait_time, kwargs['name'], marketplace.new_cart()]
+        self.order_sink = order_sink
+
+    def run(self):
+        """
+        Runs the operations of every cart, yielding every retry sleep, then places the order
+        """
+        for _ in shop(self):
+            yield self.retry_wait_time
+
+
+class ConsumerPool:
+    """
+    Runs consumers on a bounded ThreadPoolExecutor. A task advances a consumer's run()
+    until it yields the seconds it would sleep; the consumer is then parked on a heap,
+    holding no worker, and a scheduler thread submits it again once they have passed.
+    Thousands of consumers cost a heap entry each while they wait, not a thread.
+    """
+
+    def __init__(self, workers=None):
+        """
+        Constructor
+
+        :type workers: Int
+        :param workers: the number of worker threads, the ThreadPoolExecutor default if None
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="consumer-pool")
+        # (due time, sequence number, consumer generator), the earliest due first
+        [self.parked, self.sequence] = [[], count()]
+        [self.lock, self.active, self.errors, self.closed] = [Lock(), 0, [], False]
+        # the scheduler sleeps on wakeup, join() on finished; both share the lock
+        [self.wakeup, self.finished] = [Condition(self.lock), Condition(self.lock)]
+        self.scheduler = Thread(target=self._schedule, daemon=True)
+        self.scheduler.start()
+
+    def submit(self, consumer):
+        """
+        Starts running a consumer
+
+        :type consumer: PooledConsumer
+        :param consumer: the consumer, whose run() yields its sleeps
+        """
+        with self.lock:
+            self.active += 1
+        self.executor.submit(self._step, consumer.run())
+
+    def join(self):
+        """
+        Waits until every consumer submitted so far has placed its order
+
+        :raises the first exception raised by a consumer
+        """
+        with self.lock:
+            self.finished.wait_for(lambda: not self.active)
+            if self.errors:
+                raise self.errors[0]
+
+    def shutdown(self):
+        """
+        Stops the scheduler and the workers; the consumers still parked are dropped
+        """
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.scheduler.join()
+        self.executor.shutdown()
+
+    def _step(self, actor):
+        """
+        Runs a consumer until its next sleep, then parks it; a worker's task
+        """
+        try:
+            delay = next(actor)
+        except StopIteration:
+            self._finish(None)
+        except Exception as error:  # pylint: disable=broad-except
+            self._finish(error)
+        else:
+            with self.lock:
+                entry = (time.monotonic() + delay, next(self.sequence), actor)
+                heapq.heappush(self.parked, entry)
+                # the scheduler only needs to wake up early for a new earliest entry
+                if self.parked[0] is entry:
+                    self.wakeup.notify()
+
+    def _finish(self, error):
+        """
+        Accounts for a consumer that is done, with the exception it raised if any
+        """
+        with self.lock:
+            if error is not None:
+                self.errors.append(error)
+            self.active -= 1
+            if not self.active:
+                self.finished.notify_all()
+
+    def _schedule(self):
+        """
+        Submits the parked consumers as they become due; the scheduler thread
+        """
+        with self.lock:
+            while not self.closed:
+                if not self.parked:
+                    self.wakeup.wait()
+                    continue
+                delay = self.parked[0][0] - time.monotonic()
+                if delay > 0:
+                    self.wakeup.wait(delay)
+                    continue
+                self.executor.submit(self._step, heapq.heappop(self.parked)[2])
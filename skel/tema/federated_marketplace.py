@@ -0,0 +1,374 @@
+"""
+This module represents the FederatedMarketplace: products spread by consistent hashing
+over several Marketplace shards behind the Marketplace API.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import hashlib
+import time
+from bisect import bisect
+from collections import Counter
+from threading import Lock
+
+try:
+    from tema.admission import ProducerCap
+    from tema.marketplace import Marketplace
+    from tema.product import ProductRegistry
+except ImportError:
+    from admission import ProducerCap
+    from marketplace import Marketplace
+    from product import ProductRegistry
+
+# the longest an add_to_cart_wait sleeps on one shard before checking that its product
+# has not moved to another
+REROUTE_INTERVAL = 0.1
+
+
+def ring_hash(key):
+    """
+    Returns the position of a key on the ring: the first 8 bytes of its md5, which,
+    unlike hash(), is the same in every process
+    """
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring: every shard owns replicas points on it and a key goes to the
+    shard of the first point at or after its own position. A new shard takes over only
+    the keys that fall just before its points, about 1/N of them. A ring is not changed
+    once built, so it can be read without a lock.
+    """
+
+    def __init__(self, replicas=64, points=()):
+        """
+        Constructor
+
+        :type replicas: Int
+        :param replicas: the number of points of every shard
+
+        :type points: Iterable
+        :param points: the (position, shard index) points on the ring
+        """
+        [self.replicas, self.points] = [replicas, sorted(points)]
+        self.positions = [position for position, _ in self.points]
+
+    def with_shard(self, shard):
+        """
+        Returns a new ring with the points of the shard with the given index added
+        """
+        return HashRing(self.replicas, self.points + [(ring_hash(f"shard {shard} {replica}"),
+                                                       shard)
+                                                      for replica in range(self.replicas)])
+
+    def owner(self, key):
+        """
+        Returns the index of the shard that owns the key, a string
+        """
+        return self.points[bisect(self.positions, ring_hash(key)) % len(self.points)][1]
+
+
+class Shard(Marketplace):
+    """
+    One of the marketplaces of a FederatedMarketplace. The admission policy counts the
+    units of a producer over every shard, so room freed in one wakes up the producers
+    waiting in all of them.
+    """
+
+    def __init__(self, federation, queue_size_per_producer, **options):
+        """
+        Constructor
+
+        :type federation: FederatedMarketplace
+        :param federation: the federated marketplace the shard belongs to
+        """
+        super().__init__(queue_size_per_producer, **options)
+        self.federation = federation
+
+    def _wake_producers(self):
+        for shard in self.federation.shards:
+            Marketplace._wake_producers(shard)
+
+
+class FederatedMarketplace:
+    """
+    Marketplace API over several Marketplace shards, each with its own locks. Every
+    product is routed to one shard by a consistent-hash ring over its repr, so the calls
+    for different products mostly contend on different shards. The producers and the
+    carts are registered in every shard, with the same ids, and the shards share the
+    product registry and the admission policy; a cart holds its units of every product
+    in the product's shard and place_order gathers them.
+
+    add_shard() moves the units on sale of the products the new shard takes over while
+    the others keep trading. An add of a moved product may fail while its units are in
+    flight, as when it is out of stock; a call that put units on sale in a shard the
+    product has just left moves them on itself, and units already in a cart stay in the
+    old shard's cart until they are ordered or removed.
+    """
+
+    def __init__(self, queue_size_per_producer, shards=2, replicas=64, admission=None,
+                 **options):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum number of units of a producer on sale,
+        over all the shards
+
+        :type shards: Int
+        :param shards: the number of shards to start with
+
+        :type replicas: Int
+        :param replicas: the number of points of every shard on the hash ring
+
+        :type admission: AdmissionPolicy
+        :param admission: the policy shared by the shards, by default
+        ProducerCap(queue_size_per_producer). It must count the units on sale itself, as
+        the shards only count their own: ProducerCap, GlobalCap, PerProductCap or AllOf
+        of them.
+
+        :param options: the other arguments of every shard's Marketplace; waitlist is not
+        supported, as a waiting cart's ticket would not follow its product to a new shard
+        """
+        if options.get("waitlist"):
+            raise ValueError("a FederatedMarketplace does not support waitlist")
+        self.queue_size_per_producer = queue_size_per_producer
+        self.admission = ProducerCap(queue_size_per_producer) if admission is None \
+            else admission
+        self.registry = options.pop("registry", None) or ProductRegistry()
+        self.options = options
+        # guards the shard list and the producer and cart counts, so every shard gives
+        # the same ids
+        [self.lock, self.shards, self.producers, self.carts] = [Lock(), [], 0, 0]
+        # the ring and the shard index of every product routed with it, replaced together
+        self.routing = (HashRing(replicas), {})
+        for _ in range(shards):
+            self.add_shard()
+
+    @property
+    def products_list(self):
+        """
+        Snapshot of the products on sale in every shard, as {"id": producer_id,
+        "product": product} entries
+        """
+        return [entry for shard in self.shards for entry in shard.products_list]
+
+    @property
+    def carts_list(self):
+        """
+        Snapshot of the carts, gathered from every shard
+        """
+        carts = [shard.carts_list for shard in self.shards]
+        return [[entry for shard_cart in cart for entry in shard_cart] for cart in zip(*carts)]
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this, registered in every shard
+        """
+        with self.lock:
+            producer_id = [shard.register_producer() for shard in self.shards][0]
+            self.producers += 1
+        return producer_id
+
+    def publish(self, producer_id, product):
+        """
+        Adds the product to its shard
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        shard = self.shard_of(product)
+        published = shard.publish(producer_id, product)
+        if published:
+            self._settle(product, shard)
+        return published
+
+    def publish_many(self, producer_id, product, quantity):
+        """
+        Adds up to quantity units of the product to its shard
+
+        :returns the number of units published
+        """
+        shard = self.shard_of(product)
+        published = shard.publish_many(producer_id, product, quantity)
+        if published:
+            self._settle(product, shard)
+        return published
+
+    def publish_wait(self, producer_id, product, timeout=None):
+        """
+        Adds the product to its shard, blocking until the producer has room for it
+
+        :returns True, or False if the timeout expired before the product could be published
+        """
+        shard = self.shard_of(product)
+        published = shard.publish_wait(producer_id, product, timeout)
+        if published:
+            self._settle(product, shard)
+        return published
+
+    def new_cart(self):
+        """
+        Creates a new cart, in every shard
+
+        :returns an int representing the cart_id
+        """
+        with self.lock:
+            cart_id = [shard.new_cart() for shard in self.shards][0]
+            self.carts += 1
+        return cart_id
+
+    def add_to_cart(self, cart_id, product):
+        """
+        Adds a unit of the product from its shard to the cart
+
+        :returns True or False. If the caller receives False, it should wait and then try again
+        """
+        return self.shard_of(product).add_to_cart(cart_id, product)
+
+    def add_to_cart_many(self, cart_id, product, quantity):
+        """
+        Adds up to quantity units of the product from its shard to the cart
+
+        :returns the number of units added
+        """
+        return self.shard_of(product).add_to_cart_many(cart_id, product, quantity)
+
+    def add_to_cart_wait(self, cart_id, product, timeout=None):
+        """
+        Adds a unit of the product to the cart, blocking until one is on sale in its shard
+
+        :returns True, or False if the timeout expired before the product was available
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = REROUTE_INTERVAL if deadline is None \
+                else min(REROUTE_INTERVAL, deadline - time.monotonic())
+            if self.shard_of(product).add_to_cart_wait(cart_id, product, max(remaining, 0)):
+                return True
+            if remaining < REROUTE_INTERVAL:
+                return False
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes a unit of the product from the cart
+        """
+        self.remove_from_cart_many(cart_id, product, 1)
+
+    def remove_from_cart_many(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of the product from the cart and puts them back on
+        sale in the product's shard, taking them from the carts of its old shards too
+
+        :returns the number of units removed
+        """
+        owner = self.shard_of(product)
+        removed = owner.remove_from_cart_many(cart_id, product, quantity)
+        if removed < quantity:
+            product_id = self.registry.intern(product)
+            for shard in self.shards:
+                if shard is not owner and removed < quantity:
+                    # pylint: disable=protected-access
+                    producer_ids = shard._unload(cart_id, product_id, quantity - removed)
+                    if producer_ids:
+                        owner._restock(product_id, producer_ids)
+                        removed += len(producer_ids)
+        if removed:
+            self._settle(product, owner)
+        return removed
+
+    def place_order(self, cart_id, summary=False):
+        """
+        Return a list with all the products in the cart, gathered from every shard
+
+        :type summary: Boolean
+        :param summary: if True, return one (product, quantity) pair per product instead
+        """
+        lines = Counter()
+        for shard in self.shards:
+            for product, quantity in shard.place_order(cart_id, summary=True):
+                lines[product] += quantity
+        if summary:
+            return list(lines.items())
+        return [product for product, quantity in lines.items() for _ in range(quantity)]
+
+    def stats(self):
+        """
+        Returns the units on sale per producer over every shard under "inventory" and the
+        stats of every shard under "shards"
+        """
+        shards = [shard.stats() for shard in self.shards]
+        inventory = Counter()
+        for stats in shards:
+            inventory.update(stats["inventory"])
+        return {"inventory": dict(inventory), "shards": shards}
+
+    def add_shard(self):
+        """
+        Adds a shard, with every producer and cart, and moves to it the units on sale of
+        the products it takes over
+
+        :returns the number of units moved
+        """
+        with self.lock:
+            shard = Shard(self, self.queue_size_per_producer, registry=self.registry,
+                          admission=self.admission, **self.options)
+            for _ in range(self.producers):
+                shard.register_producer()
+            for _ in range(self.carts):
+                shard.new_cart()
+            index = len(self.shards)
+            self.shards.append(shard)
+            ring = self.routing[0].with_shard(index)
+            self.routing = (ring, {})
+        # every product indexed by an older shard is checked, as the routes only know the
+        # products called since the last resize; those put on sale with the old ring from
+        # now on are settled by the calls that put them
+        products = {product_id: self.registry.product(product_id)
+                    for source in self.shards[:index] for stripe in source.products_index
+                    for product_id in list(stripe)}
+        owned = {product_id for product_id, product in products.items()
+                 if ring.owner(repr(product)) == index}
+        return sum(self._migrate(products[product_id], source, shard)
+                   for source in self.shards[:index] for product_id in owned)
+
+    def shard_of(self, product):
+        """
+        Returns the shard that owns the product
+        """
+        [ring, routes] = self.routing
+        index = routes.get(product)
+        if index is None:
+            index = routes[product] = ring.owner(repr(product))
+        return self.shards[index]
+
+    def _settle(self, product, shard):
+        """
+        Moves on the units a call has just put on sale in shard, if the product has
+        moved to another shard in the meantime
+        """
+        owner = self.shard_of(product)
+        if owner is not shard:
+            self._migrate(product, shard, owner)
+
+    def _migrate(self, product, source, target):
+        """
+        Moves the units of the product on sale from the source shard to the target one
+
+        :returns the number of units moved
+        """
+        # pylint: disable=protected-access
+        product_id = self.registry.intern(product)
+        producer_ids = source._drain(product_id)
+        # the units stay admitted while they move: only the shards' counts of them change,
+        # so the room they take in the producers' queues is never freed for another unit
+        for producer_id, units in Counter(producer_ids).items():
+            with source.producers_locks[producer_id]:
+                source.producers_list[producer_id] -= units
+            with target.producers_locks[producer_id]:
+                target.producers_list[producer_id] += units
+        if producer_ids:
+            target._put_on_sale(product_id, producer_ids)
+        return len(producer_ids)
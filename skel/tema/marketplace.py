@@ -5,20 +5,54 @@ Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-from threading import Lock
+from collections import Counter, deque
+from itertools import count
+from threading import Condition, Lock
 import logging
-import logging.handlers
-import time
 
+try:
+    from tema.admission import PerProducerCap
+    from tema.array_queue import ArrayQueue, popleft_many
+    from tema.marketplace_logging import setup_logging
+    from tema.marketplace_stats import MarketplaceStats
+    from tema.product import ProductRegistry
+except ImportError:
+    from admission import PerProducerCap
+    from array_queue import ArrayQueue, popleft_many
+    from marketplace_logging import setup_logging
+    from marketplace_stats import MarketplaceStats
+    from product import ProductRegistry
+
+# the public calls counted and timed when the marketplace is instrumented, and traced
+INSTRUMENTED_METHODS = ["register_producer", "publish", "publish_many", "publish_wait",
+                        "new_cart", "add_to_cart", "add_to_cart_many", "add_to_cart_wait",
+                        "remove_from_cart", "remove_from_cart_many", "place_order"]
+
+
+class Ticket:  # pylint: disable=too-few-public-methods
+    """
+    A cart's claim on the next units of a product put on sale, in waitlist mode
+    """
+    __slots__ = ("cart_id", "wanted", "units", "queued", "condition")
+
+    def __init__(self, cart_id):
+        # wanted: the units still to hand to the cart; units: the ids of the producers of
+        # the units handed to it and not yet claimed; queued: whether it is in the waitlist
+        [self.cart_id, self.wanted, self.units, self.queued] = [cart_id, 0, deque(), False]
+        # the condition add_to_cart_wait sleeps on, sharing the lock of the product's stripe
+        self.condition = None
 
 
-class Marketplace:
+class Marketplace:  # pylint: disable=too-many-instance-attributes
     """
     Class that represents the Marketplace. It's the central part of the implementation.
     The producers and consumers use its methods concurrently.
     """
 
-    def __init__(self, queue_size_per_producer):
+    # pylint: disable=too-many-arguments
+    def __init__(self, queue_size_per_producer, *, sharded=False, stripes=16,
+                 log_level=logging.INFO, log_every=1, instrument=False, registry=None,
+                 admission=None, waitlist=False, compact=False, trace=None):
         """
         Constructor
 
@@ -26,31 +60,134 @@ class Marketplace:
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type sharded: Boolean
+        :param sharded: if True, stripe the inventory locks by product hash and give every
+        producer and every cart its own lock, instead of one lock per structure;
+        register_producer and new_cart still take the global producer and cart locks, and
+        the products whose ids are equal modulo stripes share a stripe, so they contend
+
+        :type stripes: Int
+        :param stripes: the number of inventory stripes used when sharded
+
+        :type log_level: Int
+        :param log_level: the level of the marketplace logger
+
+        :type log_every: Int
+        :param log_every: log only one in every log_every operations, 0 to log none
+
+        :type instrument: Boolean
+        :param instrument: if True, count and time the public calls and the lock waits,
+        see stats(); when False the marketplace uses plain locks and unwrapped methods
+
+        :type registry: ProductRegistry
+        :param registry: the registry that interns the products, a new one by default
+
+        :type admission: AdmissionPolicy
+        :param admission: decides how many units the producers may have on sale, by
+        default PerProducerCap(queue_size_per_producer)
+
+        :type waitlist: Boolean
+        :param waitlist: if True, an add that finds too few units on sale queues the cart
+        for the missing ones, and the units put on sale later are handed straight to the
+        carts waiting for them, oldest first; the cart claims them with its next add
+
+        :type compact: Boolean
+        :param compact: if True, keep the producer ids of the units on sale and in the carts
+        in ArrayQueues, 4 bytes per unit, instead of deques
+
+        :type trace: TraceRecorder
+        :param trace: if given, every public call is recorded in it, see tema/marketplace_trace.py
         """
 
-        [self.producer_lock, self.cart_lock, self.products_lock] = [Lock(), Lock(), Lock()]
+        self.stats_collector = MarketplaceStats() if instrument else None
+        [self.producer_lock, self.cart_lock] = [self._new_lock("producer"), self._new_lock("cart")]
         self.queue_size_per_producer = queue_size_per_producer
-        [self.producer_index, self.cart_index, self.products_list, self.producers_list, self.carts_list] = \
-            [-1, -1, [], [], []]
-
-        self.logger = logging.getLogger()
-        self.logger.setLevel(logging.INFO)
-        file_handler = logging.handlers.RotatingFileHandler("marketplace.log", backupCount=10)
-        file_handler.setLevel(logging.INFO)
-        formatter = logging.Formatter("%(asctime)s - %(message)s")
-        formatter.converter = time.gmtime
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        self.admission = PerProducerCap(queue_size_per_producer) if admission is None \
+            else admission
+        [self.producer_index, self.cart_index, self.producers_list] = [-1, -1, []]
+        # the index and the carts hold the ids the registry gives to the products
+        self.registry = ProductRegistry() if registry is None else registry
+        # per cart: product id -> ids of the producers of the units of it in the cart
+        self.carts = []
+        # the FIFO type of the producer ids in the index and in the carts
+        self.queue_type = ArrayQueue if compact else deque
+        # without sharding a single stripe guarded by products_lock holds the whole inventory;
+        # when sharded there is no such global lock
+        self.sharded = sharded
+        self.products_locks = [self._new_lock("products", stripe if sharded else None)
+                               for stripe in range(stripes if sharded else 1)]
+        self.products_lock = None if sharded else self.products_locks[0]
+        # per stripe: product id -> FIFO of the ids of the producers that have a unit of it on sale
+        self.products_index = [{} for _ in self.products_locks]
+        # the locks guarding each producer's counter and each cart (shared when not sharded)
+        [self.producers_locks, self.carts_locks] = [[], []]
+        # threads blocked in publish_wait / add_to_cart_wait sleep on these; each
+        # condition shares the lock of the structure its predicate reads
+        self.producers_conditions = []
+        # the producers blocked in publish_wait, woken by any unit leaving the sale when
+        # the admission policy is shared between producers
+        self.waiting_producers = set()
+        self.products_conditions = [{} for _ in self.products_locks]
+        # per stripe: product id -> FIFO of the tickets of the carts waiting for it, and
+        # (cart id, product id) -> the ticket of the cart for the product
+        self.waitlist = waitlist
+        [self.waitlists, self.tickets] = [[{} for _ in self.products_locks] for _ in range(2)]
+
+        # the records are written to marketplace.log by a background thread
+        [self.logger, self.log_every, self.log_counter] = \
+            [setup_logging(level=log_level), log_every, count()]
+
+        if instrument:
+            for name in INSTRUMENTED_METHODS:
+                setattr(self, name, self.stats_collector.timed(name, getattr(self, name)))
+        if trace is not None:
+            trace.bind(self.registry)
+            for name in INSTRUMENTED_METHODS:
+                setattr(self, name, trace.traced(name, getattr(self, name)))
+
+    @property
+    def products_list(self):
+        """
+        Snapshot of the products on sale, as {"id": producer_id, "product": product} entries
+        """
+        products = []
+        for lock, index in zip(self.products_locks, self.products_index):
+            with lock:
+                products.extend({"id": producer_id, "product": self.registry.product(product_id)}
+                                for product_id, producers in index.items()
+                                for producer_id in producers)
+        return products
+
+    @property
+    def carts_list(self):
+        """
+        Snapshot of the carts, as lists of {"id": producer_id, "product": product} entries
+        """
+        carts = []
+        for lock, cart in zip(self.carts_locks, self.carts):
+            with lock:
+                carts.append([{"id": producer_id, "product": self.registry.product(product_id)}
+                              for product_id, producer_ids in cart.items()
+                              for producer_id in producer_ids])
+        return carts
 
     def register_producer(self):
         """
-        Returns an id for the producer that calls this.
+        Returns an id for the producer that calls this. The ids are handed out under the
+        global producer lock, in sharded mode too.
         """
-        self.logger.info("New producer: %s", self.producer_index)
         with self.producer_lock:
             self.producer_index += 1
+            producer_id = self.producer_index
+            # logged under the lock, so that concurrent producers log their own ids
+            self._log("New producer: %s", producer_id)
+            lock = self._new_lock("producer", producer_id) if self.sharded else self.producer_lock
+            self.producers_locks.append(lock)
+            self.producers_conditions.append(Condition(lock))
             self.producers_list.append(0)
-        return self.producer_index
+            self.admission.register(producer_id)
+        return producer_id
 
     def publish(self, producer_id, product):
         """
@@ -65,31 +202,75 @@ class Marketplace:
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
 
-        self.logger.info("Publishing product %s from producer %s", str(product), producer_id)
+        self._log("Publishing product %s from producer %s", product, producer_id)
 
-        producer_number_of_products = self.producers_list[producer_id]
+        return self._publish(producer_id, self.registry.intern(product), 1) == 1
 
-        if producer_number_of_products < self.queue_size_per_producer:
-            with self.products_lock:
-                self.products_list.append({"id": producer_id, "product": product})
-            with self.producer_lock:
-                self.producers_list[producer_id] += 1
-            return True
-        else:
-            return False
+    def publish_many(self, producer_id, product, quantity):
+        """
+        Adds as many units of the product as the producer's queue has room for, up to quantity
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :returns the number of units published. If it is 0, the caller should wait and
+        then try again.
+        """
+        self._log("Publishing %d x product %s from producer %s", quantity, product, producer_id)
+
+        return self._publish(producer_id, self.registry.intern(product), quantity)
+
+    def publish_wait(self, producer_id, product, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace, blocking until the
+        producer's queue has room for it
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait, None to wait forever
+
+        :returns True, or False if the timeout expired before the product could be published
+        """
+        self._log("Publishing product %s from producer %s (wait)", product, producer_id)
+
+        product_id = self.registry.intern(product)
+        with self.producers_locks[producer_id]:
+            self.waiting_producers.add(producer_id)
+            try:
+                if not self.producers_conditions[producer_id].wait_for(
+                        lambda: self._admit(producer_id, product_id, 1), timeout):
+                    return False
+            finally:
+                self.waiting_producers.discard(producer_id)
+        self._put_on_sale(product_id, [producer_id])
+        return True
 
     def new_cart(self):
         """
-        Creates a new cart for the consumer
+        Creates a new cart for the consumer. The ids are handed out under the global cart
+        lock, in sharded mode too.
 
         :returns an int representing the cart_id
         """
-        self.logger.info("Registering new cart")
-
         with self.cart_lock:
             self.cart_index += 1
-            self.carts_list.append([])
-        return self.cart_index
+            cart_id = self.cart_index
+            self._log("Registering new cart %d", cart_id)
+            self.carts_locks.append(self._new_lock("cart", cart_id) if self.sharded
+                                    else self.cart_lock)
+            self.carts.append({})
+        return cart_id
 
     def add_to_cart(self, cart_id, product):
         """
@@ -103,19 +284,59 @@ class Marketplace:
 
         :returns True or False. If the caller receives False, it should wait and then try again
         """
-        self.logger.info("Adding product %s to cart %d", product, cart_id)
-
-        my_list = list(filter(lambda products_element: products_element['product'] is product, self.products_list))
-        if my_list:
-            with self.cart_lock:
-                self.carts_list[cart_id].append(my_list[0])
-            with self.producer_lock:
-                self.producers_list[my_list[0]["id"]] -= 1
-            with self.products_lock:
-                self.products_list.remove(my_list[0])
-            return True
-        else:
-            return False
+        self._log("Adding product %s to cart %d", product, cart_id)
+
+        return self._take(cart_id, self.registry.intern(product), 1) == 1
+
+    def add_to_cart_many(self, cart_id, product, quantity):
+        """
+        Adds as many units of the product as are on sale, up to quantity, to the given cart
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :returns the number of units added. If it is 0, the caller should wait and then
+        try again.
+        """
+        self._log("Adding %d x product %s to cart %d", quantity, product, cart_id)
+
+        return self._take(cart_id, self.registry.intern(product), quantity)
+
+    def add_to_cart_wait(self, cart_id, product, timeout=None):
+        """
+        Adds a product to the given cart, blocking until a unit of it is on sale
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait, None to wait forever
+
+        :returns True, or False if the timeout expired before the product was available
+        """
+        self._log("Adding product %s to cart %d (wait)", product, cart_id)
+
+        product_id = self.registry.intern(product)
+        if self.waitlist:
+            return self._wait_for_ticket(cart_id, product_id, timeout)
+        stripe = self._stripe(product_id)
+        index = self.products_index[stripe]
+        with self.products_locks[stripe]:
+            if not self._product_condition(stripe, product_id).wait_for(
+                    lambda: index.get(product_id), timeout):
+                return False
+            producer_id = index[product_id].popleft()
+        self._move_to_cart(cart_id, product_id, [producer_id])
+        return True
 
     def remove_from_cart(self, cart_id, product):
         """
@@ -127,31 +348,339 @@ class Marketplace:
         :type product: Product
         :param product: the product to remove from cart
         """
-        self.logger.info("Remove product %s from cart %d", product, cart_id)
+        self._log("Remove product %s from cart %d", product, cart_id)
 
-        my_product = [element for element in self.carts_list[cart_id] if element["product"] is product][0]
-        if my_product is not None:
-            with self.producer_lock:
-                self.producers_list[my_product["id"]] += 1
-            with self.products_lock:
-                self.products_list.append(my_product)
-            with self.cart_lock:
-                self.carts_list[cart_id].remove(my_product)
-            return
+        self._return(cart_id, self.registry.intern(product), 1)
 
-    def place_order(self, cart_id):
+    def remove_from_cart_many(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of a product from cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove
+
+        :returns the number of units removed
+        """
+        self._log("Remove %d x product %s from cart %d", quantity, product, cart_id)
+
+        return self._return(cart_id, self.registry.intern(product), quantity)
+
+    def place_order(self, cart_id, summary=False):
         """
         Return a list with all the products in the cart.
 
         :type cart_id: Int
         :param cart_id: id cart
+
+        :type summary: Boolean
+        :param summary: if True, return one (product, quantity) pair per product instead
         """
-        self.logger.info("Place order from cart %d", cart_id)
+        self._log("Place order from cart %d", cart_id)
+
+        with self.carts_locks[cart_id]:
+            lines = [(self.registry.product(product_id), len(producer_ids))
+                     for product_id, producer_ids in self.carts[cart_id].items()]
+        if summary:
+            return lines
 
         my_list = []
-        for elem in self.carts_list[cart_id]:
-            my_list.append(elem["product"])
+        for product, quantity in lines:
+            my_list.extend([product] * quantity)
 
         return my_list
 
+    def stats(self):
+        """
+        Returns the current counters: the units on sale per producer under "inventory" and,
+        when the marketplace is instrumented, the call counts and latency histograms under
+        "calls", the success/failure counts under "results" and the lock acquisitions and
+        wait/hold times per lock role under "locks", and per stripe, producer or cart lock
+        under each role's "indexed" when sharded
+        """
+        stats = {} if self.stats_collector is None else self.stats_collector.snapshot()
+        stats["inventory"] = dict(enumerate(list(self.producers_list)))
+        return stats
+
+    def _new_lock(self, role, index=None):
+        """
+        Returns a new lock, accounted under role and index when the marketplace is instrumented
+        """
+        return Lock() if self.stats_collector is None \
+            else self.stats_collector.new_lock(role, index)
+
+    def _log(self, msg, *args):
+        """
+        Logs an operation, sampling one in every log_every calls
+        """
+        if self.log_every and next(self.log_counter) % self.log_every == 0:
+            self.logger.info(msg, *args)
+
+    def _stripe(self, product_id):
+        """
+        Returns the inventory stripe that holds the product with the given id
+        """
+        return product_id % len(self.products_locks)
+
+    def _queue(self, queues, product_id):
+        """
+        Returns the queue of producer ids of the product in queues, a product id -> queue
+        dict, adding an empty one if there is none
+        """
+        queue = queues.get(product_id)
+        if queue is None:
+            queue = queues[product_id] = self.queue_type()
+        return queue
+
+    def _product_condition(self, stripe, product_id):
+        """
+        Returns the condition consumers waiting for the product sleep on.
+        The caller must hold the stripe's lock.
+        """
+        condition = self.products_conditions[stripe].get(product_id)
+        if condition is None:
+            condition = Condition(self.products_locks[stripe])
+            self.products_conditions[stripe][product_id] = condition
+        return condition
+
+    def _admit(self, producer_id, product_id, quantity):
+        """
+        Reserves room for up to quantity units of the producer with the admission policy
+        and counts them in the producer's queue. The caller must hold the producer's lock.
+
+        :returns the number of units admitted
+        """
+        admitted = self.admission.reserve(producer_id, product_id, quantity,
+                                          self.producers_list[producer_id])
+        if admitted <= 0:
+            return 0
+        self.producers_list[producer_id] += admitted
+        return admitted
+
+    def _publish(self, producer_id, product_id, quantity):
+        """
+        Reserves up to quantity slots in the producer's queue and puts that many units on sale
+
+        :returns the number of units published
+        """
+        with self.producers_locks[producer_id]:
+            published = self._admit(producer_id, product_id, quantity)
+        if published:
+            self._put_on_sale(product_id, [producer_id] * published)
+        return published
+
+    def _take(self, cart_id, product_id, quantity):
+        """
+        Takes up to quantity units of the product, those handed to the cart first, then
+        those on the index, and moves them to the cart
+
+        :returns the number of units moved
+        """
+        stripe = self._stripe(product_id)
+        with self.products_locks[stripe]:
+            [handed, taken] = self._claim(stripe, cart_id, product_id, quantity)
+        if handed or taken:
+            self._move_to_cart(cart_id, product_id, taken, handed)
+        return len(handed) + len(taken)
+
+    def _claim(self, stripe, cart_id, product_id, quantity):
+        """
+        Takes up to quantity units of the product for the cart: first those handed to it,
+        then those on the index. In waitlist mode, the cart's ticket then asks for the
+        units still missing, or is dropped once it has none left to claim.
+        The caller must hold the stripe's lock.
+
+        :returns the ids of the producers of the units handed and of those on the index
+        """
+        key = (cart_id, product_id)
+        ticket = self.tickets[stripe].get(key) if self.waitlist else None
+        handed = [] if ticket is None \
+            else [ticket.units.popleft() for _ in range(min(quantity, len(ticket.units)))]
+        producers = self.products_index[stripe].get(product_id)
+        taken = popleft_many(producers, quantity - len(handed)) if producers else []
+        if not self.waitlist:
+            return handed, taken
+
+        missing = quantity - len(handed) - len(taken)
+        if missing:
+            if ticket is None:
+                ticket = self.tickets[stripe][key] = Ticket(cart_id)
+            ticket.wanted = missing
+            if not ticket.queued:
+                self.waitlists[stripe].setdefault(product_id, deque()).append(ticket)
+                ticket.queued = True
+        elif ticket is not None:
+            # a ticket left in the waitlist is skipped there, as it wants nothing
+            ticket.wanted = 0
+            if not ticket.units:
+                del self.tickets[stripe][key]
+        return handed, taken
+
+    def _wait_for_ticket(self, cart_id, product_id, timeout):
+        """
+        add_to_cart_wait in waitlist mode: queues the cart for one unit of the product and
+        sleeps until it is handed over; the ticket is withdrawn if the timeout expires
+
+        :returns True, or False if the timeout expired before a unit was handed over
+        """
+        stripe = self._stripe(product_id)
+        with self.products_locks[stripe]:
+            [handed, taken] = self._claim(stripe, cart_id, product_id, 1)
+            if not handed and not taken:
+                ticket = self.tickets[stripe][(cart_id, product_id)]
+                if ticket.condition is None:
+                    ticket.condition = Condition(self.products_locks[stripe])
+                if ticket.condition.wait_for(lambda: ticket.units, timeout):
+                    [handed, taken] = self._claim(stripe, cart_id, product_id, 1)
+        if not handed and not taken:
+            self._cancel(cart_id, product_id)
+            return False
+        self._move_to_cart(cart_id, product_id, taken, handed)
+        return True
+
+    def _cancel(self, cart_id, product_id):
+        """
+        Withdraws the cart's ticket for the product, putting back on sale the units that
+        were handed to it and not claimed
+        """
+        stripe = self._stripe(product_id)
+        with self.products_locks[stripe]:
+            ticket = self.tickets[stripe].pop((cart_id, product_id), None)
+            if ticket is None:
+                return
+            ticket.wanted = 0
+            producer_ids = list(ticket.units)
+        if producer_ids:
+            self._restock(product_id, producer_ids)
+
+    def _return(self, cart_id, product_id, quantity):
+        """
+        Takes up to quantity units of the product out of the cart and puts them back on
+        sale, in the queues of the producers they came from
+
+        :returns the number of units returned
+        """
+        producer_ids = self._unload(cart_id, product_id, quantity)
+        if producer_ids:
+            self._restock(product_id, producer_ids)
+        return len(producer_ids)
+
+    def _unload(self, cart_id, product_id, quantity):
+        """
+        Takes up to quantity units of the product out of the cart, without putting them
+        back on sale
+
+        :returns the ids of the producers of the units
+        """
+        with self.carts_locks[cart_id]:
+            held = self.carts[cart_id].get(product_id)
+            if not held:
+                return []
+            # the units leave in the order they came in
+            producer_ids = popleft_many(held, quantity)
+            if not held:
+                del self.carts[cart_id][product_id]
+        return producer_ids
+
+    def _drain(self, product_id):
+        """
+        Takes every unit of the product off the index, without freeing their slots
 
+        :returns the ids of the producers of the units
+        """
+        stripe = self._stripe(product_id)
+        with self.products_locks[stripe]:
+            producers = self.products_index[stripe].pop(product_id, None)
+        return list(producers) if producers else []
+
+    def _restock(self, product_id, producer_ids):
+        """
+        Takes back slots in the producers' queues for units that had left the sale and
+        puts them on sale again
+        """
+        for producer_id, units in Counter(producer_ids).items():
+            with self.producers_locks[producer_id]:
+                self.producers_list[producer_id] += units
+                self.admission.restore(producer_id, product_id, units)
+        self._put_on_sale(product_id, producer_ids)
+
+    def _put_on_sale(self, product_id, producer_ids):
+        """
+        Puts units of the product on sale, one per producer id. In waitlist mode they go
+        to the waiting carts first, and the slots of those handed over are freed; the rest
+        are appended to the index, waking up as many consumers waiting for the product.
+
+        :returns the (cart id, producer ids) pairs of the units handed to waiting carts
+        """
+        stripe = self._stripe(product_id)
+        with self.products_locks[stripe]:
+            handed = self._hand_off(stripe, product_id, producer_ids) if self.waitlist else []
+            rest = producer_ids[sum(len(units) for _, units in handed):]
+            if rest:
+                self._queue(self.products_index[stripe], product_id).extend(rest)
+                self._product_condition(stripe, product_id).notify(len(rest))
+        if handed:
+            self._free_slots(product_id, [producer_id for _, units in handed
+                                          for producer_id in units])
+        return handed
+
+    def _hand_off(self, stripe, product_id, producer_ids):
+        """
+        Hands units of the product to the tickets waiting for it, oldest first.
+        The caller must hold the stripe's lock.
+
+        :returns the (cart id, producer ids) pairs of the units handed over
+        """
+        [waitlist, handed, start] = [self.waitlists[stripe].get(product_id), [], 0]
+        while waitlist and start < len(producer_ids):
+            ticket = waitlist[0]
+            if ticket.wanted:
+                units = producer_ids[start:start + ticket.wanted]
+                ticket.units.extend(units)
+                [ticket.wanted, start] = [ticket.wanted - len(units), start + len(units)]
+                handed.append((ticket.cart_id, units))
+                if ticket.condition is not None:
+                    ticket.condition.notify()
+            if not ticket.wanted:
+                waitlist.popleft()
+                ticket.queued = False
+        return handed
+
+    def _move_to_cart(self, cart_id, product_id, producer_ids, handed=()):
+        """
+        Records units in the cart: those taken off the index, whose slots in the
+        producers' queues are freed, and those handed to it, whose slots already were
+        """
+        with self.carts_locks[cart_id]:
+            units = self._queue(self.carts[cart_id], product_id)
+            units.extend(handed)
+            units.extend(producer_ids)
+        if producer_ids:
+            self._free_slots(product_id, producer_ids)
+
+    def _free_slots(self, product_id, producer_ids):
+        """
+        Frees the slots of units that left the sale in the producers' queues, waking up
+        the producers waiting for room
+        """
+        for producer_id, units in Counter(producer_ids).items():
+            with self.producers_locks[producer_id]:
+                self.producers_list[producer_id] -= units
+                self.admission.release(producer_id, product_id, units)
+                self.producers_conditions[producer_id].notify()
+        if self.admission.shared:
+            self._wake_producers()
+
+    def _wake_producers(self):
+        """
+        Wakes up every producer waiting for room, as the room freed by a unit leaving the
+        sale may be given to any of them
+        """
+        for producer_id in list(self.waiting_producers):
+            with self.producers_locks[producer_id]:
+                self.producers_conditions[producer_id].notify()
@@ -0,0 +1,68 @@
+"""
+This module sets up the Marketplace's logging pipeline.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+from threading import Lock
+
+LOGGER_NAME = "marketplace"
+
+[_LISTENER_LOCK, _LISTENER] = [Lock(), []]
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of the record to the listener's thread.
+    The Marketplace only logs immutable arguments (products and ids), so the record
+    can cross threads as it is.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(filename="marketplace.log", level=logging.INFO,
+                  max_bytes=5 * 1024 * 1024, backup_count=10):
+    """
+    Returns the marketplace logger. The first call in the process attaches a queue handler
+    to it and starts a single background thread that writes the records to a size-rotated
+    file; later calls only change the level.
+
+    :type filename: String
+    :param filename: the log file, used only by the first call
+
+    :type level: Int
+    :param level: the minimum level of the records that are logged
+
+    :type max_bytes: Int
+    :param max_bytes: the size at which the log file is rotated, used only by the first call
+
+    :type backup_count: Int
+    :param backup_count: the number of rotated files kept, used only by the first call
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    with _LISTENER_LOCK:
+        if not _LISTENER:
+            file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                                backupCount=backup_count)
+            formatter = logging.Formatter("%(asctime)s - %(message)s")
+            formatter.converter = time.gmtime
+            file_handler.setFormatter(formatter)
+
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, file_handler)
+            listener.start()
+            atexit.register(listener.stop)
+            _LISTENER.append(listener)
+
+            logger.addHandler(_DeferredQueueHandler(records))
+            logger.propagate = False
+        logger.setLevel(level)
+    return logger
@@ -0,0 +1,234 @@
+"""
+This module holds the Marketplace's opt-in instrumentation: operation counters, latency
+histograms and lock wait/hold times, with a Prometheus text exporter.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import bisect
+import functools
+import inspect
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# upper bounds, in seconds, of the latency histogram buckets; the last bucket is +Inf
+BUCKETS = [1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2, 1e-1, 1.0]
+
+# the calls whose True/False (or unit count) result is counted as success/failure
+RESULT_METHODS = {"publish", "publish_many", "publish_wait",
+                  "add_to_cart", "add_to_cart_many", "add_to_cart_wait"}
+
+
+class InstrumentedLock:
+    """
+    Lock that accounts the time spent waiting for it and holding it.
+    It can back a Condition: Condition only needs acquire/release.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # only the holder updates these, so the lock itself protects them
+        [self.acquisitions, self.wait_s, self.hold_s, self.acquired_at] = [0, 0.0, 0.0, 0.0]
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the lock, accounting the time it took
+        """
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)  # pylint: disable=consider-using-with
+        if acquired:
+            self.acquired_at = time.perf_counter()
+            self.acquisitions += 1
+            self.wait_s += self.acquired_at - start
+        return acquired
+
+    def release(self):
+        """
+        Releases the lock, accounting the time it was held
+        """
+        self.hold_s += time.perf_counter() - self.acquired_at
+        self.lock.release()
+
+    def locked(self):
+        """
+        Returns True if the lock is held
+        """
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class MarketplaceStats:
+    """
+    Counters of one Marketplace. The marketplace wraps its public methods with timed()
+    and creates its locks with new_lock() when instrumentation is on.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # method -> {"count", "sum_s", "buckets"}
+        self.calls = {}
+        # method -> {"success", "failure"}
+        self.results = {}
+        # lock role ("producer", "cart", "products") -> (index, lock) of every lock created
+        # for it; the index is the stripe, producer or cart the lock guards, None if global
+        self.locks = {}
+
+    def new_lock(self, role, index=None):
+        """
+        Returns a new lock accounted under role and index
+        """
+        lock = InstrumentedLock()
+        with self.lock:
+            self.locks.setdefault(role, []).append((index, lock))
+        return lock
+
+    def timed(self, name, method):
+        """
+        Returns method wrapped so that its calls, latency and result are counted under name.
+        Coroutine methods get a coroutine wrapper, which counts the time until they return.
+        """
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = await method(*args, **kwargs)
+                self.record(name, time.perf_counter() - start, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            self.record(name, time.perf_counter() - start, result)
+            return result
+        return wrapper
+
+    def record(self, name, elapsed, result):
+        """
+        Accounts one call of name that took elapsed seconds and returned result
+        """
+        with self.lock:
+            call = self.calls.get(name)
+            if call is None:
+                call = self.calls[name] = {"count": 0, "sum_s": 0.0,
+                                           "buckets": [0] * (len(BUCKETS) + 1)}
+            call["count"] += 1
+            call["sum_s"] += elapsed
+            call["buckets"][bisect.bisect_left(BUCKETS, elapsed)] += 1
+            if name in RESULT_METHODS:
+                outcome = self.results.setdefault(name, {"success": 0, "failure": 0})
+                outcome["success" if result else "failure"] += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters. The lock counters are summed per role and, under
+        "indexed", kept per stripe, producer or cart for the locks that have an index.
+        """
+        def totals(locks):
+            return {"acquisitions": sum(lock.acquisitions for lock in locks),
+                    "wait_s": sum(lock.wait_s for lock in locks),
+                    "hold_s": sum(lock.hold_s for lock in locks)}
+
+        with self.lock:
+            return {"calls": {name: {"count": call["count"], "sum_s": call["sum_s"],
+                                     "buckets": dict(zip([*BUCKETS, "+Inf"], call["buckets"]))}
+                              for name, call in self.calls.items()},
+                    "results": {name: dict(outcome) for name, outcome in self.results.items()},
+                    "locks": {role: {**totals([lock for _, lock in locks]),
+                                     "indexed": {index: totals([lock])
+                                                 for index, lock in locks if index is not None}}
+                              for role, locks in self.locks.items()}}
+
+
+def exposition(stats):
+    """
+    Formats the dict returned by Marketplace.stats() in the Prometheus text format. The
+    stats of every shard of a FederatedMarketplace are exported too, with a shard label.
+    """
+    lines = []
+    # the label prefix and the stats of the marketplace, then of each of its shards
+    sources = [("", stats)] + [(f'shard="{index}",', shard)
+                               for index, shard in enumerate(stats.get("shards", []))]
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    family("marketplace_call_duration_seconds", "histogram", "Latency of the marketplace calls")
+    for labels, source in sources:
+        for method, call in source.get("calls", {}).items():
+            cumulative = 0
+            for bound, count in call["buckets"].items():
+                cumulative += count
+                lines.append(f'marketplace_call_duration_seconds_bucket{{{labels}'
+                             f'method="{method}",le="{bound}"}} {cumulative}')
+            lines.append(f'marketplace_call_duration_seconds_sum{{{labels}method="{method}"}} '
+                         f'{call["sum_s"]}')
+            lines.append(f'marketplace_call_duration_seconds_count{{{labels}'
+                         f'method="{method}"}} {call["count"]}')
+
+    family("marketplace_call_results_total", "counter", "Successful and failed calls")
+    for labels, source in sources:
+        for method, outcome in source.get("results", {}).items():
+            for result, count in outcome.items():
+                lines.append(f'marketplace_call_results_total{{{labels}method="{method}",'
+                             f'result="{result}"}} {count}')
+
+    for key, help_text in [("acquisitions", "Lock acquisitions"),
+                           ("wait_s", "Seconds spent waiting for the locks"),
+                           ("hold_s", "Seconds the locks were held")]:
+        name = "marketplace_lock_" + key.replace("_s", "_seconds") + "_total"
+        family(name, "counter", help_text)
+        # per role, one series for its global locks and one per stripe, producer or cart
+        # lock, so that they add up to the role's totals
+        for labels, source in sources:
+            for role, totals in source.get("locks", {}).items():
+                lines.append(f'{name}{{{labels}lock="{role}"}} '
+                             f'{totals[key] - sum(one[key] for one in totals["indexed"].values())}')
+                lines.extend(f'{name}{{{labels}lock="{role}",index="{index}"}} {lock[key]}'
+                             for index, lock in totals["indexed"].items())
+
+    family("marketplace_inventory_depth", "gauge", "Units on sale per producer")
+    for labels, source in sources:
+        for producer_id, depth in source["inventory"].items():
+            lines.append(f'marketplace_inventory_depth{{{labels}producer="{producer_id}"}} '
+                         f'{depth}')
+    return "\n".join(lines) + "\n"
+
+
+def serve_stats(marketplace, port, host="127.0.0.1"):
+    """
+    Serves the marketplace's stats in the Prometheus text format from a background thread
+
+    :returns the HTTP server; call its shutdown() to stop it
+    """
+    class StatsHandler(BaseHTTPRequestHandler):
+        """
+        Answers every GET with the current stats
+        """
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            Writes the exposition
+            """
+            body = exposition(marketplace.stats()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,194 @@
+"""
+This module represents the TraceRecorder: a binary trace of the marketplace's operations,
+kept in a memory-mapped ring file.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import functools
+import inspect
+import json
+import mmap
+import struct
+import time
+from itertools import count
+
+# magic, version, record size, capacity in records, records written, start (epoch seconds)
+HEADER = struct.Struct("<8sIIQQd")
+# the records written field of the header, kept up to date as the records are written
+WRITTEN = struct.Struct("<Q")
+WRITTEN_OFFSET = struct.calcsize("<8sIIQ")
+MAGIC = b"MKTTRACE"
+VERSION = 1
+# seconds since the start, call duration, op code, producer or cart id, product id,
+# quantity asked for and result: 32 bytes
+RECORD = struct.Struct("<dfB3xiiii")
+# the op codes are the positions of the operations in this list
+OPS = ["register_producer", "publish", "publish_many", "publish_wait",
+       "new_cart", "add_to_cart", "add_to_cart_many", "add_to_cart_wait",
+       "remove_from_cart", "remove_from_cart_many", "place_order"]
+# the result of the calls that return nothing
+NO_RESULT = -1
+
+
+class TraceRecorder:
+    """
+    Writes one fixed-size record per marketplace call into a file mapped in memory, so
+    recording costs a struct.pack_into and no formatting or system call. The file holds
+    the last capacity records: once it is full, the oldest ones are overwritten. The
+    products are written as the ids their registry gives them; their names go to a
+    sidecar file, <path>.products, when the recorder is closed.
+    """
+
+    def __init__(self, path, capacity=1 << 20, clock=None):
+        """
+        Constructor
+
+        :type path: String
+        :param path: the trace file, created or overwritten
+
+        :type capacity: Int
+        :param capacity: the number of records the file holds
+
+        :type clock: VirtualClock
+        :param clock: the clock the calls are timed on, a VirtualClock or a Simulation
+        when the time is simulated; time.perf_counter() by default
+        """
+        [self.path, self.capacity, self.registry, self.closed] = [path, capacity, None, False]
+        self.now = time.perf_counter if clock is None else clock.time
+        [self.slots, self.start] = [count(), self.now()]
+        self.file = open(path, "w+b")  # pylint: disable=consider-using-with
+        self.file.truncate(HEADER.size + capacity * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), HEADER.size + capacity * RECORD.size)
+        self.started_at = time.time()
+        self._write_header(0)
+
+    def bind(self, registry):
+        """
+        Sets the registry that gives the traced products their ids
+        """
+        self.registry = registry
+
+    def traced(self, name, method):
+        """
+        Returns method wrapped so that every call of it is recorded under name. The calls
+        take a producer or cart id first, then maybe a product and, for the *_many
+        operations, a quantity.
+        """
+        [op, many] = [OPS.index(name), name.endswith("_many")]
+
+        def record(args, start, result):
+            product_id = self.registry.intern(args[1]) if len(args) > 1 else -1
+            self.record(op, args[0] if args else result, product_id,
+                        quantity=args[2] if many else 1, result=result, start=start)
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                start = self.now()
+                result = await method(*args, **kwargs)
+                record(args, start, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = self.now()
+            result = method(*args, **kwargs)
+            record(args, start, result)
+            return result
+        return wrapper
+
+    def record(self, op, actor, product_id, *, quantity, result, start):
+        """
+        Writes a record in the next slot of the ring
+
+        :type op: Int
+        :param op: the position of the operation in OPS
+
+        :type actor: Int
+        :param actor: the producer or cart id
+
+        :type product_id: Int
+        :param product_id: the registry id of the product, -1 if there is none
+
+        :type quantity: Int
+        :param quantity: the number of units asked for
+
+        :type result: Object
+        :param result: what the call returned: a number, a boolean, the products of an
+        order (recorded as their number of units) or None
+
+        :type start: Float
+        :param start: the time the call started at, on the recorder's clock
+        """
+        if self.closed:
+            return
+        end = self.now()
+        if result is None:
+            result = NO_RESULT
+        elif isinstance(result, list):
+            result = sum(line[1] if isinstance(line, tuple) else 1 for line in result)
+        written = next(self.slots)
+        RECORD.pack_into(self.map, HEADER.size + (written % self.capacity) * RECORD.size,
+                         end - self.start, end - start, op, actor, product_id, quantity,
+                         int(result))
+        # a run killed before close() leaves a trace that reads up to here; a record that
+        # finishes after a later one may be left out of the count
+        WRITTEN.pack_into(self.map, WRITTEN_OFFSET, written + 1)
+
+    def close(self):
+        """
+        Writes the number of records to the header and the product names to the sidecar
+        file, and stops recording. The mapping stays open, as daemon producers may still
+        be in the middle of a record; it is released with the recorder.
+        """
+        self.closed = True
+        self._write_header(next(self.slots))
+        self.map.flush()
+        self.file.close()
+        products = [] if self.registry is None else [str(p) for p in self.registry.products]
+        with open(self.path + ".products", "w", encoding="utf-8") as products_file:
+            json.dump(products, products_file)
+
+    def _write_header(self, written):
+        """
+        Writes the header, with written records so far
+        """
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, written,
+                         self.started_at)
+
+
+def read_trace(path):
+    """
+    Reads a trace file written by a TraceRecorder
+
+    :returns a dict with the "started_at" epoch time, the number of records "written" and
+    "lost" to the ring, the "products" names by id (empty if the sidecar file is missing)
+    and the "records", oldest first, as tuples of (time, duration, op, actor, product_id,
+    quantity, result)
+    """
+    with open(path, "rb") as trace_file:
+        data = trace_file.read()
+    [magic, version, record_size, capacity, written, started_at] = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a version {VERSION} marketplace trace")
+
+    records = data[HEADER.size:HEADER.size + capacity * RECORD.size]
+    if written > capacity:
+        # the ring wrapped: the oldest record is the one after the last written
+        split = (written % capacity) * RECORD.size
+        records = records[split:] + records[:split]
+    else:
+        records = records[:written * RECORD.size]
+
+    try:
+        with open(path + ".products", encoding="utf-8") as products_file:
+            products = json.load(products_file)
+    except FileNotFoundError:
+        products = []
+    return {"started_at": started_at, "written": written,
+            "lost": max(0, written - capacity), "products": products,
+            "records": list(RECORD.iter_unpack(records))}
@@ -0,0 +1,96 @@
+"""
+This module represents the OrderSink: the single writer of the consumers' orders.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import queue
+import sys
+from threading import Thread
+
+
+class OrderSink:
+    """
+    Consumers hand their placed orders to the sink instead of printing them. One writer
+    thread formats them, caching the text of every product, and writes whatever orders
+    have piled up in a single write. In sorted mode the lines are kept until close() and
+    written sorted, in the order check_test.py compares them.
+    """
+
+    def __init__(self, output=None, sort=False):
+        """
+        Constructor
+
+        :type output: File
+        :param output: where the orders are written, sys.stdout by default
+
+        :type sort: Boolean
+        :param sort: if True, write every line at close(), sorted
+        """
+        [self.output, self.sort] = [sys.stdout if output is None else output, sort]
+        [self.orders, self.lines, self.products] = [queue.SimpleQueue(), [], {}]
+        self.writer = Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def submit(self, name, order):
+        """
+        Hands over the order a consumer placed
+
+        :type name: String
+        :param name: the consumer's name
+
+        :type order: List
+        :param order: the (product, quantity) lines of the order, see Marketplace.place_order
+        """
+        self.orders.put((name, order))
+
+    def close(self):
+        """
+        Writes every order submitted so far and stops the writer thread
+        """
+        self.orders.put(None)
+        self.writer.join()
+
+    def _format(self, name, order):
+        """
+        Returns the output lines of an order
+        """
+        lines = []
+        for product, quantity in order:
+            text = self.products.get(product)
+            if text is None:
+                text = self.products[product] = str(product)
+            lines.extend([f"{name} bought {text}"] * quantity)
+        return lines
+
+    def _write(self):
+        """
+        Writes the submitted orders in batches until close() is called
+        """
+        closed = False
+        while not closed:
+            batch = [self.orders.get()]
+            while True:
+                try:
+                    batch.append(self.orders.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for item in batch:
+                if item is None:
+                    closed = True
+                else:
+                    lines.extend(self._format(*item))
+
+            if self.sort:
+                self.lines.extend(lines)
+            elif lines:
+                self.output.write("\n".join(lines) + "\n")
+
+        if self.sort and self.lines:
+            self.lines.sort()
+            self.output.write("\n".join(self.lines) + "\n")
+        self.output.flush()
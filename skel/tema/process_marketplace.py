@@ -0,0 +1,253 @@
+"""
+This module represents the process-parallel Marketplace: its counters live in shared
+memory so producers and consumers can run in several processes.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+from collections import deque
+
+try:
+    from tema.consumer import Consumer
+    from tema.producer import Producer
+except ImportError:
+    from consumer import Consumer
+    from producer import Producer
+
+
+class SharedMarketplace:  # pylint: disable=too-many-instance-attributes
+    """
+    Marketplace whose per-producer capacity counters and per-product stock counts are
+    array-backed shared memory, guarded by cross-process locks. Products cross process
+    boundaries as integer ids: the index of the product in the products list every process
+    gets a copy of. Carts are only ever touched by the consumer that owns them, so they are
+    kept in the memory of that consumer's process.
+
+    Only the non-blocking calls are supported.
+    """
+
+    def __init__(self, queue_size_per_producer, products, max_producers):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type products: List
+        :param products: every product that can be published
+
+        :type max_producers: Int
+        :param max_producers: the number of producers the shared arrays are sized for
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        [self.products, self.max_producers] = [list(products), max_producers]
+        self.product_ids = {product: index for index, product in enumerate(self.products)}
+
+        # stock[product_id * max_producers + producer_id] = units of product from that producer
+        self.stock = multiprocessing.Array('i', len(self.products) * max_producers, lock=False)
+        self.producers_list = multiprocessing.Array('i', max_producers, lock=False)
+        [self.producer_index, self.cart_index] = \
+            [multiprocessing.Value('i', -1), multiprocessing.Value('i', -1)]
+        # one lock per product row of stock and one per producer counter; a thread holding a
+        # product lock may take a producer lock, never the other way around
+        self.products_locks = [multiprocessing.Lock() for _ in self.products]
+        self.producers_locks = [multiprocessing.Lock() for _ in range(max_producers)]
+        # cart id -> product id -> ids of the producers of the units of it in the cart
+        self.carts_list = {}
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        with self.producer_index.get_lock():
+            self.producer_index.value += 1
+            producer_id = self.producer_index.value
+        if producer_id >= self.max_producers:
+            raise ValueError(f"SharedMarketplace is sized for {self.max_producers} producers")
+        return producer_id
+
+    def publish(self, producer_id, product):
+        """
+        Adds the product provided by the producer to the marketplace
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        return self.publish_many(producer_id, product, 1) == 1
+
+    def publish_many(self, producer_id, product, quantity):
+        """
+        Adds as many units of the product as the producer's queue has room for, up to quantity
+
+        :returns the number of units published
+        """
+        product_id = self.product_ids[product]
+        with self.producers_locks[producer_id]:
+            published = min(quantity,
+                            self.queue_size_per_producer - self.producers_list[producer_id])
+            if published <= 0:
+                return 0
+            self.producers_list[producer_id] += published
+        with self.products_locks[product_id]:
+            self.stock[product_id * self.max_producers + producer_id] += published
+        return published
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        with self.cart_index.get_lock():
+            self.cart_index.value += 1
+            cart_id = self.cart_index.value
+        self.carts_list[cart_id] = {}
+        return cart_id
+
+    def add_to_cart(self, cart_id, product):
+        """
+        Adds a product to the given cart
+
+        :returns True or False. If the caller receives False, it should wait and then try again
+        """
+        return self.add_to_cart_many(cart_id, product, 1) == 1
+
+    def add_to_cart_many(self, cart_id, product, quantity):
+        """
+        Adds as many units of the product as are on sale, up to quantity, to the given cart
+
+        :returns the number of units added
+        """
+        product_id = self.product_ids[product]
+        row = product_id * self.max_producers
+        added = 0
+        with self.products_locks[product_id]:
+            for producer_id in range(self.max_producers):
+                units = min(quantity - added, self.stock[row + producer_id])
+                if units <= 0:
+                    continue
+                self.stock[row + producer_id] -= units
+                with self.producers_locks[producer_id]:
+                    self.producers_list[producer_id] -= units
+                self.carts_list[cart_id].setdefault(product_id, deque()).extend(
+                    [producer_id] * units)
+                added += units
+                if added == quantity:
+                    break
+        return added
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes a product from cart.
+        """
+        self.remove_from_cart_many(cart_id, product, 1)
+
+    def remove_from_cart_many(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of a product from cart.
+
+        :returns the number of units removed
+        """
+        product_id = self.product_ids[product]
+        held = self.carts_list[cart_id].get(product_id, deque())
+        removed = [held.popleft() for _ in range(min(quantity, len(held)))]
+
+        with self.products_locks[product_id]:
+            for producer_id in removed:
+                self.stock[product_id * self.max_producers + producer_id] += 1
+                with self.producers_locks[producer_id]:
+                    self.producers_list[producer_id] += 1
+        return len(removed)
+
+    def place_order(self, cart_id, summary=False):
+        """
+        Return a list with all the products in the cart, or one (product, quantity) pair
+        per product if summary is True.
+        """
+        lines = [(self.products[product_id], len(producer_ids))
+                 for product_id, producer_ids in self.carts_list[cart_id].items() if producer_ids]
+        if summary:
+            return lines
+        return [product for product, quantity in lines for _ in range(quantity)]
+
+
+# seconds the parent waits for a result before checking that the workers are alive
+RESULT_POLL_S = 1.0
+
+
+def _worker(index, marketplace, producers, consumers, *, results, done):
+    """
+    Runs a share of the producers and consumers as threads of one process. The output of
+    the consumers is captured and handed to the parent, tagged with the worker's index,
+    which prints it in one piece; the producers keep publishing until the parent sets done.
+    """
+    producers = [Producer(**config, marketplace=marketplace, daemon=True) for config in producers]
+    consumers = [Consumer(**config, marketplace=marketplace) for config in consumers]
+    for producer in producers:
+        producer.start()
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+    results.put((index, output.getvalue()))
+    done.wait()
+
+
+def run_processes(marketplace, producers, consumers, workers=None):
+    """
+    Spreads the producers and consumers round-robin over a pool of worker processes and
+    prints what the consumers bought once all of them are done
+
+    :type marketplace: SharedMarketplace
+    :param marketplace: the marketplace shared by every process
+
+    :type producers: List
+    :param producers: the Producer arguments (besides the marketplace) of every producer
+
+    :type consumers: List
+    :param consumers: the Consumer arguments (besides the marketplace) of every consumer
+
+    :type workers: Int
+    :param workers: the number of processes, the number of CPUs by default
+
+    :raises RuntimeError if a worker exits before handing its result, instead of waiting
+    for it forever; the other workers are terminated
+    """
+    workers = max(1, min(workers or os.cpu_count(), len(producers) + len(consumers)))
+    [results, done] = [multiprocessing.Queue(), multiprocessing.Event()]
+    processes = [multiprocessing.Process(target=_worker,
+                                         args=(i, marketplace, producers[i::workers],
+                                               consumers[i::workers]),
+                                         kwargs={"results": results, "done": done},
+                                         daemon=True)
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    pending = set(range(workers))
+    while pending:
+        try:
+            [index, output] = results.get(timeout=RESULT_POLL_S)
+        except queue.Empty:
+            # the workers only exit after done is set, so one that exited has died
+            dead = [i for i in pending if processes[i].exitcode is not None]
+            if dead:
+                for process in processes:
+                    process.terminate()
+                message = f"worker {dead[0]} exited with code {processes[dead[0]].exitcode}"
+                raise RuntimeError(message + " before handing its result") from None
+            continue
+        pending.discard(index)
+        print(output, end="")
+    done.set()
+    for process in processes:
+        process.join()
@@ -6,16 +6,36 @@ Assignment 1
 March 2021
 """
 
-import time
 from threading import Thread
 
+# pylint: disable=duplicate-code
+try:
+    from tema.clock import RealClock
+except ImportError:
+    from clock import RealClock
+# pylint: enable=duplicate-code
+
+
+def units_made(quantity, wait_time, elapsed, published):
+    """
+    Returns how many of the quantity units of a product a producer has made elapsed
+    seconds after it started on it: one at once, then one every wait_time. A publish is
+    only tried once the next unit is due, so that one is made whatever the rounding.
+
+    :type published: Int
+    :param published: the units of the product already published
+    """
+    made = quantity if wait_time <= 0 else 1 + int(elapsed / wait_time)
+    return min(quantity, max(made, published + 1))
+
 
 class Producer(Thread):
     """
     Class that represents a producer.
     """
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, blocking=False, clock=None,
+                 **kwargs):
         """
         Constructor.
 
@@ -29,6 +49,13 @@ class Producer(Thread):
         @param republish_wait_time: the number of seconds that a producer must
         wait until the marketplace becomes available
 
+        @type blocking: Boolean
+        @param blocking: if True, block in Marketplace.publish_wait until the queue has
+        room instead of sleeping republish_wait_time between attempts
+
+        @type clock: RealClock or VirtualClock
+        @param clock: the clock the producer sleeps on, the wall clock by default
+
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
         """
@@ -37,18 +64,26 @@ class Producer(Thread):
         self.products, self.marketplace, self.republish_wait_time, \
             self.product_no, self.producer_id = products, marketplace, republish_wait_time, 0, \
             marketplace.register_producer()
+        self.blocking = blocking
+        self.clock = clock or RealClock()
+        self.clock.register()
 
     def publish_product(self, product, quantity, wait_time, id_producer):
-        iterator = 0
+        [iterator, start] = [0, self.clock.time()]
         # Publish a product in the given quantity
         while iterator < quantity:
-            wait_publish = self.marketplace.publish(id_producer, product)
+            # Publish in one call every unit made so far that the queue has room for
+            made = units_made(quantity, wait_time, self.clock.time() - start, iterator)
+            wait_publish = self.marketplace.publish_many(id_producer, product, made - iterator)
+            if not wait_publish and self.blocking:
+                wait_publish = int(self.marketplace.publish_wait(id_producer, product))
             # Producer must wait until the marketplace becomes available
             if wait_publish:
-                iterator = iterator + 1
-                time.sleep(wait_time)
+                iterator = iterator + wait_publish
+                # until the next unit is made
+                self.clock.sleep(max(0, start + iterator * wait_time - self.clock.time()))
             else:
-                time.sleep(self.republish_wait_time)
+                self.clock.sleep(self.republish_wait_time)
 
     def run(self):
         while True:
@@ -6,7 +6,8 @@ Assignment 1
 March 2021
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from threading import Lock
 
 
 @dataclass(init=True, repr=True, order=False, frozen=True)
@@ -14,15 +15,38 @@ class Product:
     """
     Class that represents a product.
     """
+    # slotted, with room for the hash, which is computed on first use
+    __slots__ = ("name", "price", "_hash")
+
     name: str
     price: int
 
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            value = hash(tuple(getattr(self, field.name) for field in fields(self)))
+            object.__setattr__(self, "_hash", value)
+            return value
+
+    # a frozen slotted class needs these to be pickled; the hash is left out, as the
+    # hashes of strings differ between processes
+    def __getstate__(self):
+        return [getattr(self, field.name) for field in fields(self)]
+
+    def __setstate__(self, state):
+        for field, value in zip(fields(self), state):
+            object.__setattr__(self, field.name, value)
+
 
 @dataclass(init=True, repr=True, order=False, frozen=True)
 class Tea(Product):
     """
     Tea products
     """
+    __slots__ = ("type",)
+    __hash__ = Product.__hash__
+
     type: str
 
 
@@ -31,5 +55,41 @@ class Coffee(Product):
     """
     Coffee products
     """
+    __slots__ = ("acidity", "roast_level")
+    __hash__ = Product.__hash__
+
     acidity: str
     roast_level: str
+
+
+class ProductRegistry:
+    """
+    Interns products: every distinct product gets a small integer id, the same for all
+    the products equal to it, and the first of them stands for all the others.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # product -> id, and id -> the interned product
+        [self.ids, self.products] = [{}, []]
+
+    def intern(self, product):
+        """
+        Returns the id of product, registering it the first time it is seen
+        """
+        product_id = self.ids.get(product)
+        if product_id is None:
+            with self.lock:
+                product_id = self.ids.get(product)
+                if product_id is None:
+                    # the product is stored before its id is published, as the id is
+                    # read without the lock and may be used right away
+                    self.products.append(product)
+                    product_id = self.ids[product] = len(self.products) - 1
+        return product_id
+
+    def product(self, product_id):
+        """
+        Returns the interned product with the given id
+        """
+        return self.products[product_id]
@@ -0,0 +1,233 @@
+"""
+This module represents the discrete-event simulation engine: producers and consumers
+run as generators on a single thread, scheduled from a seeded event queue.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import math
+import random
+from collections import Counter, deque
+from itertools import count
+
+# pylint: disable=duplicate-code
+try:
+    from tema.consumer import shop
+    from tema.marketplace import Marketplace
+    from tema.producer import units_made
+except ImportError:
+    from consumer import shop
+    from marketplace import Marketplace
+    from producer import units_made
+# pylint: enable=duplicate-code
+
+
+class Simulation:
+    """
+    Single-threaded event loop over simulated time. An actor is a generator that yields
+    the number of seconds it sleeps; it is resumed once the simulated time has advanced
+    by that much. Actors due at the same time are resumed in an order drawn from the
+    seeded generator, so a run depends only on its configuration and seed.
+
+    An actor whose attempt failed may instead yield a (key, interval) pair: it would retry
+    every interval seconds, but as every retry before wake(key) is called would fail too,
+    it is parked until then and resumed at its first retry time after the wake-up.
+    """
+
+    def __init__(self, seed=0):
+        """
+        Constructor
+
+        :type seed: Int
+        :param seed: the seed that breaks ties between actors due at the same time
+        """
+        [self.now, self.rng, self.sequence] = [0.0, random.Random(seed), count()]
+        # heap of (time, tie-breaker, sequence number, actor, daemon) events
+        self.events = []
+        # the non-daemon actors that have not finished yet
+        self.remaining = 0
+        # key -> (actor, daemon, time of the failed attempt, retry interval) of parked actors
+        self.parked = {}
+
+    def time(self):
+        """
+        Returns the current simulated time, in seconds
+        """
+        return self.now
+
+    def spawn(self, actor, daemon=False):
+        """
+        Schedules a new actor to start now. Like a daemon thread, a daemon actor does not
+        keep the simulation running.
+        """
+        if not daemon:
+            self.remaining += 1
+        self._schedule(actor, 0, daemon)
+
+    def run(self):
+        """
+        Runs the events in time order until every non-daemon actor has finished
+
+        :returns the simulated time at which the last of them finished
+        :raises RuntimeError if every remaining actor is parked for good
+        """
+        while self.remaining and self.events:
+            [self.now, _, _, actor, daemon] = heapq.heappop(self.events)
+            try:
+                delay = next(actor)
+            except StopIteration:
+                if not daemon:
+                    self.remaining -= 1
+                continue
+            if isinstance(delay, tuple):
+                [key, interval] = delay
+                self.parked.setdefault(key, deque()).append((actor, daemon, self.now, interval))
+            else:
+                self._schedule(actor, delay, daemon)
+        if self.remaining:
+            raise RuntimeError(f"deadlock at {self.now}s: {self.remaining} actors can never "
+                               "succeed again")
+        return self.now
+
+    def wake(self, key, limit):
+        """
+        Schedules up to limit of the actors parked on key, in the order they parked, at
+        their next retry time
+        """
+        parked = self.parked.get(key)
+        while parked and limit > 0:
+            [actor, daemon, failed_at, interval] = parked.popleft()
+            retries = max(1, math.ceil((self.now - failed_at) / interval)) if interval else 0
+            self._schedule(actor, failed_at + retries * interval - self.now, daemon)
+            limit -= 1
+
+    def _schedule(self, actor, delay, daemon):
+        """
+        Queues actor to resume delay seconds from now
+        """
+        heapq.heappush(self.events, (self.now + delay, self.rng.random(), next(self.sequence),
+                                     actor, daemon))
+
+
+class SimulatedMarketplace(Marketplace):
+    """
+    Marketplace of a simulation. It wakes up the actors parked on a product when units
+    of it are put on sale, and those parked on a producer when its queue frees up: one
+    actor per unit, as a woken actor that finds the unit taken parks again, and one that
+    finds it there takes it, there are never more units waiting than actors woken for them.
+    """
+
+    def __init__(self, queue_size_per_producer, seed=0, simulation=None, **kwargs):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type seed: Int
+        :param seed: the seed of the simulation's tie-breaking
+
+        :type simulation: Simulation
+        :param simulation: the simulation the marketplace runs in, a new one seeded with
+        seed by default
+
+        :type kwargs:
+        :param kwargs: other arguments that are passed to the Marketplace's __init__()
+        """
+        super().__init__(queue_size_per_producer, **kwargs)
+        self.simulation = Simulation(seed) if simulation is None else simulation
+
+    def _put_on_sale(self, product_id, producer_ids):
+        handed = super()._put_on_sale(product_id, producer_ids)
+        self.simulation.wake(("product", self.registry.product(product_id)), len(producer_ids))
+        # in waitlist mode the consumers park on their carts, see SimulatedConsumer
+        for cart_id, _ in handed:
+            self.simulation.wake(("cart", cart_id), 1)
+        return handed
+
+    def _free_slots(self, product_id, producer_ids):
+        super()._free_slots(product_id, producer_ids)
+        for producer_id, units in Counter(producer_ids).items():
+            self.simulation.wake(("producer", producer_id), units)
+
+    def _wake_producers(self):
+        for producer_id in range(len(self.producers_list)):
+            self.simulation.wake(("producer", producer_id), 1)
+
+
+class SimulatedProducer:
+    """
+    Event-driven counterpart of the Producer thread.
+    """
+
+    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+        """
+        Constructor. Takes the same arguments as Producer; kwargs may hold the name.
+        """
+        [self.products, self.marketplace, self.republish_wait_time, self.name] = \
+            [products, marketplace, republish_wait_time, kwargs.get('name')]
+        self.producer_id = marketplace.register_producer()
+
+    def run(self):
+        """
+        Publishes the producer's products forever, yielding every sleep
+        """
+        simulation = self.marketplace.simulation
+        while True:
+            for product, quantity, wait_time in self.products:
+                [published, start] = [0, simulation.now]
+                while published < quantity:
+                    made = units_made(quantity, wait_time, simulation.now - start, published)
+                    attempt = self.marketplace.publish_many(self.producer_id, product,
+                                                            made - published)
+                    if attempt:
+                        published += attempt
+                        # until the next unit is made
+                        yield max(0, start + published * wait_time - simulation.now)
+                    else:
+                        yield ("producer", self.producer_id), self.republish_wait_time
+
+
+class SimulatedConsumer:
+    """
+    Event-driven counterpart of the Consumer thread.
+    """
+
+    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+        """
+        Constructor. Takes the same arguments as Consumer; kwargs must hold the name and
+        may hold the order_sink.
+        """
+        [self.carts, self.marketplace, self.retry_wait_time, self.name] = \
+            [carts, marketplace, retry_wait_time, kwargs['name']]
+        self.order_sink = kwargs.get('order_sink')
+        self.cart_index = marketplace.new_cart()
+
+    def run(self):
+        """
+        Runs the operations of every cart, yielding every retry sleep, then places the order
+        """
+        for product in shop(self):
+            # in waitlist mode the missing units are handed to the cart as they show up
+            key = ("cart", self.cart_index) if self.marketplace.waitlist else ("product", product)
+            yield key, self.retry_wait_time
+
+
+def run_simulation(marketplace, producers, consumers):
+    """
+    Runs the producers as daemon actors until every consumer has placed its order
+
+    :type marketplace: SimulatedMarketplace
+    :param marketplace: the marketplace of the producers and consumers
+
+    :returns the simulated time the run took
+    """
+    simulation = marketplace.simulation
+    for producer in producers:
+        simulation.spawn(producer.run(), daemon=True)
+    for consumer in consumers:
+        simulation.spawn(consumer.run())
+    return simulation.run()
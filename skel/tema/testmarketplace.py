@@ -1,6 +1,30 @@
-from product import Coffee, Tea
+from product import Coffee, ProductRegistry, Tea
+from admission import AdmissionPolicy, AllOf, FairShare, GlobalCap, PerProducerCap, \
+    PerProductCap, ProducerCap
+from array_queue import ArrayQueue, popleft_many
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import time
 import unittest
+from logging.handlers import QueueHandler
+from unittest import mock
+from threading import Thread, current_thread
+from clock import VirtualClock
+from producer import Producer
 from marketplace import Marketplace
+from marketplace_stats import exposition
+from order_sink import OrderSink
+from async_marketplace import AsyncMarketplace
+import process_marketplace
+from process_marketplace import SharedMarketplace
+from marketplace_trace import OPS, TraceRecorder, read_trace
+from federated_marketplace import FederatedMarketplace, HashRing
+from consumer_pool import ConsumerPool, PooledConsumer
+from simulation import Simulation, SimulatedConsumer, SimulatedMarketplace, SimulatedProducer, \
+    run_simulation
 
 
 class TestMarketPlace(unittest.TestCase):
@@ -111,11 +135,14 @@ class TestMarketPlace(unittest.TestCase):
         self.assertEqual(ordered_products[1], second_product)
 class TestMarketPlace(unittest.TestCase):
 
+    # extra Marketplace constructor arguments, overridden by the variants below
+    options = {}
+
     def setUp(self):
         """
         Sets up a mock marketplace with a queue of size 10 for producers
         """
-        self.marketplace = Marketplace(10)
+        self.marketplace = Marketplace(10, **self.options)
 
         self.first_product = Coffee("Brasil", 1, "5.09", "MEDIUM")
         self.second_product = Tea("Wild Cherry", 4, "Wild Cherry")
@@ -215,3 +242,798 @@ class TestMarketPlace(unittest.TestCase):
 
         self.assertEqual(ordered_products[0], first_product)
         self.assertEqual(ordered_products[1], second_product)
+
+    def test_publish_wait(self):
+        """
+        Tests that publish_wait times out on a full queue and is woken up
+        as soon as a consumer frees a slot
+        """
+        marketplace = Marketplace(1, **self.options)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+
+        self.assertTrue(marketplace.publish_wait(producer, self.first_product, timeout=0))
+        self.assertFalse(marketplace.publish_wait(producer, self.second_product, timeout=0.01))
+
+        waiter = Thread(target=marketplace.publish_wait, args=(producer, self.second_product))
+        waiter.start()
+        self.assertTrue(marketplace.add_to_cart(cart, self.first_product))
+        waiter.join(timeout=5)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(marketplace.products_list,
+                         [{'id': producer, 'product': self.second_product}])
+
+    def test_add_to_cart_wait(self):
+        """
+        Tests that add_to_cart_wait times out while the product is out of stock
+        and is woken up as soon as it is published
+        """
+        producer = self.marketplace.register_producer()
+        cart = self.marketplace.new_cart()
+
+        self.assertFalse(self.marketplace.add_to_cart_wait(cart, self.first_product, timeout=0.01))
+
+        waiter = Thread(target=self.marketplace.add_to_cart_wait, args=(cart, self.first_product))
+        waiter.start()
+        self.assertTrue(self.marketplace.publish(producer, self.first_product))
+        waiter.join(timeout=5)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(self.marketplace.place_order(cart), [self.first_product])
+        self.assertEqual(self.marketplace.producers_list[producer], 0)
+
+
+    def test_logging_setup(self):
+        """
+        Tests that several marketplaces share one queue handler and that
+        per-operation logs can be turned off
+        """
+        marketplace = Marketplace(10, log_every=0, **self.options)
+        queue_handlers = [handler for handler in marketplace.logger.handlers
+                          if isinstance(handler, QueueHandler)]
+        self.assertEqual(len(queue_handlers), 1)
+        self.assertIs(marketplace.logger, self.marketplace.logger)
+
+        with mock.patch.object(marketplace.logger, "info") as info:
+            marketplace.register_producer()
+            marketplace.new_cart()
+        info.assert_not_called()
+
+    def test_bulk_operations(self):
+        """
+        Tests that the *_many calls move as many units as possible and report how many
+        """
+        marketplace = Marketplace(3, **self.options)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+
+        self.assertEqual(marketplace.publish_many(producer, self.first_product, 5), 3)
+        self.assertEqual(marketplace.publish_many(producer, self.first_product, 1), 0)
+
+        self.assertEqual(marketplace.add_to_cart_many(cart, self.first_product, 2), 2)
+        self.assertEqual(marketplace.add_to_cart_many(cart, self.first_product, 2), 1)
+        self.assertEqual(marketplace.add_to_cart_many(cart, self.second_product, 1), 0)
+        self.assertEqual(marketplace.producers_list[producer], 0)
+
+        self.assertEqual(marketplace.remove_from_cart_many(cart, self.first_product, 2), 2)
+        self.assertEqual(marketplace.producers_list[producer], 2)
+        self.assertEqual(marketplace.place_order(cart), [self.first_product])
+        self.assertEqual(len(marketplace.products_list), 2)
+
+    def test_order_summary(self):
+        """
+        Tests that an order can be summed up per product and that emptied lines go away
+        """
+        producers = [self.marketplace.register_producer() for _ in range(2)]
+        cart = self.marketplace.new_cart()
+        for producer in producers:
+            self.marketplace.publish_many(producer, self.first_product, 3)
+        self.marketplace.publish(producers[0], self.second_product)
+
+        self.assertEqual(self.marketplace.add_to_cart_many(cart, self.first_product, 5), 5)
+        self.assertTrue(self.marketplace.add_to_cart(cart, self.second_product))
+        self.assertEqual(self.marketplace.place_order(cart, summary=True),
+                         [(self.first_product, 5), (self.second_product, 1)])
+
+        self.assertEqual(self.marketplace.remove_from_cart_many(cart, self.second_product, 3), 1)
+        self.assertEqual(self.marketplace.remove_from_cart_many(cart, self.first_product, 2), 2)
+        self.assertEqual(self.marketplace.place_order(cart, summary=True),
+                         [(self.first_product, 3)])
+        self.assertEqual(self.marketplace.place_order(cart), [self.first_product] * 3)
+        self.assertEqual(list(self.marketplace.producers_list), [3, 1])
+
+    def test_stats(self):
+        """
+        Tests that an instrumented marketplace counts its calls, their results and its locks
+        """
+        self.assertEqual(self.marketplace.stats(), {"inventory": {}})
+
+        marketplace = Marketplace(1, instrument=True, **self.options)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+        self.assertTrue(marketplace.publish(producer, self.first_product))
+        self.assertFalse(marketplace.publish(producer, self.first_product))
+        self.assertFalse(marketplace.add_to_cart(cart, self.second_product))
+
+        stats = marketplace.stats()
+        self.assertEqual(stats["calls"]["publish"]["count"], 2)
+        self.assertEqual(sum(stats["calls"]["publish"]["buckets"].values()), 2)
+        self.assertEqual(stats["results"]["publish"], {"success": 1, "failure": 1})
+        self.assertEqual(stats["results"]["add_to_cart"], {"success": 0, "failure": 1})
+        self.assertGreater(stats["locks"]["producer"]["acquisitions"], 0)
+        self.assertEqual(stats["inventory"], {producer: 1})
+
+        text = exposition(stats)
+        self.assertIn('marketplace_call_results_total{method="publish",result="success"} 1', text)
+        self.assertIn('marketplace_call_duration_seconds_count{method="publish"} 2', text)
+        self.assertIn(f'marketplace_inventory_depth{{producer="{producer}"}} 1', text)
+
+    def test_equal_products(self):
+        """
+        Tests that products equal to a published one, but built separately, match it
+        """
+        producer = self.marketplace.register_producer()
+        cart = self.marketplace.new_cart()
+        self.marketplace.publish(producer, Coffee("Brasil", 1, "5.09", "MEDIUM"))
+
+        self.assertTrue(self.marketplace.add_to_cart(cart, self.first_product))
+        self.marketplace.remove_from_cart(cart, Coffee("Brasil", 1, "5.09", "MEDIUM"))
+        self.assertEqual(self.marketplace.place_order(cart), [])
+        self.assertEqual(len(self.marketplace.products_list), 1)
+
+    def test_product_registry(self):
+        """
+        Tests that the registry gives equal products one id and that products are slotted
+        """
+        registry = ProductRegistry()
+        first_id = registry.intern(self.first_product)
+
+        self.assertEqual(registry.intern(Coffee("Brasil", 1, "5.09", "MEDIUM")), first_id)
+        self.assertNotEqual(registry.intern(self.second_product), first_id)
+        self.assertIs(registry.product(first_id), self.first_product)
+        self.assertFalse(hasattr(self.first_product, "__dict__"))
+        self.assertEqual(hash(self.first_product), hash(Coffee("Brasil", 1, "5.09", "MEDIUM")))
+
+    def test_admission_policies(self):
+        """
+        Tests the global, per-product, fair share and combined admission policies
+        """
+        marketplace = Marketplace(10, admission=GlobalCap(3), **self.options)
+        producers = [marketplace.register_producer() for _ in range(2)]
+        cart = marketplace.new_cart()
+        self.assertEqual(marketplace.publish_many(producers[0], self.first_product, 2), 2)
+        self.assertEqual(marketplace.publish_many(producers[1], self.second_product, 2), 1)
+        self.assertTrue(marketplace.add_to_cart(cart, self.first_product))
+        self.assertEqual(marketplace.publish_many(producers[1], self.second_product, 2), 1)
+        # units removed from a cart go back on sale even when the marketplace is full
+        marketplace.remove_from_cart(cart, self.first_product)
+        self.assertEqual(list(marketplace.producers_list), [2, 2])
+        self.assertEqual(marketplace.admission.on_sale, 4)
+
+        marketplace = Marketplace(10, admission=PerProductCap(2), **self.options)
+        producers = [marketplace.register_producer() for _ in range(2)]
+        self.assertEqual(marketplace.publish_many(producers[0], self.first_product, 3), 2)
+        self.assertEqual(marketplace.publish_many(producers[1], self.first_product, 3), 0)
+        self.assertEqual(marketplace.publish_many(producers[1], self.second_product, 3), 2)
+
+        marketplace = Marketplace(10, admission=FairShare(6, weights={0: 2}), **self.options)
+        producers = [marketplace.register_producer() for _ in range(2)]
+        self.assertEqual(marketplace.publish_many(producers[0], self.first_product, 9), 4)
+        self.assertEqual(marketplace.publish_many(producers[1], self.first_product, 9), 2)
+
+        policy = AllOf(PerProducerCap(2), GlobalCap(3))
+        marketplace = Marketplace(10, admission=policy, **self.options)
+        producers = [marketplace.register_producer() for _ in range(2)]
+        self.assertEqual(marketplace.publish_many(producers[0], self.first_product, 5), 2)
+        self.assertEqual(marketplace.publish_many(producers[1], self.first_product, 5), 1)
+        self.assertEqual(policy.policies[1].on_sale, 3)
+
+        class Unlimited(AdmissionPolicy):  # pylint: disable=abstract-method
+            """
+            A policy that forgot to define reserve()
+            """
+
+        with self.assertRaises(TypeError):
+            Unlimited()  # pylint: disable=abstract-class-instantiated
+
+    def test_publish_wait_shared_room(self):
+        """
+        Tests that a producer waiting for room under a global cap is woken up when
+        the unit of another producer is bought, and that concurrent publishes never
+        overshoot the cap
+        """
+        marketplace = Marketplace(10, admission=GlobalCap(1), **self.options)
+        producers = [marketplace.register_producer() for _ in range(2)]
+        cart = marketplace.new_cart()
+        self.assertTrue(marketplace.publish(producers[0], self.first_product))
+
+        waiter = Thread(target=marketplace.publish_wait, args=(producers[1], self.second_product))
+        waiter.start()
+        self.assertTrue(marketplace.add_to_cart(cart, self.first_product))
+        waiter.join(timeout=5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(marketplace.products_list,
+                         [{'id': producers[1], 'product': self.second_product}])
+
+        marketplace = Marketplace(10, admission=GlobalCap(50), **self.options)
+        producers = [marketplace.register_producer() for _ in range(8)]
+        publishers = [Thread(target=lambda producer=producer: [
+            marketplace.publish(producer, self.first_product) for _ in range(20)])
+                      for producer in producers]
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+        self.assertEqual(sum(marketplace.producers_list), 50)
+        self.assertEqual(len(marketplace.products_list), 50)
+
+    def test_waitlist_handoff(self):
+        """
+        Tests that in waitlist mode published units go to the waiting carts, oldest first,
+        and are claimed by their next add
+        """
+        marketplace = Marketplace(10, waitlist=True, **self.options)
+        producer = marketplace.register_producer()
+        carts = [marketplace.new_cart() for _ in range(2)]
+        self.assertEqual(marketplace.add_to_cart_many(carts[0], self.first_product, 2), 0)
+        self.assertFalse(marketplace.add_to_cart(carts[1], self.first_product))
+
+        self.assertEqual(marketplace.publish_many(producer, self.first_product, 4), 4)
+        # the handed units left the producer's queue, the fourth one is on sale
+        self.assertEqual(marketplace.producers_list[producer], 1)
+        self.assertEqual(marketplace.products_list,
+                         [{'id': producer, 'product': self.first_product}])
+        self.assertEqual(marketplace.add_to_cart_many(carts[0], self.first_product, 2), 2)
+        self.assertEqual(marketplace.add_to_cart_many(carts[1], self.first_product, 2), 2)
+        self.assertEqual(marketplace.place_order(carts[1], summary=True),
+                         [(self.first_product, 2)])
+
+        # a removed unit is handed over too
+        self.assertFalse(marketplace.add_to_cart(carts[0], self.first_product))
+        marketplace.remove_from_cart(carts[1], self.first_product)
+        self.assertTrue(marketplace.add_to_cart(carts[0], self.first_product))
+        self.assertEqual(marketplace.place_order(carts[0]), [self.first_product] * 3)
+        self.assertEqual(marketplace.products_list, [])
+
+    def test_waitlist_wait(self):
+        """
+        Tests that add_to_cart_wait in waitlist mode is handed the next unit and that
+        a timed out wait gives up its place
+        """
+        marketplace = Marketplace(10, waitlist=True, **self.options)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+
+        self.assertFalse(marketplace.add_to_cart_wait(cart, self.second_product, timeout=0.01))
+        self.assertTrue(marketplace.publish(producer, self.second_product))
+        self.assertEqual(len(marketplace.products_list), 1)
+        self.assertTrue(marketplace.add_to_cart(cart, self.second_product))
+
+        waiter = Thread(target=marketplace.add_to_cart_wait, args=(cart, self.first_product))
+        waiter.start()
+        # publish only once the waiter is queued, or the unit would simply go on sale
+        while not any(marketplace.tickets):
+            waiter.join(timeout=0.001)
+        self.assertTrue(marketplace.publish(producer, self.first_product))
+        waiter.join(timeout=5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(marketplace.place_order(cart),
+                         [self.second_product, self.first_product])
+        self.assertEqual(marketplace.products_list, [])
+
+    def test_trace(self):
+        """
+        Tests that a traced marketplace records its calls and that the trace reads back,
+        oldest first, once its ring has wrapped
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            trace = TraceRecorder(os.path.join(directory, "trace"), capacity=4)
+            marketplace = Marketplace(10, trace=trace, **self.options)
+            producer = marketplace.register_producer()
+            cart = marketplace.new_cart()
+            self.assertFalse(marketplace.add_to_cart(cart, self.first_product))
+            self.assertEqual(marketplace.publish_many(producer, self.first_product, 2), 2)
+            self.assertEqual(marketplace.add_to_cart_many(cart, self.first_product, 3), 2)
+            marketplace.remove_from_cart(cart, self.first_product)
+            marketplace.place_order(cart, summary=True)
+            trace.close()
+            marketplace.publish(producer, self.first_product)
+
+            result = read_trace(os.path.join(directory, "trace"))
+
+        self.assertEqual([result["written"], result["lost"]], [7, 3])
+        self.assertEqual(result["products"], [str(self.first_product)])
+        self.assertEqual([(OPS[op], actor, product_id, quantity, outcome)
+                          for [_, _, op, actor, product_id, quantity, outcome]
+                          in result["records"]],
+                         [("publish_many", producer, 0, 2, 2),
+                          ("add_to_cart_many", cart, 0, 3, 2),
+                          ("remove_from_cart", cart, 0, 1, -1),
+                          ("place_order", cart, -1, 1, 1)])
+        times = [record[0] for record in result["records"]]
+        self.assertEqual(times, sorted(times))
+
+    def test_unclosed_trace(self):
+        """
+        Tests that the records of a trace that was never closed, as after a crash, read back
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            trace = TraceRecorder(os.path.join(directory, "trace"), capacity=4)
+            marketplace = Marketplace(10, trace=trace, **self.options)
+            producer = marketplace.register_producer()
+            for _ in range(5):
+                marketplace.publish(producer, self.first_product)
+
+            result = read_trace(os.path.join(directory, "trace"))
+            trace.map.close()
+            trace.file.close()
+
+        self.assertEqual([result["written"], result["lost"], result["products"]], [6, 2, []])
+        self.assertEqual([OPS[record[2]] for record in result["records"]], ["publish"] * 4)
+
+
+class TestShardedMarketPlace(TestMarketPlace):
+    """
+    Runs the same tests against a marketplace with striped/per-actor locks
+    """
+    options = {"sharded": True, "stripes": 4}
+
+    def test_independent_locks(self):
+        """
+        Tests that producers and carts get their own locks and that different
+        products can land on different stripes
+        """
+        producers = [self.marketplace.register_producer() for _ in range(2)]
+        carts = [self.marketplace.new_cart() for _ in range(2)]
+
+        self.assertIsNot(self.marketplace.producers_locks[producers[0]],
+                         self.marketplace.producers_locks[producers[1]])
+        self.assertIsNot(self.marketplace.carts_locks[carts[0]],
+                         self.marketplace.carts_locks[carts[1]])
+        self.assertEqual(len(self.marketplace.products_locks), 4)
+        self.assertIsNone(self.marketplace.products_lock)
+
+    def test_stripe_stats(self):
+        """
+        Tests that the lock counters of an instrumented sharded marketplace are kept per
+        stripe, so that a hot stripe stands out
+        """
+        marketplace = Marketplace(2, instrument=True, **self.options)
+        producer = marketplace.register_producer()
+        stripe = marketplace.registry.intern(self.first_product) % 4
+        for _ in range(2):
+            self.assertTrue(marketplace.publish(producer, self.first_product))
+
+        stripes = marketplace.stats()["locks"]["products"]["indexed"]
+        self.assertEqual(sorted(stripes), [0, 1, 2, 3])
+        self.assertEqual([index for index, lock in stripes.items() if lock["acquisitions"]],
+                         [stripe])
+        self.assertIn(f'marketplace_lock_acquisitions_total{{lock="products",index="{stripe}"}} 2',
+                      exposition(marketplace.stats()))
+
+
+class TestCompactMarketPlace(TestMarketPlace):
+    """
+    Runs the same tests against a marketplace that keeps its units in ArrayQueues
+    """
+    options = {"compact": True}
+
+    def test_array_queue(self):
+        """
+        Tests that an ArrayQueue is a FIFO that drops its popped items as it goes
+        """
+        queue = ArrayQueue([1, 2])
+        queue.extend(range(3, 200))
+        self.assertEqual(queue.popleft(), 1)
+        self.assertEqual(queue.popleft_many(3), [2, 3, 4])
+        self.assertEqual(popleft_many(queue, 100), list(range(5, 105)))
+        self.assertEqual(len(queue.items), 95)
+        self.assertEqual(list(queue), list(range(105, 200)))
+        self.assertEqual(queue.popleft_many(1000), list(range(105, 200)))
+        self.assertFalse(queue)
+        self.assertRaises(IndexError, queue.popleft)
+
+        producer = self.marketplace.register_producer()
+        self.marketplace.publish_many(producer, self.first_product, 3)
+        # the class the marketplace imported, tema.array_queue when run from skel/
+        units = self.marketplace.products_index[0][0]
+        self.assertIs(type(units), self.marketplace.queue_type)
+        self.assertEqual(type(units).__name__, "ArrayQueue")
+
+
+class TestFederatedMarketPlace(unittest.TestCase):
+    """
+    Tests the marketplace sharded by product over several Marketplaces
+    """
+
+    def setUp(self):
+        """
+        Sets up a federated marketplace of two shards, with products on both of them
+        """
+        self.marketplace = FederatedMarketplace(3, shards=2)
+        self.products = [Tea(f"Tea {i}", i, "Green") for i in range(12)]
+        shards = {self.marketplace.shards.index(self.marketplace.shard_of(product))
+                  for product in self.products}
+        self.assertEqual(shards, {0, 1})
+
+    def test_hash_ring(self):
+        """
+        Tests that a new shard takes keys only from the others, and some of them
+        """
+        keys = [f"key {i}" for i in range(200)]
+        ring = HashRing().with_shard(0).with_shard(1)
+        bigger = ring.with_shard(2)
+        moved = [key for key in keys if ring.owner(key) != bigger.owner(key)]
+        self.assertTrue(moved)
+        self.assertTrue(all(bigger.owner(key) == 2 for key in moved))
+
+    def test_shared_cap(self):
+        """
+        Tests that the producer's queue size holds over all the shards and that a cart
+        gathers its products from all of them
+        """
+        producer = self.marketplace.register_producer()
+        cart = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.publish_many(producer, self.products[0], 2), 2)
+        self.assertEqual(sum(self.marketplace.publish(producer, product)
+                             for product in self.products[1:]), 1)
+        self.assertFalse(self.marketplace.publish(producer, self.products[0]))
+        self.assertEqual(self.marketplace.stats()["inventory"], {producer: 3})
+
+        for product in self.products:
+            self.marketplace.add_to_cart(cart, product)
+        self.assertEqual(len(self.marketplace.carts_list[cart]), 2)
+        self.assertTrue(self.marketplace.publish(producer, self.products[0]))
+        self.assertTrue(self.marketplace.add_to_cart_wait(cart, self.products[0], timeout=1))
+        self.marketplace.remove_from_cart(cart, self.products[0])
+        self.assertEqual(len(self.marketplace.place_order(cart)), 2)
+        self.assertEqual(sum(quantity for _, quantity
+                             in self.marketplace.place_order(cart, summary=True)), 2)
+        self.assertEqual(ProducerCap(3).reserve(producer, 0, 5, 0), 3)
+
+    def test_add_shard_keeps_room(self):
+        """
+        Tests that the units a new shard takes over keep their room in the producer's
+        queue while they move, so that no other unit can take it
+        """
+        producer = self.marketplace.register_producer()
+        for product in self.products[:3]:
+            self.assertTrue(self.marketplace.publish(producer, product))
+        with mock.patch.object(self.marketplace.admission, "release",
+                               side_effect=AssertionError("the room was freed")):
+            self.assertGreater(sum(self.marketplace.add_shard() for _ in range(3)), 0)
+        self.assertFalse(any(self.marketplace.publish(producer, product)
+                             for product in self.products))
+        self.assertEqual(self.marketplace.stats()["inventory"], {producer: 3})
+
+    def test_stats(self):
+        """
+        Tests that the stats of every shard are exported, with a shard label
+        """
+        marketplace = FederatedMarketplace(3, shards=2, instrument=True)
+        producer = marketplace.register_producer()
+        self.assertTrue(marketplace.publish(producer, self.products[0]))
+        shard = marketplace.shards.index(marketplace.shard_of(self.products[0]))
+
+        text = exposition(marketplace.stats())
+        self.assertIn(f'marketplace_call_results_total{{shard="{shard}",method="publish",'
+                      f'result="success"}} 1', text)
+        self.assertIn(f'marketplace_call_duration_seconds_count{{shard="{1 - shard}",'
+                      f'method="register_producer"}} 1', text)
+        self.assertIn(f'marketplace_inventory_depth{{shard="{shard}",producer="{producer}"}} 1',
+                      text)
+        self.assertIn(f'marketplace_inventory_depth{{producer="{producer}"}} 1', text)
+
+    def test_add_shard(self):
+        """
+        Tests that a new shard takes over the units on sale of its products, and that
+        units of a moved product left in a cart go back on sale in the new shard
+        """
+        marketplace = FederatedMarketplace(100, shards=2)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+        for product in self.products:
+            marketplace.publish_many(producer, product, 2)
+            marketplace.add_to_cart(cart, product)
+        before = sorted(str(entry["product"]) for entry in marketplace.products_list)
+
+        self.assertGreater(marketplace.add_shard(), 0)
+        new_shard = marketplace.shards[2]
+        moved = [product for product in self.products
+                 if marketplace.shard_of(product) is new_shard]
+        self.assertEqual(len(new_shard.products_list), len(moved))
+        self.assertEqual(sorted(str(entry["product"]) for entry in marketplace.products_list),
+                         before)
+        self.assertEqual(marketplace.new_cart(), cart + 1)
+
+        self.assertEqual(marketplace.remove_from_cart_many(cart, moved[0], 5), 1)
+        self.assertEqual(len(new_shard.products_list), len(moved) + 1)
+        self.assertEqual(marketplace.add_to_cart_many(cart, moved[0], 2), 2)
+        self.assertEqual(len(marketplace.place_order(cart)), len(self.products) + 1)
+        self.assertEqual(marketplace.stats()["inventory"], {producer: len(self.products) - 1})
+
+    def test_idle_resizes(self):
+        """
+        Tests that products nobody calls between resizes still follow their new shards
+        """
+        marketplace = FederatedMarketplace(10, shards=1)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+        for product in self.products[:10]:
+            marketplace.publish(producer, product)
+        for _ in range(5):
+            marketplace.add_shard()
+
+        self.assertEqual(sum(marketplace.add_to_cart(cart, product)
+                             for product in self.products[:10]), 10)
+        self.assertEqual(marketplace.stats()["inventory"], {producer: 0})
+
+
+class TestConsumerPool(unittest.TestCase):
+    """
+    Tests running consumers as tasks on a few threads
+    """
+
+    def test_parked_consumers(self):
+        """
+        Tests that more consumers than workers all wait for a late producer and place
+        their orders, parked instead of holding a worker while they wait
+        """
+        marketplace = Marketplace(100)
+        # the names of the threads the consumers' adds ran on
+        [workers, add_to_cart_many] = [set(), marketplace.add_to_cart_many]
+
+        def add_recorded(*args):
+            workers.add(current_thread().name)
+            return add_to_cart_many(*args)
+        marketplace.add_to_cart_many = add_recorded
+        product = Tea("Linden", 9, "Herbal")
+        output = io.StringIO()
+        order_sink = OrderSink(output)
+        pool = ConsumerPool(workers=2)
+        carts = [[{"type": "add", "product": product, "quantity": 2},
+                  {"type": "remove", "product": product, "quantity": 1}]]
+        for i in range(20):
+            pool.submit(PooledConsumer(carts, marketplace, 0.01, order_sink=order_sink,
+                                       name=f"cons{i}"))
+
+        time.sleep(0.05)
+        producer = marketplace.register_producer()
+        self.assertEqual(marketplace.publish_many(producer, product, 40), 40)
+        pool.join()
+        pool.shutdown()
+        order_sink.close()
+
+        self.assertEqual(output.getvalue().count("bought"), 20)
+        self.assertEqual(len(marketplace.products_list), 20)
+        self.assertLessEqual(len(workers), 2)
+        self.assertTrue(all(name.startswith("consumer-pool") for name in workers))
+
+
+class TestVirtualClock(unittest.TestCase):
+    """
+    Tests the simulated clock
+    """
+
+    def test_wake_up_order(self):
+        """
+        Tests that the clock jumps to each wake-up once every actor sleeps, in order
+        """
+        clock = VirtualClock()
+        woken = []
+
+        def actor(name, delays):
+            for delay in delays:
+                clock.sleep(delay)
+                woken.append((clock.time(), name))
+            clock.unregister()
+
+        threads = [Thread(target=actor, args=("slow", [100, 100])),
+                   Thread(target=actor, args=("fast", [30, 30, 30]))]
+        for thread in threads:
+            clock.register()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(woken, [(30, "fast"), (60, "fast"), (90, "fast"),
+                                 (100, "slow"), (200, "slow")])
+
+    def test_producer_pacing(self):
+        """
+        Tests that a producer puts a unit on sale only once it is made, one every
+        wait_time, and the units made while its queue was full in one call
+        """
+        clock = VirtualClock()
+        marketplace = Marketplace(10, log_every=0)
+        producer = Producer([], marketplace, 0.5, clock=clock)
+        [calls, publish_many] = [[], marketplace.publish_many]
+
+        def publish_until_full(producer_id, product, quantity):
+            calls.append((clock.time(), quantity))
+            # the queue is full from the second unit until the time 3
+            if calls[1:] and clock.time() < 3:
+                return 0
+            return publish_many(producer_id, product, quantity)
+
+        marketplace.publish_many = publish_until_full
+        producer.publish_product(Tea("Linden", 9, "Herbal"), 6, 1.0, producer.producer_id)
+        self.assertEqual(calls, [(0, 1), (1, 1), (1.5, 1), (2, 2), (2.5, 2), (3, 3),
+                                 (4, 1), (5, 1)])
+        self.assertEqual(clock.time(), 6)
+
+
+class TestSimulation(unittest.TestCase):
+    """
+    Tests the discrete-event simulation engine
+    """
+
+    def simulate(self, seed, queue_size=10, **options):
+        """
+        Runs two producers and two consumers competing for the same products, options
+        being other arguments of the SimulatedMarketplace
+        """
+        coffee = Coffee("Brasil", 1, "5.09", "MEDIUM")
+        tea = Tea("Wild Cherry", 4, "Wild Cherry")
+        marketplace = SimulatedMarketplace(queue_size, seed=seed, log_every=0, **options)
+        producers = [SimulatedProducer([(coffee, 3, 0.1), (tea, 1, 0.2)], marketplace, 0.3)
+                     for _ in range(2)]
+        consumers = [SimulatedConsumer([[{"type": "add", "product": coffee, "quantity": 4},
+                                         {"type": "add", "product": tea, "quantity": 2},
+                                         {"type": "remove", "product": coffee, "quantity": 1}]],
+                                       marketplace, 0.25, name=f"cons{i}")
+                     for i in range(2)]
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            end = run_simulation(marketplace, producers, consumers)
+        return end, output.getvalue()
+
+    def test_reproducible(self):
+        """
+        Tests that a seed always gives the same run and that every order is complete
+        """
+        [end, output] = self.simulate(7)
+        self.assertEqual(self.simulate(7), (end, output))
+        self.assertGreater(end, 0)
+        for name in ["cons0", "cons1"]:
+            self.assertEqual(output.count(f"{name} bought Coffee"), 3)
+            self.assertEqual(output.count(f"{name} bought Tea"), 2)
+
+    def test_deadlock(self):
+        """
+        Tests that a run whose producers' queues fill up with unwanted units stops
+        """
+        with self.assertRaises(RuntimeError):
+            self.simulate(7, queue_size=2)
+
+    def test_trace(self):
+        """
+        Tests that a simulated run is traced in simulated time, where the calls take none
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            simulation = Simulation(7)
+            trace = TraceRecorder(os.path.join(directory, "trace"), clock=simulation)
+            run = self.simulate(7, simulation=simulation, trace=trace)
+            trace.close()
+            records = read_trace(os.path.join(directory, "trace"))["records"]
+
+        self.assertEqual(run, self.simulate(7))
+        self.assertEqual(max(record[0] for record in records), run[0])
+        self.assertEqual({record[1] for record in records}, {0})
+
+
+class TestOrderSink(unittest.TestCase):
+    """
+    Tests the buffered order writer
+    """
+
+    def test_orders(self):
+        """
+        Tests that the submitted orders are written whole, in order or sorted
+        """
+        coffee = Coffee("Brasil", 1, "5.09", "MEDIUM")
+        tea = Tea("Wild Cherry", 4, "Wild Cherry")
+        for sort in [False, True]:
+            output = io.StringIO()
+            sink = OrderSink(output, sort=sort)
+            sink.submit("cons2", [(tea, 1)])
+            sink.submit("cons1", [(coffee, 2), (tea, 1)])
+            sink.close()
+
+            lines = [f"cons2 bought {tea}", f"cons1 bought {coffee}", f"cons1 bought {coffee}",
+                     f"cons1 bought {tea}"]
+            self.assertEqual(output.getvalue().splitlines(), sorted(lines) if sort else lines)
+
+
+class TestSharedMarketPlace(unittest.TestCase):
+    """
+    Tests the shared-memory marketplace of the process runtime
+    """
+
+    def test_operations(self):
+        """
+        Tests the queue limit, the stock moves and the provenance of returned units
+        """
+        first_product = Coffee("Brasil", 1, "5.09", "MEDIUM")
+        second_product = Tea("Wild Cherry", 4, "Wild Cherry")
+        marketplace = SharedMarketplace(2, [first_product, second_product], max_producers=2)
+        producers = [marketplace.register_producer(), marketplace.register_producer()]
+        cart = marketplace.new_cart()
+
+        self.assertEqual(marketplace.publish_many(producers[0], first_product, 3), 2)
+        self.assertTrue(marketplace.publish(producers[1], first_product))
+        self.assertFalse(marketplace.add_to_cart(cart, second_product))
+
+        self.assertEqual(marketplace.add_to_cart_many(cart, first_product, 3), 3)
+        self.assertEqual(list(marketplace.producers_list), [0, 0])
+
+        marketplace.remove_from_cart(cart, first_product)
+        self.assertEqual(list(marketplace.producers_list), [1, 0])
+        self.assertEqual(marketplace.place_order(cart), [first_product, first_product])
+        self.assertRaises(ValueError, marketplace.register_producer)
+
+    def test_dead_worker(self):
+        """
+        Tests that run_processes raises instead of waiting forever for a worker that died
+        """
+        product = Coffee("Brasil", 1, "5.09", "MEDIUM")
+        marketplace = SharedMarketplace(1, [product], max_producers=1)
+        consumer = {"carts": [], "retry_wait_time": 0.01, "kwargs": {"name": "cons1"}}
+
+        def die(*_args, **_kwargs):
+            os._exit(3)  # pylint: disable=protected-access
+
+        with mock.patch.object(process_marketplace, "_worker", die), \
+                mock.patch.object(process_marketplace, "RESULT_POLL_S", 0.01):
+            with self.assertRaisesRegex(RuntimeError, "exited with code 3"):
+                process_marketplace.run_processes(marketplace, [], [consumer], workers=1)
+
+class TestAsyncMarketPlace(unittest.IsolatedAsyncioTestCase):
+    """
+    Tests the awaitable calls of the asyncio marketplace
+    """
+
+    async def test_wait_calls(self):
+        """
+        Tests that waiting coroutines are resumed by the operations that make room or stock
+        """
+        marketplace = AsyncMarketplace(1)
+        product = Coffee("Brasil", 1, "5.09", "MEDIUM")
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+
+        self.assertFalse(await marketplace.add_to_cart_wait(cart, product, timeout=0.01))
+
+        waiter = asyncio.create_task(marketplace.add_to_cart_wait(cart, product))
+        await asyncio.sleep(0)
+        self.assertTrue(await marketplace.publish_wait(producer, product))
+        self.assertTrue(await asyncio.wait_for(waiter, 5))
+
+        self.assertTrue(marketplace.publish(producer, product))
+        waiter = asyncio.create_task(marketplace.publish_wait(producer, product))
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        self.assertTrue(marketplace.add_to_cart(cart, product))
+        self.assertTrue(await asyncio.wait_for(waiter, 5))
+        self.assertEqual(marketplace.place_order(cart), [product, product])
+
+    async def test_stats(self):
+        """
+        Tests that an instrumented asyncio marketplace counts its awaitable calls
+        """
+        marketplace = AsyncMarketplace(1, instrument=True)
+        product = Coffee("Brasil", 1, "5.09", "MEDIUM")
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+
+        self.assertTrue(await marketplace.publish_wait(producer, product))
+        self.assertFalse(await marketplace.publish_wait(producer, product, timeout=0.01))
+        self.assertTrue(await marketplace.add_to_cart_wait(cart, product))
+
+        stats = marketplace.stats()
+        self.assertEqual(stats["results"]["publish_wait"], {"success": 1, "failure": 1})
+        self.assertEqual(stats["results"]["add_to_cart_wait"], {"success": 1, "failure": 0})
+        self.assertGreaterEqual(stats["calls"]["publish_wait"]["sum_s"], 0.01)
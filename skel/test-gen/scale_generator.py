@@ -0,0 +1,242 @@
+"""
+Generates large tests for load testing the marketplace.
+
+Unlike test_generator.py, the product names are synthetic, so there can be any number of
+products, every random value is drawn in batches with NumPy, and the expected carts are
+computed on arrays. The input (.in) and reference output (.ref.out) files are written as
+streams, with the marketplace and the products first, so config_loader.py can start the
+producers and consumers while the rest of the input is still being read.
+
+Every producer supplies a single product, so a producer's queue only ever waits for the
+consumers of one product and the test cannot deadlock; there must be at least as many
+producers as products.
+
+Script input
+    - test file name
+    - number of producers, consumers and products
+    - marketplace queue
+    - min and max number of carts per consumer
+    - max number of add operations per cart and max quantity per operation
+    - the share of the carts that end with a removal
+"""
+import argparse
+import json
+
+import numpy as np
+
+from test_utils import *  # pylint: disable=wildcard-import, unused-wildcard-import
+from config_loader import make_product
+
+# the range of the producers' and consumers' wait times, as in test_generator.py
+WAIT_TIME_RANGE = (0.05, 0.4)
+
+
+def parse_input():
+    """
+    Parses command line input and returns the arguments
+    """
+    parser = argparse.ArgumentParser(description="Generates a large test, quickly")
+    parser.add_argument(ARG_TEST_NAME, type=str, help="Test file name (no extension)")
+    parser.add_argument("--producers", type=int, default=1000, help="number of producers")
+    parser.add_argument("--consumers", type=int, default=1000, help="number of consumers")
+    parser.add_argument("--products", type=int, default=1000, help="number of products")
+    parser.add_argument("--marketplace-q", type=int, default=DEFAULT_MARKETPLACE_QUEUE_SIZE,
+                        help="queue size in the marketplace for each producer")
+    parser.add_argument("--min-carts", type=int, default=1,
+                        help="minimum number of carts per consumer")
+    parser.add_argument("--max-carts", type=int, default=100,
+                        help="maximum number of carts per consumer")
+    parser.add_argument("--max-ops", type=int, default=10,
+                        help="maximum number of add operations per cart")
+    parser.add_argument("--max-quantity", type=int, default=10,
+                        help="maximum quantity of an operation")
+    parser.add_argument("--removal-rate", type=float, default=0.5,
+                        help="the share of the carts that end with a removal")
+    parser.add_argument("--seed", type=int, default=0, help="the random seed")
+    parser.add_argument("--tests-dir", default=TESTS_DIR, help="where the files are written")
+
+    args = parser.parse_args()
+    if min(args.producers, args.consumers, args.products, args.marketplace_q,
+           args.min_carts, args.max_ops, args.max_quantity) <= 0 \
+            or args.max_carts < args.min_carts or not 0 <= args.removal_rate <= 1:
+        parser.error("invalid arguments")
+    if args.producers < args.products:
+        parser.error("every product needs a producer: use at least as many producers as products")
+    return args
+
+
+def generate_products(rng, count):
+    """
+    Generates count products, half coffee and half tea as in test_generator.py, with a
+    number appended to their names to tell them apart
+
+    :return: the products' configurations, by position
+    """
+    coffees = (count + 1) // 2
+    [coffee_names, tea_names] = [np.array(COFFEE_NAMES), np.array(list(TEA_NAMES_TYPES))]
+    names = np.concatenate([coffee_names[rng.integers(0, len(coffee_names), coffees)],
+                            tea_names[rng.integers(0, len(tea_names), count - coffees)]])
+    prices = rng.integers(1, 11, count).tolist()
+    acidities = rng.uniform(MIN_ACIDITY, MAX_ACIDITY, coffees).round(2).tolist()
+    roast_levels = rng.integers(0, len(ROAST_LEVEL), coffees).tolist()
+
+    products = []
+    for i, name in enumerate(names.tolist()):
+        product = {"name": f"{name} {i + 1}", "price": prices[i]}
+        if i < coffees:
+            product.update(product_type="Coffee", acidity=acidities[i],
+                           roast_level=ROAST_LEVEL[roast_levels[i]])
+        else:
+            product.update(product_type="Tea", type=TEA_NAMES_TYPES[name])
+        products.append(product)
+    return products
+
+
+def generate_producers(rng, count, products, max_quantity):
+    """
+    Generates the producers; producer i supplies the product i modulo products
+
+    :return: the producers' configurations
+    """
+    quantities = rng.integers(1, max_quantity + 1, count).tolist()
+    [make_times, wait_times] = rng.uniform(*WAIT_TIME_RANGE, (2, count)).round(2).tolist()
+    return [{"name": f"{PRODUCER_NAME_PREFIX}{i + 1}",
+             "products": [[f"{PRODUCT_PREFIX}{i % products + 1}", quantities[i], make_times[i]]],
+             "republish_wait_time": wait_times[i]}
+            for i in range(count)]
+
+
+def generate_carts(rng, args):
+    """
+    Draws every cart operation at once. The carts of a consumer are consecutive, and so
+    are the operations of a cart: its adds, then maybe a removal of part of one of them.
+
+    :return: a dict of arrays, with the carts of each consumer, the operations of each
+    cart (as offsets into the operation arrays) and the operations' product, quantity
+    and type (True for a removal)
+    """
+    carts = rng.integers(args.min_carts, args.max_carts + 1, args.consumers)
+    cart_count = int(carts.sum())
+    adds = rng.integers(1, args.max_ops + 1, cart_count)
+    add_starts = np.concatenate([[0], np.cumsum(adds)[:-1]])
+    add_count = int(adds.sum())
+    add_products = rng.integers(0, args.products, add_count)
+    add_quantities = rng.integers(1, args.max_quantity + 1, add_count)
+
+    # a removal takes back part of one of the cart's adds, so it never exceeds the cart
+    removing = np.flatnonzero(rng.random(cart_count) < args.removal_rate)
+    targets = add_starts[removing] + (rng.random(len(removing)) * adds[removing]).astype(int)
+    removed = 1 + (rng.random(len(removing)) * add_quantities[targets]).astype(int)
+
+    # the removals go after the adds of their carts; a stable sort keeps everything else
+    op_carts = np.concatenate([np.repeat(np.arange(cart_count), adds), removing])
+    order = np.argsort(op_carts, kind="stable")
+    ops = adds.copy()
+    ops[removing] += 1
+    return {"carts": carts, "ops": ops, "cart_of_op": op_carts[order],
+            "products": np.concatenate([add_products, add_products[targets]])[order],
+            "quantities": np.concatenate([add_quantities, removed])[order],
+            "removals": (np.arange(len(order)) >= add_count)[order]}
+
+
+def expected_totals(args, operations):
+    """
+    Computes what each consumer buys: the quantities added minus those removed, summed
+    per consumer and product. A removal never takes more than its cart holds, so the
+    carts need not be summed on their own first.
+
+    :return: the consumers, products and quantities of the bought units
+    """
+    consumer_of_op = np.repeat(np.arange(args.consumers),
+                               operations["carts"])[operations["cart_of_op"]]
+    signed = np.where(operations["removals"], -operations["quantities"],
+                      operations["quantities"])
+    keys = consumer_of_op.astype(np.int64) * args.products + operations["products"]
+    [bought, inverse] = np.unique(keys, return_inverse=True)
+    quantities = np.bincount(inverse, weights=signed).astype(np.int64)
+    [consumers, products] = np.divmod(bought, args.products)
+    nonzero = quantities > 0
+    return consumers[nonzero], products[nonzero], quantities[nonzero]
+
+
+def write_input(input_file, marketplace, products, *, producers, consumer_names, operations):
+    """
+    Writes the test's input, one consumer at a time. The operations are formatted once per
+    distinct (type, product, quantity) and looked up for every cart.
+    """
+    input_file.write(f'{{\n"marketplace": {json.dumps(marketplace)},\n"products": {{\n')
+    input_file.write(",\n".join(f'"{PRODUCT_PREFIX}{i + 1}": {json.dumps(product)}'
+                                for i, product in enumerate(products)))
+    input_file.write('\n},\n"producers": [\n')
+    input_file.write(",\n".join(json.dumps(producer) for producer in producers))
+    input_file.write('\n],\n"consumers": [\n')
+
+    max_quantity = int(operations["quantities"].max())
+    formatted = np.array([json.dumps({"type": op_type, "product": f"{PRODUCT_PREFIX}{i + 1}",
+                                      "quantity": quantity})
+                          for op_type in (ADD_TO_CART_OP, REMOVE_FROM_CART_OP)
+                          for i in range(len(products))
+                          for quantity in range(1, max_quantity + 1)], dtype=object)
+    op_texts = formatted[(operations["removals"] * len(products) + operations["products"])
+                         * max_quantity + operations["quantities"] - 1].tolist()
+
+    cart_ends = np.cumsum(operations["ops"]).tolist()
+    consumer_ends = np.cumsum(operations["carts"]).tolist()
+    [cart, start] = [0, 0]
+    for i, name in enumerate(consumer_names):
+        carts = []
+        while cart < consumer_ends[i]:
+            carts.append("[" + ", ".join(op_texts[start:cart_ends[cart]]) + "]")
+            [cart, start] = [cart + 1, cart_ends[cart]]
+        retry_wait_time = operations["retry_wait_times"][i]
+        input_file.write((",\n" if i else "")
+                         + f'{{"name": "{name}", "retry_wait_time": {retry_wait_time}, '
+                         + '"carts": [\n' + ",\n".join(carts) + "]}")
+    input_file.write("\n]\n}\n")
+
+
+def write_reference(output_file, products, consumer_names, totals):
+    """
+    Writes the reference output, sorted like the one of test_generator.py. Every line is
+    "<consumer> bought <product>" and a consumer name never continues with a space, so
+    sorting the lines sorts them by consumer, then by product.
+    """
+    texts = [str(make_product(product)) for product in products]
+    [consumer_rank, product_rank] = [np.argsort(np.argsort(consumer_names)),
+                                     np.argsort(np.argsort(texts))]
+    [consumers, product_ids, quantities] = totals
+    order = np.lexsort((product_rank[product_ids], consumer_rank[consumers]))
+    for consumer, product, quantity in zip(consumers[order].tolist(),
+                                           product_ids[order].tolist(),
+                                           quantities[order].tolist()):
+        output_file.write(f"{consumer_names[consumer]} bought {texts[product]}\n" * quantity)
+
+
+def generate_test():
+    """
+    Generates the test and writes its input and reference output files
+    """
+    args = parse_input()
+    rng = np.random.default_rng(args.seed)
+
+    products = generate_products(rng, args.products)
+    producers = generate_producers(rng, args.producers, args.products, args.max_quantity)
+    operations = generate_carts(rng, args)
+    operations["retry_wait_times"] = \
+        rng.uniform(*WAIT_TIME_RANGE, args.consumers).round(2).tolist()
+    consumer_names = [f"{CONSUMER_NAME_PREFIX}{i + 1}" for i in range(args.consumers)]
+
+    with open(f"{args.tests_dir}/{args.test_name}.in", "w", encoding="utf-8") as input_file:
+        write_input(input_file, {"queue_size_per_producer": args.marketplace_q}, products,
+                    producers=producers, consumer_names=consumer_names, operations=operations)
+    with open(f"{args.tests_dir}/{args.test_name}.ref.out", "w",
+              encoding="utf-8") as output_file:
+        write_reference(output_file, products, consumer_names,
+                        expected_totals(args, operations))
+
+    print(f"{args.test_name}: {len(operations['cart_of_op'])} operations in "
+          f"{len(operations['ops'])} carts")
+
+
+if __name__ == "__main__":
+    generate_test()
@@ -54,8 +54,10 @@ def generate_test():
     for prod_id in products.keys():
         del products[prod_id]["is_produced"]
 
-    json_data = {ARG_PRODUCTS: products, ARG_PRODUCERS: producers,
-                 ARG_CONSUMERS: consumers, "marketplace": marketplace}
+    # the marketplace and the products go first, so config_loader.py can start running
+    # the producers and consumers while it is still reading them
+    json_data = {"marketplace": marketplace, ARG_PRODUCTS: products,
+                 ARG_PRODUCERS: producers, ARG_CONSUMERS: consumers}
 
     # write to json test file (tests/{test_name}.json)
     with open(f'{TESTS_DIR}/{cmdline_arguments[ARG_TEST_NAME]}.json', 'w') as json_file:
@@ -256,7 +258,6 @@ def generate_consumers(count, products, min_cart, max_cart,
         for _ in range(num_carts):
             num_operations = random.randint(1, max_operations_per_cart)
 
-            print(products.keys(), " ", num_operations)
             if len(products) < num_operations:
                 num_operations = len(products)
 
@@ -327,7 +328,6 @@ def generate_in_out_test_files(test_name):
 
     lines = []
     for consumer in conf['consumers']:
-        print("consumer" + str(consumer))
         for cart in consumer['carts']:
             for product, count in cart['expected_cart'].items():
                 lines += ([f'{consumer["name"]} bought {product}'] * count)
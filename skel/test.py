@@ -6,13 +6,26 @@ Assignment 1
 March 2020
 """
 
+import asyncio
 import sys
-from json import loads
+from argparse import ArgumentParser
+from json import dumps
+from threading import Timer
 
+from config_loader import iter_config, load_config
+from tema.async_marketplace import AsyncConsumer, AsyncMarketplace, AsyncProducer, run_market
+from tema.clock import VirtualClock
 from tema.producer import Producer
 from tema.consumer import Consumer
+from tema.consumer_pool import ConsumerPool, PooledConsumer
+from tema.federated_marketplace import FederatedMarketplace
 from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.marketplace_stats import serve_stats
+from tema.marketplace_trace import TraceRecorder
+from tema.order_sink import OrderSink
+from tema.process_marketplace import SharedMarketplace, run_processes
+from tema.simulation import Simulation, SimulatedConsumer, SimulatedMarketplace, \
+    SimulatedProducer, run_simulation
 
 
 def main():
@@ -20,54 +33,285 @@ def main():
         Convert the market_configuration input file into specific models:
         Producer, Consumer, Marketplace
     """
-    try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
+    parser = ArgumentParser(description="Run the marketplace on a test file")
+    parser.add_argument("input_file", help="the test's market configuration (.in)")
+    parser.add_argument("--blocking", action="store_true",
+                        help="producers and consumers block on the marketplace's conditions "
+                             "instead of sleeping between retries")
+    parser.add_argument("--sharded", action="store_true",
+                        help="use striped inventory locks and per-producer/per-cart locks")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="the level of the marketplace logger")
+    parser.add_argument("--log-every", type=int, default=1,
+                        help="log one in every N marketplace operations, 0 to disable them")
+    parser.add_argument("--runtime", default="thread",
+                        choices=["thread", "pool", "asyncio", "process"],
+                        help="run every producer and consumer in its own thread, the "
+                             "consumers as tasks on a pool of threads, all of them as "
+                             "coroutines on one event loop, or spread over worker processes")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="the number of worker processes of the process runtime "
+                             "(default: the number of CPUs) or of threads of the pool runtime")
+    parser.add_argument("--stats", action="store_true",
+                        help="instrument the marketplace and print its stats to stderr at the end")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="instrument the marketplace and serve its stats in the Prometheus "
+                             "text format on this localhost port while the test runs")
+    parser.add_argument("--virtual-clock", action="store_true",
+                        help="sleep on a simulated clock that skips ahead whenever every "
+                             "producer and consumer is asleep (thread runtime only)")
+    parser.add_argument("--engine", default="realtime", choices=["realtime", "des"],
+                        help="run the actors in real (or virtual) time, or as a single-threaded "
+                             "discrete-event simulation that is reproducible for a given seed")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="the seed of the discrete-event simulation")
+    parser.add_argument("--order-sink", action="store_true",
+                        help="hand the orders to one buffered writer thread instead of "
+                             "printing them from every consumer")
+    parser.add_argument("--sorted-output", action="store_true",
+                        help="write the orders sorted, once every consumer is done "
+                             "(implies --order-sink)")
+    parser.add_argument("--waitlist", action="store_true",
+                        help="queue the consumers that miss a product and hand them the "
+                             "units published later, oldest first")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep the units on sale and in the carts in typed arrays")
+    parser.add_argument("--trace", default=None,
+                        help="record every marketplace call in this binary trace file, "
+                             "see trace_analyzer.py")
+    parser.add_argument("--trace-capacity", type=int, default=1 << 20,
+                        help="the number of records the trace keeps, the last ones")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="route the products by consistent hashing over this many "
+                             "marketplaces (thread and pool runtimes only)")
+    parser.add_argument("--add-shard-after", type=float, default=None,
+                        help="add a shard, rebalancing the products, this many seconds into "
+                             "the test (needs --shards)")
+    args = parser.parse_args()
+    check_args(parser, args)
 
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
+    # the product definitions are turned into products, and the product ids of the
+    # producers and consumers into those products, as the file is read
+    with open(args.input_file, encoding="utf-8") as input_file:
+        if args.engine == "des":
+            run_des(load_config(input_file), args)
+        elif args.runtime == "asyncio":
+            run_asyncio(load_config(input_file), args)
+        elif args.runtime == "process":
+            market_config = load_config(input_file)
+            run_process_pool(market_config, list(market_config['products'].values()), args)
+        else:
+            run_threads(iter_config(input_file), args)
 
-    # turn product definitions into actual products
-    products = {}
 
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
+def check_args(parser, args):
+    """
+        Exit with an error if the options given cannot be combined
+    """
+    if args.runtime == "process" and (args.blocking or args.sharded):
+        parser.error("the process runtime supports neither --blocking nor --sharded")
+    if args.runtime == "process" and (args.stats or args.stats_port is not None):
+        parser.error("the process runtime does not support --stats nor --stats-port")
+    if args.runtime == "process" and (args.order_sink or args.sorted_output):
+        parser.error("the process runtime does not support --order-sink nor --sorted-output")
+    if args.runtime == "process" and (args.waitlist or args.compact or args.trace):
+        parser.error("the process runtime supports neither --waitlist, --compact nor --trace")
+    if args.shards and (args.runtime not in ("thread", "pool") or args.engine == "des"
+                        or args.waitlist):
+        parser.error("--shards needs the thread or pool runtime and supports no --waitlist")
+    if args.runtime == "pool" and args.blocking:
+        parser.error("the pool runtime parks the consumers instead of blocking them")
+    if args.add_shard_after is not None and not args.shards:
+        parser.error("--add-shard-after needs --shards")
+    if args.virtual_clock and (args.runtime != "thread" or args.blocking):
+        parser.error("--virtual-clock needs the thread runtime and no --blocking")
+    if args.engine == "des" and (args.runtime != "thread" or args.blocking or args.virtual_clock):
+        parser.error("--engine des replaces the runtime; it takes neither --blocking, "
+                     "--virtual-clock nor another --runtime")
+
+
+def run_threads(config, args):
+    """
+        Run every producer and consumer in its own thread, or the consumers on a
+        ConsumerPool with the pool runtime, starting each of them as soon as it is read
+    """
+    [marketplace, server, producers, consumers] = [None, None, [], []]
+    clock = VirtualClock() if args.virtual_clock else None
+    [order_sink, trace] = [make_order_sink(args), make_trace(args, clock)]
+    pool = ConsumerPool(args.workers) if args.runtime == "pool" else None
+
+    for kind, value in config:
+        if kind == "marketplace":
+            marketplace = make_marketplace(value, trace, args)
+            server = start_stats(marketplace, args)
+            continue
+        if kind == "producer":
+            actor = Producer(**value, marketplace=marketplace, blocking=args.blocking,
+                             clock=clock, daemon=True)
+            producers.append(actor)
+        elif kind == "consumer" and pool is not None:
+            pool.submit(PooledConsumer(**value, marketplace=marketplace, order_sink=order_sink))
+            continue
+        elif kind == "consumer":
+            actor = Consumer(**value, marketplace=marketplace, blocking=args.blocking,
+                             clock=clock, order_sink=order_sink)
+            consumers.append(actor)
+        else:
+            continue
+        # a virtual clock must know every actor before any of them starts
+        if clock is None:
+            actor.start()
 
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
+    if clock is not None:
+        for actor in producers + consumers:
+            actor.start()
 
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
+    for consumer in consumers:
+        consumer.join()
+    if pool is not None:
+        pool.join()
+        pool.shutdown()
 
-    # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
+    close_order_sink(order_sink)
+    stop_stats(marketplace, server, args)
+    close_trace(trace)
 
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
+
+def run_asyncio(market_config, args):
+    """
+        Run every producer and consumer as a coroutine on a single event loop
+    """
+    trace = make_trace(args)
+    marketplace = AsyncMarketplace(**market_config['marketplace'], sharded=args.sharded,
+                                   log_level=args.log_level, log_every=args.log_every,
+                                   instrument=args.stats or args.stats_port is not None,
+                                   waitlist=args.waitlist, compact=args.compact,
+                                   trace=trace)
+    server = start_stats(marketplace, args)
+    order_sink = make_order_sink(args)
+
+    producers = [AsyncProducer(**p_market_config, marketplace=marketplace, blocking=args.blocking)
                  for p_market_config in market_config['producers']]
+    consumers = [AsyncConsumer(**c_market_config, marketplace=marketplace, blocking=args.blocking,
+                               order_sink=order_sink)
+                 for c_market_config in market_config['consumers']]
 
-    for producer in producers:
-        producer.start()
+    asyncio.run(run_market(producers, consumers))
+    close_order_sink(order_sink)
+    stop_stats(marketplace, server, args)
+    close_trace(trace)
 
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
+
+
+def run_des(market_config, args):
+    """
+        Run every producer and consumer as an actor of a discrete-event simulation
+    """
+    simulation = Simulation(args.seed)
+    trace = make_trace(args, simulation)
+    marketplace = SimulatedMarketplace(**market_config['marketplace'], simulation=simulation,
+                                       sharded=args.sharded, log_level=args.log_level,
+                                       log_every=args.log_every,
+                                       instrument=args.stats or args.stats_port is not None,
+                                       waitlist=args.waitlist, compact=args.compact,
+                                       trace=trace)
+    server = start_stats(marketplace, args)
+    order_sink = make_order_sink(args)
+
+    producers = [SimulatedProducer(**p_market_config, marketplace=marketplace)
+                 for p_market_config in market_config['producers']]
+    consumers = [SimulatedConsumer(**c_market_config, marketplace=marketplace,
+                                   order_sink=order_sink)
                  for c_market_config in market_config['consumers']]
 
-    for consumer in consumers:
-        consumer.start()
+    run_simulation(marketplace, producers, consumers)
+    close_order_sink(order_sink)
+    stop_stats(marketplace, server, args)
+    close_trace(trace)
 
-    for consumer in consumers:
-        consumer.join()
+
+def make_marketplace(config, trace, args):
+    """
+        Build the marketplace of the thread and pool runtimes, federated over --shards
+        marketplaces if it was given
+    """
+    options = {"sharded": args.sharded, "log_level": args.log_level,
+               "log_every": args.log_every, "compact": args.compact, "trace": trace,
+               "instrument": args.stats or args.stats_port is not None}
+    if not args.shards:
+        return Marketplace(**config, waitlist=args.waitlist, **options)
+    marketplace = FederatedMarketplace(**config, shards=args.shards, **options)
+    if args.add_shard_after is not None:
+        timer = Timer(args.add_shard_after, marketplace.add_shard)
+        timer.daemon = True
+        timer.start()
+    return marketplace
+
+
+def make_order_sink(args):
+    """
+        Build the order sink if --order-sink or --sorted-output was given
+    """
+    if not (args.order_sink or args.sorted_output):
+        return None
+    return OrderSink(sort=args.sorted_output)
+
+
+def close_order_sink(order_sink):
+    """
+        Write out the orders still held by the order sink, if there is one
+    """
+    if order_sink is not None:
+        order_sink.close()
+
+
+def make_trace(args, clock=None):
+    """
+        Build the trace recorder if --trace was given, timing the calls on clock if the
+        time is simulated
+    """
+    if args.trace is None:
+        return None
+    return TraceRecorder(args.trace, args.trace_capacity, clock)
+
+
+def close_trace(trace):
+    """
+        Write out the trace, if there is one
+    """
+    if trace is not None:
+        trace.close()
+
+
+def start_stats(marketplace, args):
+    """
+        Serve the marketplace's stats if --stats-port was given
+    """
+    if args.stats_port is None:
+        return None
+    return serve_stats(marketplace, args.stats_port)
+
+
+def stop_stats(marketplace, server, args):
+    """
+        Print the marketplace's stats if --stats was given and stop the stats server
+    """
+    if args.stats:
+        print(dumps(marketplace.stats(), indent=4), file=sys.stderr)
+    if server is not None:
+        server.shutdown()
+
+
+def run_process_pool(market_config, products, args):
+    """
+        Spread the producers and consumers over worker processes sharing the marketplace
+    """
+    marketplace = SharedMarketplace(**market_config['marketplace'], products=products,
+                                    max_producers=len(market_config['producers']))
+
+    run_processes(marketplace, market_config['producers'], market_config['consumers'],
+                  workers=args.workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,367 @@
+"""
+This module tests the scripts that read the tests' configurations and what the
+marketplace recorded.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from collections import Counter, defaultdict
+
+from tema.marketplace import Marketplace
+from tema.marketplace_trace import TraceRecorder
+from tema.product import Coffee, Tea
+from config_loader import iter_config, load_config
+from replay import Replayer, parse_product, read_log, read_trace_operations
+from trace_analyzer import analyze
+
+# a log of one producer and two carts, the second cart logged without its id as in
+# older logs
+LOG = """(2021-03-20 10:00:00,000): New producer: 0
+(2021-03-20 10:00:00,010): Publishing product Tea(name='Linden', price=9, type='Herbal') \
+from producer 0
+(2021-03-20 10:00:00,020): Publishing 2 x product Coffee(name='Indonezia', price=1, \
+acidity=5.05, roast_level='MEDIUM') from producer 0
+2021-03-20 10:00:00,030 - Registering new cart 0
+2021-03-20 10:00:00,040 - Registering new cart
+2021-03-20 10:00:00,050 - Adding product Tea(name='Linden', price=9, type='Herbal') to cart 1
+an unrelated line
+2021-03-20 10:00:00,060 - Place order from cart 1
+"""
+
+# a configuration with its keys in the order of the test files, the marketplace last
+CONFIG = {"products": {"id1": {"product_type": "Tea", "name": "Linden", "type": "Herbal",
+                               "price": 9},
+                       "id2": {"product_type": "Coffee", "name": "Indonezia", "acidity": 5.05,
+                               "roast_level": "MEDIUM", "price": 1}},
+          "producers": [{"name": "prod1", "products": [["id2", 2, 0.18], ["id1", 1, 0.23]],
+                         "republish_wait_time": 0.15}],
+          "consumers": [{"name": "cons1", "retry_wait_time": 0.31,
+                         "carts": [[{"type": "add", "product": "id2", "quantity": 12345},
+                                    {"type": "remove", "product": "id1", "quantity": 1}]]},
+                        {"name": "cons2", "retry_wait_time": 0.5, "carts": [[], []]}],
+          "marketplace": {"queue_size_per_producer": 15}}
+
+
+class TestConfigLoader(unittest.TestCase):
+    """
+    Tests the streaming reader of the test configurations
+    """
+
+
+    def setUp(self):
+        """
+        Sets up the products the configuration describes
+        """
+        self.tea = Tea("Linden", 9, "Herbal")
+        self.coffee = Coffee("Indonezia", 1, 5.05, "MEDIUM")
+
+    def test_chunks(self):
+        """
+        Tests if the values cut by the ends of the chunks are read whole
+        """
+        text = json.dumps(CONFIG, indent=4)
+        for chunk_size in [1, 2, 7, 1 << 16]:
+            items = list(iter_config(io.StringIO(text), chunk_size))
+            self.assertEqual(items[:2], [("products", {"id1": self.tea, "id2": self.coffee}),
+                                         ("marketplace", {"queue_size_per_producer": 15})])
+            self.assertEqual(items[2][1]["products"],
+                             [(self.coffee, 2, 0.18), (self.tea, 1, 0.23)])
+            self.assertEqual([config["carts"] for _, config in items[3:]],
+                             [[[{"type": "add", "product": self.coffee, "quantity": 12345},
+                                {"type": "remove", "product": self.tea, "quantity": 1}]],
+                              [[], []]])
+
+    def test_held_back(self):
+        """
+        Tests if the producers and consumers read before the marketplace are held back
+        until it is read, and those read after it are yielded as soon as they are read
+        """
+        text = json.dumps(CONFIG)
+        kinds = [kind for kind, _ in iter_config(io.StringIO(text), chunk_size=1)]
+        self.assertEqual(kinds, ["products", "marketplace", "producer", "consumer", "consumer"])
+
+        text = json.dumps({"marketplace": CONFIG["marketplace"], **CONFIG,
+                           "consumers": CONFIG["consumers"] * 20})
+        input_file = io.StringIO(text)
+        for kind, config in iter_config(input_file, chunk_size=1):
+            if kind == "producer":
+                self.assertEqual(config["name"], "prod1")
+                self.assertLess(input_file.tell(), len(text) // 2)
+                break
+        else:
+            self.fail("no producer was read")
+
+    def test_missing(self):
+        """
+        Tests if a configuration without its marketplace or products is rejected
+        """
+        for key in ["marketplace", "products"]:
+            text = json.dumps({k: v for k, v in CONFIG.items() if k != key})
+            with self.assertRaises(ValueError):
+                load_config(io.StringIO(text))
+
+
+class TestScaleGenerator(unittest.TestCase):
+    """
+    Tests the large test generator of test-gen
+    """
+
+    def test_generate(self):
+        """
+        Tests if a generated test loads, with every product supplied by a producer, and if
+        its reference output is what the consumers' carts buy
+        """
+        root = os.path.dirname(os.path.abspath(__file__))
+        with tempfile.TemporaryDirectory() as directory:
+            subprocess.run([sys.executable, "scale_generator.py", "small", "--producers", "6",
+                            "--consumers", "5", "--products", "4", "--max-carts", "3",
+                            "--max-ops", "4", "--max-quantity", "3", "--seed", "3",
+                            "--tests-dir", directory],
+                           cwd=os.path.join(root, "test-gen"),
+                           env={**os.environ, "PYTHONPATH": root}, check=True,
+                           capture_output=True)
+            with open(os.path.join(directory, "small.in"), encoding="utf-8") as input_file:
+                config = load_config(input_file)
+            with open(os.path.join(directory, "small.ref.out"), encoding="utf-8") as output_file:
+                reference = Counter(output_file.read().splitlines())
+
+        self.assertEqual([len(config["products"]), len(config["producers"]),
+                          len(config["consumers"])], [4, 6, 5])
+        self.assertEqual({product for producer in config["producers"]
+                          for product, _, _ in producer["products"]},
+                         set(config["products"].values()))
+        bought = Counter()
+        for consumer in config["consumers"]:
+            cart = Counter()
+            for operations in consumer["carts"]:
+                for operation in operations:
+                    sign = 1 if operation["type"] == "add" else -1
+                    cart[operation["product"]] = max(0, cart[operation["product"]]
+                                                     + sign * operation["quantity"])
+            bought.update({f"{consumer['name']} bought {product}": quantity
+                           for product, quantity in cart.items() if quantity})
+        self.assertTrue(reference)
+        self.assertEqual(reference, bought)
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Tests the replay driver: reading logs and traces back and replaying them
+    """
+
+
+    def setUp(self):
+        """
+        Sets up a directory for the logs and traces
+        """
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.tea = Tea("Linden", 9, "Herbal")
+        self.coffee = Coffee("Indonezia", 1, 5.05, "MEDIUM")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, queue_size, calls):
+        """
+        Runs calls, a function of a marketplace, on a traced Marketplace
+
+        :returns the operations read back from the trace
+        """
+        path = os.path.join(self.directory.name, "trace.bin")
+        recorder = TraceRecorder(path, capacity=64)
+        calls(Marketplace(queue_size, log_every=0, trace=recorder))
+        recorder.close()
+        return read_trace_operations(path)
+
+    def test_parse_product(self):
+        """
+        Tests if the products are built back from their reprs, and nothing else is
+        """
+        self.assertEqual(parse_product(repr(self.tea)), self.tea)
+        self.assertEqual(parse_product(f" {self.coffee!r}\n"), self.coffee)
+        for text in ["Milk(name='Whole', price=2)", "print('Tea')", "42",
+                     "Tea(name=input(), price=9, type='Herbal')"]:
+            with self.assertRaises(ValueError):
+                parse_product(text)
+
+    def test_read_log(self):
+        """
+        Tests if the logged operations are read with their actors, products and times
+        """
+        path = os.path.join(self.directory.name, "marketplace.log")
+        with open(path, "w", encoding="utf-8") as log_file:
+            log_file.write(LOG)
+
+        operations = read_log([path])
+        self.assertEqual([operation[1:] for operation in operations],
+                         [("register_producer", 0, None, 1, None),
+                          ("publish", 0, self.tea, 1, None),
+                          ("publish_many", 0, self.coffee, 2, None),
+                          ("new_cart", 0, None, 1, None),
+                          ("new_cart", 1, None, 1, None),
+                          ("add_to_cart", 1, self.tea, 1, None),
+                          ("place_order", 1, None, 1, None)])
+        self.assertEqual(operations[0][0], 0)
+        self.assertAlmostEqual(operations[-1][0], 0.06, places=3)
+
+    def test_read_trace_operations(self):
+        """
+        Tests if the traced operations are read with their results, but for the new ids
+        """
+        def calls(marketplace):
+            producer_id = marketplace.register_producer()
+            marketplace.publish(producer_id, self.tea)
+            marketplace.publish(producer_id, self.tea)
+            cart_id = marketplace.new_cart()
+            marketplace.add_to_cart_many(cart_id, self.tea, 2)
+            marketplace.remove_from_cart(cart_id, self.tea)
+            marketplace.place_order(cart_id)
+
+        operations = self.record(1, calls)
+        self.assertEqual([operation[1:] for operation in operations],
+                         [("register_producer", 0, None, 1, None),
+                          ("publish", 0, self.tea, 1, 1),
+                          ("publish", 0, self.tea, 1, 0),
+                          ("new_cart", 0, None, 1, None),
+                          ("add_to_cart_many", 0, self.tea, 2, 1),
+                          ("remove_from_cart", 0, self.tea, 1, None),
+                          ("place_order", 0, None, 1, 0)])
+        self.assertEqual(sorted(operations), operations)
+
+    def test_remap_ids(self):
+        """
+        Tests if the recorded ids are mapped to the ones the marketplace gives, and the
+        actors registered before the recording started are registered on first use
+        """
+        operations = [(0.0, "register_producer", 7, None, 1, None),
+                      (0.1, "publish", 7, self.tea, 1, 1),
+                      (0.2, "publish", 3, self.coffee, 1, 1),
+                      (0.3, "new_cart", 5, None, 1, None),
+                      (0.4, "add_to_cart", 5, self.coffee, 1, 1),
+                      (0.5, "place_order", 5, None, 1, 1)]
+        marketplace = Marketplace(1, log_every=0)
+        replayer = Replayer(marketplace, speed=0)
+
+        results = replayer.run(operations)
+        self.assertEqual(replayer.ids, {("producer", 7): 0, ("producer", 3): 1, ("cart", 5): 0})
+        self.assertEqual(results["divergences"], {})
+        self.assertEqual(results["calls"]["publish"], 2)
+        self.assertEqual(marketplace.products_list, [{"id": 0, "product": self.tea}])
+
+    def test_actor_order(self):
+        """
+        Tests if the operations of every actor are replayed in their recorded order when
+        the actors are spread over several workers
+        """
+        operations = []
+        for position in range(60):
+            [actor, product] = [position % 5, Tea(f"Tea {position}", 1, "Black")]
+            operations.append((position / 1000, "publish", actor, product, 1, None))
+            operations.append((position / 1000, "add_to_cart", actor, product, 1, None))
+        replayed = defaultdict(list)
+
+        class RecordingReplayer(Replayer):
+            """
+            Replayer that notes the products of the calls of every actor
+            """
+            def call(self, op, actor, product, quantity):
+                replayed[op, actor].append(product)
+                return super().call(op, actor, product, quantity)
+
+        results = RecordingReplayer(Marketplace(100, log_every=0), speed=0).run(operations, 3)
+        self.assertEqual(results["calls"], {"publish": 60, "add_to_cart": 60})
+        recorded = defaultdict(list)
+        for [_, op, actor, product, _, _] in operations:
+            recorded[op, actor].append(product)
+        self.assertEqual(replayed, recorded)
+
+    def test_divergences(self):
+        """
+        Tests if the results that differ from the traced ones are reported
+        """
+        def calls(marketplace):
+            producer_id = marketplace.register_producer()
+            for _ in range(3):
+                marketplace.publish(producer_id, self.tea)
+            cart_id = marketplace.new_cart()
+            marketplace.add_to_cart_many(cart_id, self.tea, 2)
+            marketplace.place_order(cart_id)
+
+        operations = self.record(2, calls)
+        results = Replayer(Marketplace(2, log_every=0), speed=0).run(operations, 2)
+        self.assertEqual(results["divergences"], {})
+
+        results = Replayer(Marketplace(1, log_every=0), speed=0).run(operations, 2)
+        self.assertEqual(results["divergences"], {"publish": 1, "add_to_cart_many": 1,
+                                                  "place_order": 1})
+        self.assertEqual([(example["position"], example["expected"], example["result"])
+                          for example in results["examples"]],
+                         [(2, 1, 0), (5, 2, 1), (6, 2, 1)])
+
+
+class TestTraceAnalyzer(unittest.TestCase):
+    """
+    Tests the analyses of the trace analyzer
+    """
+
+
+    def setUp(self):
+        """
+        Sets up the records of a producer and a cart: the cart waits for product 0 to be
+        published, the producer for room for product 1, and product 2 runs out at the end
+        """
+        # (time, duration, op code, actor, product id, quantity, result)
+        self.records = [(0.0, 0.1, 0, 0, -1, 1, 0), (0.1, 0.1, 4, 0, -1, 1, 0),
+                        (0.2, 0.1, 5, 0, 0, 1, 0), (0.5, 0.1, 5, 0, 0, 1, 0),
+                        (1.2, 0.1, 2, 0, 0, 3, 2), (1.4, 0.1, 6, 0, 0, 2, 2),
+                        (1.5, 0.1, 1, 0, 1, 1, 0), (2.5, 0.1, 1, 0, 1, 1, 1),
+                        (2.6, 0.1, 5, 0, 2, 1, 0), (2.9, 0.1, 10, 0, -1, 1, 2)]
+        self.results = analyze({"records": self.records[::-1], "lost": 0}, 1.0, 2.0)
+
+    def test_throughput(self):
+        """
+        Tests if the calls, the failures and the units are counted per interval
+        """
+        self.assertEqual(self.results["records"], 10)
+        self.assertEqual(self.results["span_s"], 2.9)
+        self.assertEqual(self.results["throughput"],
+                         [{"start": 0.0, "calls": 4, "failed": 2},
+                          {"start": 1.0, "calls": 3, "published": 2, "bought": 2, "failed": 1},
+                          {"start": 2.0, "calls": 3, "published": 1, "failed": 1}])
+        self.assertEqual(self.results["retry_storms"], self.results["throughput"][:1])
+
+    def test_stockouts(self):
+        """
+        Tests if a stockout lasts until the next publish, or until the end of the trace
+        """
+        stockouts = self.results["stockouts"]
+        self.assertEqual(sorted(stockouts), [0, 2])
+        self.assertEqual([stockouts[0]["failed_adds"], stockouts[0]["stockouts"]], [2, 1])
+        self.assertAlmostEqual(stockouts[0]["duration"], 1.0)
+        self.assertEqual([stockouts[2]["failed_adds"], stockouts[2]["stockouts"]], [1, 1])
+        self.assertAlmostEqual(stockouts[2]["duration"], 0.3)
+
+    def test_waits(self):
+        """
+        Tests if the waits last from the first failed attempt to the next successful one
+        """
+        waits = self.results["waits"]
+        self.assertEqual(sorted(waits["cart"]), [0])
+        self.assertAlmostEqual(waits["cart"][0], 1.2)
+        self.assertEqual(sorted(waits["producer"]), [0])
+        self.assertAlmostEqual(waits["producer"][0], 1.0)
+        self.assertEqual(self.results["wait_distribution"]["cart"]["count"], 1)
+        self.assertEqual(self.results["call_durations"]["add_to_cart"]["count"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+"""
+This module analyzes a binary marketplace trace written with test.py --trace
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import json
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+
+from tema.marketplace_trace import OPS, read_trace
+
+PUBLISH_OPS = {OPS.index(name) for name in ("publish", "publish_many", "publish_wait")}
+ADD_OPS = {OPS.index(name) for name in ("add_to_cart", "add_to_cart_many", "add_to_cart_wait")}
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which fraction of the sorted values fall, 0 if there are none
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def distribution(values):
+    """
+    Returns the count, mean, median, 99th percentile and maximum of values
+    """
+    values = sorted(values)
+    return {"count": len(values), "mean": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(values, 0.5), "p99": percentile(values, 0.99),
+            "max": values[-1] if values else 0.0}
+
+
+def throughput(records, interval):
+    """
+    Buckets the calls by time
+
+    :returns per interval, from the first: the calls, the failed calls and the units
+    published and bought
+    """
+    buckets = defaultdict(Counter)
+    for [when, _, op, _, _, _, result] in records:
+        bucket = buckets[int(when // interval)]
+        bucket["calls"] += 1
+        if op in PUBLISH_OPS or op in ADD_OPS:
+            units = int(result)
+            bucket["failed" if units <= 0 else
+                   "published" if op in PUBLISH_OPS else "bought"] += max(units, 1)
+    return [dict(buckets[i], start=i * interval)
+            for i in range(min(buckets, default=0), max(buckets, default=-1) + 1)]
+
+
+def retry_storms(buckets, interval, threshold):
+    """
+    Returns the intervals in which publishes and adds failed at least threshold times a
+    second: their callers were mostly sleeping and retrying
+    """
+    return [bucket for bucket in buckets if bucket.get("failed", 0) / interval >= threshold]
+
+
+def stockouts(records, end):
+    """
+    Follows every product's stockouts: a stockout starts with an add that finds no unit
+    and ends with the next successful publish of the product
+
+    :returns per product id: the failed adds, the stockouts and their total duration
+    """
+    [products, since] = [defaultdict(Counter), {}]
+    for [when, _, op, _, product_id, _, result] in records:
+        if op in ADD_OPS and result <= 0:
+            products[product_id]["failed_adds"] += 1
+            if product_id not in since:
+                since[product_id] = when
+                products[product_id]["stockouts"] += 1
+        elif op in PUBLISH_OPS and result > 0 and product_id in since:
+            products[product_id]["duration"] += when - since.pop(product_id)
+    for product_id, start in since.items():
+        products[product_id]["duration"] += end - start
+    return products
+
+
+def actor_latency(records):
+    """
+    Measures how long the actors waited: from the first failed attempt of a cart to add a
+    product, or of a producer to publish, until the next successful one
+
+    :returns the waits of the carts and of the producers, by actor id, and the durations
+    of the calls, by op
+    """
+    [waits, first_failure, durations] = [{"cart": defaultdict(list), "producer":
+                                          defaultdict(list)}, {}, defaultdict(list)]
+    for [when, duration, op, actor, product_id, _, result] in records:
+        durations[OPS[op]].append(duration)
+        if op in ADD_OPS:
+            key = ("cart", actor, product_id)
+        elif op in PUBLISH_OPS:
+            key = ("producer", actor, product_id)
+        else:
+            continue
+        if result <= 0:
+            first_failure.setdefault(key, when)
+        elif key in first_failure:
+            waits[key[0]][actor].append(when - first_failure.pop(key))
+    return waits, durations
+
+
+def analyze(trace, interval, storm_threshold):
+    """
+    Runs every analysis on a trace read by read_trace
+
+    :returns a dict with the results
+    """
+    records = sorted(trace["records"])
+    end = records[-1][0] if records else 0.0
+    buckets = throughput(records, interval)
+    [waits, durations] = actor_latency(records)
+    return {"records": len(records), "lost": trace["lost"], "span_s": end,
+            "throughput": buckets,
+            "retry_storms": retry_storms(buckets, interval, storm_threshold),
+            "stockouts": stockouts(records, end),
+            "waits": {kind: {actor: sum(values) for actor, values in by_actor.items()}
+                      for kind, by_actor in waits.items()},
+            "wait_distribution": {kind: distribution([value for values in by_actor.values()
+                                                      for value in values])
+                                  for kind, by_actor in waits.items()},
+            "call_durations": {op: distribution(values) for op, values in durations.items()}}
+
+
+def print_report(results, products, top):
+    """
+    Prints the results of analyze, the top entries of every ranking
+    """
+    def product_name(product_id):
+        return products[product_id] if 0 <= product_id < len(products) else f"#{product_id}"
+
+    print(f"{results['records']} records over {results['span_s']:.2f}s"
+          + (f", {results['lost']} older ones overwritten" if results['lost'] else ""))
+
+    print("\nThroughput (start: calls, failed, published, bought)")
+    for bucket in results["throughput"]:
+        print(f"  {bucket['start']:8.2f}s: {bucket.get('calls', 0)}, {bucket.get('failed', 0)}, "
+              f"{bucket.get('published', 0)}, {bucket.get('bought', 0)}")
+
+    print(f"\nRetry storms: {len(results['retry_storms'])} intervals")
+    for bucket in results["retry_storms"][:top]:
+        print(f"  {bucket['start']:8.2f}s: {bucket['failed']} failed calls")
+
+    print("\nStockouts (product: stockouts, failed adds, total duration)")
+    ranked = sorted(results["stockouts"].items(), key=lambda item: -item[1]["duration"])
+    for product_id, stockout in ranked[:top]:
+        print(f"  {product_name(product_id)}: {stockout['stockouts']}, "
+              f"{stockout['failed_adds']}, {stockout['duration']:.3f}s")
+
+    for kind, distribution_ in results["wait_distribution"].items():
+        print(f"\nWaits of the {kind}s: {distribution_['count']}, mean "
+              f"{distribution_['mean']:.3f}s, p50 {distribution_['p50']:.3f}s, p99 "
+              f"{distribution_['p99']:.3f}s, max {distribution_['max']:.3f}s")
+        ranked = sorted(results["waits"][kind].items(), key=lambda item: -item[1])
+        for actor, total in ranked[:top]:
+            print(f"  {kind} {actor}: {total:.3f}s in total")
+
+    print("\nCall durations (op: calls, p50, p99, max)")
+    for op, distribution_ in sorted(results["call_durations"].items()):
+        print(f"  {op}: {distribution_['count']}, {distribution_['p50'] * 1e6:.1f}us, "
+              f"{distribution_['p99'] * 1e6:.1f}us, {distribution_['max'] * 1e6:.1f}us")
+
+
+def write_report(results, path):
+    """
+    Writes the results to a JSON file, if a path is given
+    """
+    if path:
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(results, report_file, indent=4)
+
+
+def main():
+    """
+    Analyzes the trace given on the command line
+    """
+    parser = ArgumentParser(description="Analyze a marketplace trace written by test.py --trace")
+    parser.add_argument("trace_file", help="the trace file")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="the seconds of every throughput interval")
+    parser.add_argument("--storm-threshold", type=float, default=100.0,
+                        help="the failed publishes and adds per second of a retry storm")
+    parser.add_argument("--top", type=int, default=10,
+                        help="the number of entries shown of every ranking")
+    parser.add_argument("--report", default=None,
+                        help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    trace = read_trace(args.trace_file)
+    results = analyze(trace, args.interval, args.storm_threshold)
+    print_report(results, trace["products"], args.top)
+    write_report(results, args.report)
+
+
+if __name__ == "__main__":
+    main()